@@ -42,7 +42,9 @@ class AviaNZ_batchProcess():
     # Also called by the GUI
     # Parent: AviaNZ_batchWindow
     # mode: "GUI/CLI/test". If GUI, must provide the parent
-    def __init__(self, parent, mode="GUI", configdir='', sdir='', recogniser=None, wind=0, maxgap=1.0, minlen=0.5, maxlen=10.0):
+    # nprocs: number of processes to analyse files in parallel (0 = all cores).
+    #   If None, read from config
+    def __init__(self, parent, mode="GUI", configdir='', sdir='', recogniser=None, wind=0, maxgap=1.0, minlen=0.5, maxlen=10.0, nprocs=None):
         # read config and filters from user location
         # recogniser - filter file name without ".txt"
         self.configdir = configdir
@@ -69,6 +71,10 @@ class AviaNZ_batchProcess():
         elif mode=="export":
             self.CLI = False
             self.testmode=False
+        elif mode=="worker":
+            # a process of the parallel pool, with no UI
+            self.CLI = True
+            self.testmode = False
         else:
             print("ERROR: unrecognized mode ", mode)
             return
@@ -81,9 +87,26 @@ class AviaNZ_batchProcess():
         self.minlen = minlen
         self.maxlen = maxlen
 
+        if nprocs is None:
+            nprocs = self.config.get("batchProcesses", 1)
+        if nprocs == 0:
+            nprocs = os.cpu_count() or 1
+        self.nprocs = max(1, int(nprocs))
+        # threads to analyse wavelet nodes of a page in parallel (0 = all cores).
+        # Only used when files are not already spread over processes.
+        nthreads = self.config.get("batchThreads", 1)
+        if nthreads == 0:
+            nthreads = os.cpu_count() or 1
+        self.nthreads = 1 if (self.nprocs > 1 or mode == "worker") else max(1, int(nthreads))
+        # wavelet denoising of pages before detection: "none", or the noise estimator to use
+        self.denoise = self.config.get("batchDenoise", "none")
+
         # In CLI/test modes, immediately run detection on init.
-        # Otherwise GUI will ping that once it is moved to the right thread
-        if self.CLI or self.testmode:
+        # Otherwise GUI will ping that once it is moved to the right thread.
+        # Pool workers get their files one by one from the parent process.
+        if mode=="worker":
+            self.species = recogniser
+        elif self.CLI or self.testmode:
             self.species = [recogniser]
             self.detect()
         else:
@@ -128,7 +151,11 @@ class AviaNZ_batchProcess():
 
             # load target CNN models (currently stored in the same dir as filters)
             # format: {filtername: [model, win, inputdim, output]}
-            self.CNNDicts = self.ConfigLoader.CNNmodels(self.FilterDicts, self.filtersDir, self.species)
+            # (with several processes, each worker loads its own copy instead)
+            if self.nprocs > 1:
+                self.CNNDicts = {}
+            else:
+                self.CNNDicts = self.ConfigLoader.CNNmodels(self.FilterDicts, self.filtersDir, self.species, backend=self.config.get("CNNBackend", "keras"))
 
         # LIST ALL FILES that will be processed (either wav or bmp, depending on mode)
         allwavs = []
@@ -336,12 +363,16 @@ class AviaNZ_batchProcess():
     def mainloop(self,allwavs,total,speciesStr,filters,settings):
         # MAIN PROCESSING starts here
         processingTime = 0
-        cleanexit = 0
         cnt = 0
 
         timeWindow_s = settings[1]
         timeWindow_e = settings[2]
 
+        # Intermittent sampling does not read the audio, so no point in spreading it
+        if self.nprocs > 1 and self.method != "Intermittent sampling":
+            self.mainloopParallel(allwavs, total, speciesStr, filters, timeWindow_s, timeWindow_e)
+            return
+
         for filename in allwavs:
             # get remaining run time in min
             processingTimeStart = time.time()
@@ -351,122 +382,199 @@ class AviaNZ_batchProcess():
 
             print("*** Processing" + progrtext + " ***")
 
-            # if it was processed previously (stored in log)
-            if filename in self.filesDone:
-                # skip the processing:
-                print("File %s processed previously, skipping" % filename)
-                self.log.appendFile(filename)
+            if not self.checkFile(filename, timeWindow_s, timeWindow_e):
                 continue
 
-            # check if file not empty
-            if os.stat(filename).st_size < 1000:
-                print("File %s empty, skipping" % filename)
+            # ALL SYSTEMS GO: process this file
+            try:
+                self.processFile(filename, speciesStr, filters)
+            except GentleExitException:
+                raise
+            except Exception:
+                estr = "Encountered error:\n" + traceback.format_exc()
+                print("ERROR: ", estr)
                 if not self.testmode:
-                    self.log.appendFile(filename)
-                continue
-
-            # check if file is formatted correctly
-            with open(filename, 'br') as f:
-                if (self.method == "Click" and f.read(2) != b'BM') or (self.method == "Bats" and f.read(2) != b'BM') or (self.method != "Click" and self.method != "Bats" and f.read(4) != b'RIFF'):
-                    print("Warning: file %s not formatted correctly, skipping" % filename)
-                    self.log.appendFile(filename)
-                    continue
-
-            # test the selected time window if it is a doc recording
-            DOCRecording = re.search(r'(\d{6})_(\d{6})', os.path.basename(filename))
-            if DOCRecording:
-                startTime = DOCRecording.group(2)
-                sTime = int(startTime[:2]) * 3600 + int(startTime[2:4]) * 60 + int(startTime[4:6])
-                if timeWindow_s == timeWindow_e:
-                    # (no time window set)
-                    inWindow = True
-                elif timeWindow_s < timeWindow_e:
-                    # for day times ("8 to 17")
-                    inWindow = (sTime >= timeWindow_s and sTime <= timeWindow_e)
-                else:
-                    # for times that include midnight ("17 to 8")
-                    inWindow = (sTime >= timeWindow_s or sTime <= timeWindow_e)
-            else:
-                inWindow = True
+                    self.log.file.close()
+                raise
 
-            if DOCRecording and not inWindow:
-                print("Skipping out-of-time-window recording")
-                if not self.testmode:
-                    self.log.appendFile(filename)
-                continue
+            self.saveResults(filename)
 
-            # ALL SYSTEMS GO: process this file
-            self.filename = filename
-            self.segments = Segment.SegmentList()
-            if self.testmode:
-                self.segments_nocnn = Segment.SegmentList()
-            if self.method == "Intermittent sampling":
-                try:
-                    self.addRegularSegments()
-                except Exception:
-                    estr = "Encountered error:\n" + traceback.format_exc()
-                    print("ERROR: ", estr)
+            # Update ProgrDlg
+            if not self.testmode and not self.CLI:
+                self.need_update.emit(cnt,"Analysed "+progrtext)
+                # TODO sprinkle more of these checks
+                if self.ui.dlg.wasCanceled():
+                    print("Analysis cancelled")
                     self.log.file.close()
-                    raise
-            else:
-                # load audiodata/spectrogram and clean up old segments:
-                print("Loading file...")
-                # Impulse masking:   TODO masking is useful but could be improved
-                if speciesStr=="Any sound":
-                    impMask = True  # Up to debate - could turn this off here
-                elif self.method=="Click" or self.method=="Bats":
-                    impMask = False  # definitely off for bats
-                else:
-                    # MUST BE off for changepoints (it introduces discontinuities, which
-                    # create large WCs and highly distort means/variances)
-                    impMask = "chp" not in [sf.get("method") for sf in filters]
-                self.loadFile(species=self.species, anysound=(speciesStr == "Any sound"), impMask=impMask)
-
-                # initialize empty segmenter
-                if self.method=="Wavelets":
-                    self.ws = WaveletSegment.WaveletSegment(wavelet='dmey2')
-                    del self.sp
-                    gc.collect()
-
-                # Main work is done here:
-                try:
-                    print("Segmenting...")
-                    self.detectFile(speciesStr, filters)
-                except GentleExitException:
-                    raise
-                except Exception:
-                    estr = "Encountered error:\n" + traceback.format_exc()
-                    print("ERROR: ", estr)
-                    self.log.file.close()
-                    raise
-
-                print('Segments in this file: ', self.segments)
+                    raise GentleExitException
+            # track how long it took to process one file:
+            processingTime = time.time() - processingTimeStart
+            print("File processed in", processingTime)
+            # END of audio batch processing
 
-            # export segments
-            print("%d new segments marked" % len(self.segments))
-            if self.testmode:
-                # save separately With and without CNN
-                cleanexit = self.saveAnnotation(self.segments, suffix=".tmpdata")
-                cleanexit = self.saveAnnotation(self.segments_nocnn, suffix=".tmp2data")
-            else:
-                cleanexit = self.saveAnnotation(self.segments)
-            if cleanexit != 1:
-                print("Warning: could not save segments!")
+    def mainloopParallel(self, allwavs, total, speciesStr, filters, timeWindow_s, timeWindow_e):
+        """ Same as mainloop, but the files are analysed by a pool of self.nprocs processes.
+            The workers only read and segment the audio, and send the segments back.
+            All writing to the .data files and to the log is done here, in the parent,
+            so the log never lists a file whose annotations were not saved.
+        """
+        import multiprocessing
 
-            # Log success for this file and update ProgrDlg
-            if not self.testmode:
-                self.log.appendFile(filename)
-                if not self.CLI:
+        # cheap checks (log, empty files, time window) are done first, here
+        todo = []
+        for filename in allwavs:
+            if self.checkFile(filename, timeWindow_s, timeWindow_e):
+                todo.append(filename)
+        cnt = total - len(todo)
+        if len(todo) == 0:
+            return
+        nprocs = min(self.nprocs, len(todo))
+        print("Analysing %d files using %d processes" % (len(todo), nprocs))
+
+        # spawn, not fork: TensorFlow and Qt do not survive forking
+        ctx = multiprocessing.get_context("spawn")
+        pool = ctx.Pool(processes=nprocs, initializer=_initPoolWorker,
+                        initargs=(self.configdir, self.species, self.method, self.testmode, self.wind, self.maxgap, self.minlen, self.maxlen))
+        processingTimeStart = time.time()
+        ndone = 0
+        try:
+            jobs = [(filename, speciesStr, filters) for filename in todo]
+            for res in pool.imap_unordered(_runPoolWorker, jobs):
+                ndone += 1
+                cnt += 1
+                self.filename = res["filename"]
+                self.segments = res["segments"]
+                self.segments_nocnn = res["segments_nocnn"]
+                self.datalength = res["datalength"]
+                self.sampleRate = res["sampleRate"]
+                self.saveResults(self.filename)
+
+                processingTime = (time.time() - processingTimeStart) / ndone
+                hh,mm = divmod(processingTime * (len(todo)-ndone) / 60, 60)
+                progrtext = "file %d / %d. Time remaining: %d h %.2f min" % (cnt, total, hh, mm)
+                print("*** Analysed " + progrtext + " ***")
+                if not self.testmode and not self.CLI:
                     self.need_update.emit(cnt,"Analysed "+progrtext)
-                    # TODO sprinkle more of these checks
                     if self.ui.dlg.wasCanceled():
                         print("Analysis cancelled")
                         self.log.file.close()
                         raise GentleExitException
-            # track how long it took to process one file:
-            processingTime = time.time() - processingTimeStart
-            print("File processed in", processingTime)
-            # END of audio batch processing
+        except GentleExitException:
+            pool.terminate()
+            raise
+        except Exception:
+            estr = "Encountered error:\n" + traceback.format_exc()
+            print("ERROR: ", estr)
+            pool.terminate()
+            if not self.testmode:
+                self.log.file.close()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def checkFile(self, filename, timeWindow_s, timeWindow_e):
+        """ Returns True if this file needs to be analysed.
+            Skipped files are marked as done in the log.
+        """
+        # if it was processed previously (stored in log)
+        if filename in self.filesDone:
+            # skip the processing:
+            print("File %s processed previously, skipping" % filename)
+            self.log.appendFile(filename)
+            return False
+
+        # check if file not empty
+        if os.stat(filename).st_size < 1000:
+            print("File %s empty, skipping" % filename)
+            if not self.testmode:
+                self.log.appendFile(filename)
+            return False
+
+        # check if file is formatted correctly
+        with open(filename, 'br') as f:
+            if (self.method == "Click" and f.read(2) != b'BM') or (self.method == "Bats" and f.read(2) != b'BM') or (self.method != "Click" and self.method != "Bats" and f.read(4) != b'RIFF'):
+                print("Warning: file %s not formatted correctly, skipping" % filename)
+                self.log.appendFile(filename)
+                return False
+
+        # test the selected time window if it is a doc recording
+        DOCRecording = re.search(r'(\d{6})_(\d{6})', os.path.basename(filename))
+        if DOCRecording:
+            startTime = DOCRecording.group(2)
+            sTime = int(startTime[:2]) * 3600 + int(startTime[2:4]) * 60 + int(startTime[4:6])
+            if timeWindow_s == timeWindow_e:
+                # (no time window set)
+                inWindow = True
+            elif timeWindow_s < timeWindow_e:
+                # for day times ("8 to 17")
+                inWindow = (sTime >= timeWindow_s and sTime <= timeWindow_e)
+            else:
+                # for times that include midnight ("17 to 8")
+                inWindow = (sTime >= timeWindow_s or sTime <= timeWindow_e)
+        else:
+            inWindow = True
+
+        if DOCRecording and not inWindow:
+            print("Skipping out-of-time-window recording")
+            if not self.testmode:
+                self.log.appendFile(filename)
+            return False
+
+        return True
+
+    def processFile(self, filename, speciesStr, filters):
+        """ Reads and segments a single file, leaving the results in self.segments
+            (and self.segments_nocnn in testmode). Does not save anything.
+        """
+        self.filename = filename
+        self.segments = Segment.SegmentList()
+        if self.testmode:
+            self.segments_nocnn = Segment.SegmentList()
+        if self.method == "Intermittent sampling":
+            self.addRegularSegments()
+        else:
+            # load audiodata/spectrogram and clean up old segments:
+            print("Loading file...")
+            # Impulse masking:   TODO masking is useful but could be improved
+            if speciesStr=="Any sound":
+                impMask = True  # Up to debate - could turn this off here
+            elif self.method=="Click" or self.method=="Bats":
+                impMask = False  # definitely off for bats
+            else:
+                # MUST BE off for changepoints (it introduces discontinuities, which
+                # create large WCs and highly distort means/variances)
+                impMask = "chp" not in [sf.get("method") for sf in filters]
+            self.loadFile(species=self.species, anysound=(speciesStr == "Any sound"), impMask=impMask)
+
+            # initialize empty segmenter
+            if self.method=="Wavelets":
+                self.ws = WaveletSegment.WaveletSegment(wavelet='dmey2', nthreads=self.nthreads)
+                del self.sp
+                gc.collect()
+
+            # Main work is done here:
+            print("Segmenting...")
+            self.detectFile(speciesStr, filters)
+
+            print('Segments in this file: ', self.segments)
+
+    def saveResults(self, filename):
+        """ Exports the segments of the current file and logs it as done. """
+        print("%d new segments marked" % len(self.segments))
+        if self.testmode:
+            # save separately With and without CNN
+            cleanexit = self.saveAnnotation(self.segments, suffix=".tmpdata")
+            cleanexit = self.saveAnnotation(self.segments_nocnn, suffix=".tmp2data")
+        else:
+            cleanexit = self.saveAnnotation(self.segments)
+        if cleanexit != 1:
+            print("Warning: could not save segments!")
+
+        # Log success for this file
+        if not self.testmode:
+            self.log.appendFile(filename)
 
     def addRegularSegments(self):
         """ Perform the Hartley bodge: add 10s segments every minute. """
@@ -512,11 +620,26 @@ class AviaNZ_batchProcess():
         # (ceil division for large integers)
         numPages = (self.datalength - 1) // samplesInPage + 1
 
+        # Audio is read from disk one page at a time, so self.audiodata only holds the current page.
+        # (bat methods work on the spectrogram already read in loadFile)
+        if self.method == "Click" or self.method == "Bats":
+            pages = ((start, None) for start in range(0, self.datalength, samplesInPage))
+        elif self.method == "Wavelets":
+            # wavelet filters can run in single precision to save memory
+            pages = self.readPages(samplesInPage, dtype=self.getPrecision(filters))
+        else:
+            pages = self.readPages(samplesInPage)
+
         # Actual segmentation happens here:
-        for page in range(numPages):
+        for page, (start, pagedata) in enumerate(pages):
             print("Segmenting page %d / %d" % (page+1, numPages))
-            start = page*samplesInPage
-            end = min(start+samplesInPage, self.datalength)
+            self.audiodata = pagedata
+            # CNN page spectrogram windows (if used) are only valid for this page
+            self.CNNpagesps = {}
+            if self.audiodata is None:
+                end = min(start+samplesInPage, self.datalength)
+            else:
+                end = start + len(self.audiodata)
             thisPageLen = (end-start) / self.sampleRate
 
             if thisPageLen < 2 and (self.method != "Click" and self.method != "Bats"):
@@ -528,7 +651,7 @@ class AviaNZ_batchProcess():
                 # Create spectrogram for median clipping etc
                 if not hasattr(self, 'sp'):
                     self.sp = SignalProc.SignalProc(self.config['window_width'], self.config['incr'])
-                self.sp.data = self.audiodata[start:end]
+                self.sp.data = self.audiodata
                 self.sp.sampleRate = self.sampleRate
                 _ = self.sp.spectrogram(window='Hann', sgType='Standard', mean_normalise=True, onesided=True)
                 self.seg = Segment.Segmenter(self.sp, self.sampleRate)
@@ -537,7 +660,7 @@ class AviaNZ_batchProcess():
                 # Post-process
                 print("Segments detected: ", len(thisPageSegs))
                 print("Post-processing...")
-                post = Segment.PostProcess(configdir=self.configdir, audioData=self.audiodata[start:end], sampleRate=self.sampleRate, segments=thisPageSegs, subfilter={}, cert=0)
+                post = Segment.PostProcess(configdir=self.configdir, audioData=self.audiodata, sampleRate=self.sampleRate, segments=thisPageSegs, subfilter={}, cert=0)
                 post.joinGaps(self.maxgap)
                 post.deleteShort(self.minlen)
                 # avoid extra long segments (for Isabel)
@@ -561,7 +684,7 @@ class AviaNZ_batchProcess():
             else:
                 if self.method != "Click" and self.method != "Bats":
                     # read in the page and resample as needed
-                    self.ws.readBatch(self.audiodata[start:end], self.sampleRate, d=False, spInfo=filters, wpmode="new", wind=self.wind>0)
+                    self.ws.readBatch(self.audiodata, self.sampleRate, d=self.denoise!="none", spInfo=filters, wpmode="new", wind=self.wind>0, noiseest=self.denoise)
 
                 data_test = []
                 click_label = 'None'
@@ -732,10 +855,11 @@ class AviaNZ_batchProcess():
         """ Full bird-style postprocessing (CNN, joinGaps...)
             segments: list of segments over calltypes
             start, end: start and end of this page, in samples
+                (self.audiodata must contain this page)
             CNNmodel: None or a CNN
         """
         subfilter = spInfo["Filters"][filtix]
-        post = Segment.PostProcess(configdir=self.configdir, audioData=self.audiodata[start:end],
+        post = Segment.PostProcess(configdir=self.configdir, audioData=self.audiodata,
                             sampleRate=self.sampleRate, tgtsampleRate=spInfo["SampleRate"],
                             segments=segments[filtix], subfilter=subfilter,
                             CNNmodel=CNNmodel, cert=50)
@@ -743,7 +867,15 @@ class AviaNZ_batchProcess():
 
         if CNNmodel:
             print('Post-processing with CNN')
-            post.CNN()
+            if self.config.get("CNNPageSpec", False) and len(post.segments)>0:
+                # spectrogram windows of the page for each CNN spectrogram setting,
+                # shared over call types and species
+                spkey = (tuple(CNNmodel[4]), spInfo["SampleRate"])
+                if spkey not in self.CNNpagesps:
+                    self.CNNpagesps[spkey] = post.CNNPageSpec()
+                post.CNN(pagesp=self.CNNpagesps[spkey])
+            else:
+                post.CNN()
 
         # Fund freq and merging. Only do for standard wavelet filter currently:
         # (for median clipping, gap joining and some short segment cleanup was already done in WaveletSegment)
@@ -827,12 +959,12 @@ class AviaNZ_batchProcess():
             self.sampleRate = self.sp.sampleRate
             self.datalength = self.sp.fileLength
         else:
-            self.sp.readWav(self.filename)
-            self.sampleRate = self.sp.sampleRate
-            self.audiodata = self.sp.data
-
-            self.datalength = np.shape(self.audiodata)[0]
-            print("Read %d samples, %f s at %d Hz" % (len(self.audiodata), float(self.datalength)/self.sampleRate, self.sampleRate))
+            # audio is streamed from disk one page at a time in detectFile,
+            # so only read the header here
+            (rate, nseconds, nchannels, sampwidth) = wavio.readFmt(self.filename)
+            self.sampleRate = rate
+            self.datalength = int(round(nseconds*rate))
+            print("File has %d samples, %f s at %d Hz" % (self.datalength, nseconds, self.sampleRate))
 
         # Read in stored segments (useful when doing multi-species)
         self.segments = Segment.SegmentList()
@@ -860,13 +992,49 @@ class AviaNZ_batchProcess():
                             del self.segments[i]
             print("%d segments loaded from .data file" % len(self.segments))
 
-        # impulse masking (on by default)
+        # impulse masking (on by default), applied to each page when it is read
         if impMask:
             if anysound:
-                self.sp.data = self.sp.impMask(engp=70, fp=0.50)
+                self.impMaskArgs = {"engp": 70, "fp": 0.50}
             else:
-                self.sp.data = self.sp.impMask()
-            self.audiodata = self.sp.data
+                self.impMaskArgs = {}
+        else:
+            self.impMaskArgs = None
+
+    def getPrecision(self, filters):
+        """ Returns the float type to use for the audio and wavelet trees.
+            The "precision" setting of a filter overrides the global config one.
+            If the filters disagree, the higher precision is used.
+        """
+        if filters is None:
+            return np.float64
+        default = self.config.get("precision", "float64")
+        precisions = set([filt.get("precision", default) for filt in filters])
+        if "float64" in precisions:
+            return np.float64
+        return np.float32
+
+    def readPages(self, samplesInPage, dtype=np.float64):
+        """ Streams the current file from disk, samplesInPage samples at a time,
+            applying impulse masking if requested in loadFile.
+            Yields (start, data) for each page, start in samples, data of dtype.
+            At the end, updates self.datalength to the number of samples actually read.
+        """
+        # Impulse masking sees some context on either side of each page, so that
+        # impulse runs and windows crossing page boundaries are detected.
+        # (a multiple of the largest impulse window, 1024, keeps the window grid aligned)
+        overlap = 16*1024 if self.impMaskArgs is not None else 0
+        sp = SignalProc.SignalProc(self.config['window_width'], self.config['incr'])
+        end = 0
+        for start, left, data in sp.readWavPages(self.filename, samplesInPage, overlap, dtype=dtype):
+            if self.impMaskArgs is not None:
+                sp.data = data
+                sp.sampleRate = self.sampleRate
+                data = sp.impMask(**self.impMaskArgs).astype(dtype, copy=False)
+            data = data[left:left+samplesInPage]
+            end = start + len(data)
+            yield start, data
+        self.datalength = end
 
     def ClickSearch(self, imspec, file,virginia=True):
         """
@@ -1468,6 +1636,27 @@ class AviaNZ_batchProcess():
                     date = '.\\'+root.split('/')[-1]
 
 
+# Each process of the parallel pool keeps one batch processor,
+# so that the filters and CNN models are loaded only once per process.
+_poolWorker = None
+
+def _initPoolWorker(configdir, species, method, testmode, wind, maxgap, minlen, maxlen):
+    global _poolWorker
+    _poolWorker = AviaNZ_batchProcess(parent=None, mode="worker", configdir=configdir, recogniser=species, wind=wind, maxgap=maxgap, minlen=minlen, maxlen=maxlen, nprocs=1)
+    _poolWorker.method = method
+    _poolWorker.testmode = testmode
+    if method in ["Wavelets", "Click", "Bats"]:
+        _poolWorker.CNNDicts = _poolWorker.ConfigLoader.CNNmodels(_poolWorker.FilterDicts, _poolWorker.filtersDir, species, backend=_poolWorker.config.get("CNNBackend", "keras"))
+
+def _runPoolWorker(job):
+    # Analyses one file in a pool process and returns the results to be saved by the parent
+    filename, speciesStr, filters = job
+    _poolWorker.processFile(filename, speciesStr, filters)
+    return {"filename": filename, "segments": _poolWorker.segments,
+            "segments_nocnn": getattr(_poolWorker, "segments_nocnn", None),
+            "datalength": _poolWorker.datalength, "sampleRate": _poolWorker.sampleRate}
+
+
 class GentleExitException(Exception):
     """ To allow tracking user-requested aborts, instead of using C-style returns. """
     pass
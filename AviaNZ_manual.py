@@ -3982,7 +3982,7 @@ class AviaNZ(QMainWindow):
             for f in speciesData['Filters']:
                 CTs.append(f['calltype'])
             CTs.append('Noise')
-            self.CNNDicts = self.ConfigLoader.CNNmodels(self.FilterDicts, self.filtersDir, [filtername])
+            self.CNNDicts = self.ConfigLoader.CNNmodels(self.FilterDicts, self.filtersDir, [filtername], backend=self.config.get("CNNBackend", "keras"))
 
             segment = [[self.startRead, self.startRead + self.datalengthSec]]
             CNNmodel = None
@@ -4967,7 +4967,7 @@ class AviaNZ(QMainWindow):
                 print(newSegments)
                 print('Post-processing...')
                 # load target CNN model if exists
-                self.CNNDicts = self.ConfigLoader.CNNmodels(self.FilterDicts, self.filtersDir, [filtname])
+                self.CNNDicts = self.ConfigLoader.CNNmodels(self.FilterDicts, self.filtersDir, [filtname], backend=self.config.get("CNNBackend", "keras"))
                 # postProcess currently operates on single-level list of segments,
                 # so we run it over subfilters for wavelets:
                 for filtix in range(len(speciesData['Filters'])):
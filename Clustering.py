@@ -22,14 +22,15 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
-import random
 import os, wavio
+import json, hashlib
 import librosa
 
 import WaveletSegment
 import WaveletFunctions
 import SignalProc
 import Segment
+from ext import ce_dtw
 
 from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import scale
@@ -63,9 +64,14 @@ class Clustering:
         self.targets = labels
         self.n_clusters = nclusters
 
-    def custom_dist(self, x, y):
-            d, _ = librosa.sequence.dtw(x, y, metric='euclidean')
-            return d[d.shape[0] - 1][d.shape[1] - 1]
+        self.distances = None
+        self.featureStore = None
+
+    def custom_dist(self, x, y, maxcost=np.inf):
+            """ DTW distance with Euclidean frame cost, for features stored as features x frames
+                (or 1D series). Distances above maxcost are returned as np.inf.
+            """
+            return pairDistance(x, y, 'dtw', maxcost=maxcost)
 
     def clusteringScore1(self, labels_true, labels):
         """ Evaluate clustering performance using different scores when ground truth labels are present.
@@ -225,7 +231,10 @@ class Clustering:
         """
         model = AgglomerativeClustering(n_clusters=n_clusters, distance_threshold=distance_threshold, linkage=linkage,
                                         affinity=affinity, compute_full_tree=compute_full_tree)
-        d = pairwise_distances(self.features, self.features, metric=self.custom_dist)
+        if affinity == 'precomputed' and self.distances is not None:
+            d = self.distances.D
+        else:
+            d = pairwise_distances(self.features, self.features, metric=self.custom_dist)
         model.fit(d)
         # model.fit(self.features)
 
@@ -264,7 +273,7 @@ class Clustering:
 
     # def cluster(self, dirname, fs, species=None, feature='we', n_mels=24, minlen=0.2, denoise=False, alg='agglomerative'):
     def cluster(self, dirname, fs, species=None, feature='we', n_mels=24, minlen=0.2, denoise=False,
-                    alg='agglomerative'):
+                    alg='agglomerative', nprocs=1, featurestore=None):
         """
         Cluster segments during training to make sub-filters.
         Given wav + annotation files,
@@ -279,11 +288,14 @@ class Clustering:
         :param minlen: min syllable length in secs
         :param denoise: True/False
         :param alg: algorithm to use, default to agglomerative
+        :param nprocs: number of processes to compute the syllable distances (0 = all cores)
+        :param featurestore: optional FeatureStore, to reuse syllables and features from previous runs
         :return: clustered segments - a list of lists [[file1, seg1, [syl1, syl2], [features1, features2], predict], ...]
                  fs, nclasses, syllable duration (median)
         """
 
         self.alg = alg
+        self.featureStore = featurestore
         nlevels = 6
         weInds = []
 
@@ -320,6 +332,16 @@ class Clustering:
         # 4. Read the syllables and generate features, also zero padding short syllables
         features = []
         for record in dataset:
+            if self.featureStore is not None:
+                key = self.featureStore.key(record[0], record[2][0], record[2][1], fs, feature,
+                                            {"duration": duration, "f1": f1, "f2": f2, "denoise": denoise,
+                                             "n_mels": n_mels, "nlevels": nlevels, "weInds": weInds})
+                entry = self.featureStore.get(key)
+                if entry is not None:
+                    f = entry["f"].tolist() if feature == 'mfcc' else entry["f"]
+                    features.append(f)
+                    record.insert(3, f)
+                    continue
             audiodata = self.loadFile(filename=record[0], duration=record[2][1] - record[2][0], offset=record[2][0], fs=fs, denoise=denoise, f1=f1, f2=f2, silent=True)
             audiodata = audiodata.tolist()
             if record[2][1] - record[2][0] < duration:
@@ -355,11 +377,19 @@ class Clustering:
                 chroma = scale(chroma, axis=1)
                 features.append(chroma)
                 record.insert(3, chroma)
+            if self.featureStore is not None:
+                self.featureStore.put(key, f=np.asarray(record[3]))
 
         # 5. Actual clustering
         # features = TSNE().fit_transform(features)
         self.features = features
 
+        # DTW distances between all syllables, kept in the feature store (if any) for reuse
+        settings = {"species": species, "feature": feature, "n_mels": n_mels, "fs": fs, "f1": f1, "f2": f2,
+                    "minlen": minlen, "denoise": denoise, "duration": duration}
+        self.distances = SyllableDistances(features, ids=[(rec[0], rec[2][0], rec[2][1]) for rec in dataset],
+                                           dist_method='dtw', settings=settings, store=self.featureStore, nprocs=nprocs)
+
         model = self.trainModel()
         predicted_labels = model.labels_
         print(predicted_labels)
@@ -550,6 +580,13 @@ class Clustering:
         """ Find syllables in the segment using median clipping - single segment
         :return: syllables list
         """
+        if self.featureStore is not None:
+            key = self.featureStore.key(file, seg[0], seg[1], fs, 'syllables',
+                                        {"flow": seg[2], "fhigh": seg[3], "denoise": denoise, "minlen": minlen})
+            entry = self.featureStore.get(key)
+            if entry is not None:
+                return entry["syls"].tolist()
+
         # TODO: Use f1 and f2 to restrict spectrogram in median clipping to skip some of the noise
         # audiodata = self.loadFile(filename=file, duration=seg[1] - seg[0], offset=seg[0], fs=fs, denoise=denoise, f1=f1, f2=f2)
         audiodata = self.loadFile(filename=file, duration=seg[1] - seg[0], offset=seg[0], fs=fs, denoise=denoise)
@@ -589,6 +626,8 @@ class Clustering:
         if len(syls) == 1 and syls[0][1] - syls[0][0] < minlen:  # Sanity check
             syls = [[start, seg[1]]]
 
+        if self.featureStore is not None:
+            self.featureStore.put(key, syls=np.asarray(syls, dtype=float))
         return syls
 
     def trainModel(self):
@@ -705,12 +744,13 @@ class Clustering:
         return audiodata
 
     def cluster_by_dist(self, dir, species, feature='we', n_mels=24, fs=0, minlen=0.2, f_1=0, f_2=0, denoise=False, single=False,
-                        distance='dtw', max_clusters=10):
+                        distance='dtw', max_clusters=10, nprocs=1, featurestore=None):
         """
         Given wav + annotation files,
             1) identify syllables using median clipping/ FIR
             2) generate features WE/MFCC/chroma
-            3) calculate DTW distances and decide class/ generate new class
+            3) calculate DTW distances between all syllables (stored in dir for reuse)
+            4) decide class/ generate new class
         :param dir: directory of audio and annotations
         :param feature: 'WE' or 'MFCC' or 'chroma'
         :param n_mels: number of mel coefs for MFCC
@@ -721,11 +761,13 @@ class Clustering:
         :param denoise: wavelet denoise
         :param single: True means when there are multiple syllables in a segment, add only one syllable to the cluster info
         :param distance: 'dtw' or 'xcor'
+        :param nprocs: number of processes to compute the syllable distances (0 = all cores)
+        :param featurestore: optional FeatureStore, to reuse syllables and features from previous runs
         :return: possible clusters
         """
+        self.featureStore = featurestore
         import Segment
         import SignalProc
-        from scipy import signal
 
         # Get flow and fhigh for bandpass from annotations
         lowlist = []
@@ -786,10 +828,10 @@ class Clustering:
             ind_flow = (np.abs(linear - f_1)).argmin()
             ind_fhigh = (np.abs(linear - f_2)).argmin()
 
-        # Ready for clustering
-        max_clusters = max_clusters
-        n_clusters = 0
-        clusters = []
+        # Find the syllables of all segments and their features first
+        segrecs = []    # [file, seg, syls, features, syllable indices]
+        allfeatures = []
+        allids = []
         for root, dirs, files in os.walk(str(dir)):
             for file in files:
                 if file.lower().endswith('.wav') and file + '.data' in files:
@@ -812,173 +854,196 @@ class Clustering:
                     for seg in sortedsegments:
                         if seg[0] == -1:
                             continue
-                        audiodata = self.loadFile(filename=os.path.join(root, file), duration=seg[1] - seg[0],
-                                                      offset=seg[0], fs=fs, denoise=denoise, f1=f_1, f2=f_2)
-                        start = int(seg[0] * fs)
-                        sp = SignalProc.SignalProc(256, 128)
-                        sp.data = audiodata
-                        sp.sampleRate = fs
-                        sgRaw = sp.spectrogram(256, 128)
-                        segment = Segment.Segmenter(sp=sp, fs=fs)
-                        syls = segment.medianClip(thr=3, medfiltersize=5, minaxislength=9, minSegment=50)
-                        if len(syls) == 0:  # Try again with FIR
-                            syls = segment.segmentByFIR(threshold=0.05)
-                        syls = segment.checkSegmentOverlap(syls)  # merge overlapped segments
-                        syls = [[int(s[0] * fs), int(s[1] * fs)] for s in syls]
-
-                        if len(syls) == 0:  # Sanity check, when annotating syllables tight,
-                            syls = [[0, int((seg[1] - seg[0]) * fs)]]  # median clipping doesn't detect it.
-                        if len(syls) > 1:
-                            # TODO: samples to seconds
-                            syls = segment.joinGaps(syls, minlen_samples)  # Merge short segments
-                        if len(syls) == 1 and syls[0][1] - syls[0][0] < minlen_samples:  # Sanity check
-                            syls = [[0, int((seg[1] - seg[0]) * fs)]]
-                        temp = [[np.round((x[0] + start) / fs, 2), np.round((x[1] + start) / fs, 2)] for x in syls]
-                        print('\nCurrent:', seg, '--> syllables >', minlen, 'secs ', temp)
-
-                        # Calculate features of the syllables in the current segment.
-                        f = []
-                        for s in syls:
-                            data = audiodata[s[0]:s[1]]
-                            if feature == 'mfcc':  # MFCC
-                                mfcc = librosa.feature.mfcc(y=data, sr=fs, n_mfcc=n_mels)
-                                if f_1 != 0 and f_2 != 0:
-                                    mfcc = mfcc[ind_flow:ind_fhigh, :]  # Limit the frequency to the fixed range [f_1, f_2]
-                                mfcc_delta = librosa.feature.delta(mfcc, mode='nearest')
-                                mfcc = np.concatenate((mfcc, mfcc_delta), axis=0)
-                                mfcc = scale(mfcc, axis=1)
-                                # librosa.display.specshow(mfcc, sr=fs, x_axis='time')
-                                # m = [i for sublist in mfcc for i in sublist]
-                                f.append(mfcc)
-
-                            elif feature == 'we':  # Wavelet Energy
-                                ws = WaveletSegment.WaveletSegment(spInfo={})
-                                we = ws.computeWaveletEnergy(data=data, sampleRate=fs, nlevels=5, wpmode='new')
-                                we = we.mean(axis=1)
-                                if f_1 != 0 and f_2 != 0:
-                                    we = we[ind_flow:ind_fhigh]  # Limit the frequency to a fixed range f_1, f_2
-                                f.append(we)
-                            elif feature == 'chroma':
-                                chroma = librosa.feature.chroma_cqt(y=data, sr=fs)
-                                # chroma = librosa.feature.chroma_stft(y=data, sr=fs)
-                                chroma = scale(chroma, axis=1)
-                                f.append(chroma)
-
-                        matched = False
-                        if n_clusters == 0:
-                            print('**Case 1: First class')
-                            newclass = self.class_create(label=n_clusters, syl=syls, features=f, f_low=seg[2],
-                                                         f_high=seg[3], segs=[(os.path.join(root, file), seg)],
-                                                         single=single, dist_method=distance)
-                            clusters.append(newclass)
-                            n_clusters += 1
-                            print('Created new class: Class ', "'", newclass["label"], "'", ',\tIn-class_d: ',
-                                  newclass["d"], '\tf_low: ', newclass["f_low"], '\tf_high: ', newclass["f_high"])
+                        filename = os.path.join(root, file)
+                        # Syllables and their features may be stored from a previous run with the same settings
+                        entry = None
+                        if self.featureStore is not None:
+                            key = self.featureStore.key(filename, seg[0], seg[1], fs, feature,
+                                                        {"flow": seg[2], "fhigh": seg[3], "f1": f_1, "f2": f_2,
+                                                         "denoise": denoise, "minlen": minlen, "n_mels": n_mels})
+                            entry = self.featureStore.get(key)
+                        if entry is not None:
+                            syls = entry["syls"].tolist()
+                            f = [entry["feat" + str(i)] for i in range(len(syls))]
+                        else:
+                            audiodata = self.loadFile(filename=filename, duration=seg[1] - seg[0],
+                                                          offset=seg[0], fs=fs, denoise=denoise, f1=f_1, f2=f_2)
+                            start = int(seg[0] * fs)
+                            sp = SignalProc.SignalProc(256, 128)
+                            sp.data = audiodata
+                            sp.sampleRate = fs
+                            sgRaw = sp.spectrogram(256, 128)
+                            segment = Segment.Segmenter(sp=sp, fs=fs)
+                            syls = segment.medianClip(thr=3, medfiltersize=5, minaxislength=9, minSegment=50)
+                            if len(syls) == 0:  # Try again with FIR
+                                syls = segment.segmentByFIR(threshold=0.05)
+                            syls = segment.checkSegmentOverlap(syls)  # merge overlapped segments
+                            syls = [[int(s[0] * fs), int(s[1] * fs)] for s in syls]
+
+                            if len(syls) == 0:  # Sanity check, when annotating syllables tight,
+                                syls = [[0, int((seg[1] - seg[0]) * fs)]]  # median clipping doesn't detect it.
+                            if len(syls) > 1:
+                                # TODO: samples to seconds
+                                syls = segment.joinGaps(syls, minlen_samples)  # Merge short segments
+                            if len(syls) == 1 and syls[0][1] - syls[0][0] < minlen_samples:  # Sanity check
+                                syls = [[0, int((seg[1] - seg[0]) * fs)]]
+                            temp = [[np.round((x[0] + start) / fs, 2), np.round((x[1] + start) / fs, 2)] for x in syls]
+                            print('\nCurrent:', seg, '--> syllables >', minlen, 'secs ', temp)
+
+                            # Calculate features of the syllables in the current segment.
+                            f = []
+                            for s in syls:
+                                data = audiodata[s[0]:s[1]]
+                                if feature == 'mfcc':  # MFCC
+                                    mfcc = librosa.feature.mfcc(y=data, sr=fs, n_mfcc=n_mels)
+                                    if f_1 != 0 and f_2 != 0:
+                                        mfcc = mfcc[ind_flow:ind_fhigh, :]  # Limit the frequency to the fixed range [f_1, f_2]
+                                    mfcc_delta = librosa.feature.delta(mfcc, mode='nearest')
+                                    mfcc = np.concatenate((mfcc, mfcc_delta), axis=0)
+                                    mfcc = scale(mfcc, axis=1)
+                                    # librosa.display.specshow(mfcc, sr=fs, x_axis='time')
+                                    # m = [i for sublist in mfcc for i in sublist]
+                                    f.append(mfcc)
+
+                                elif feature == 'we':  # Wavelet Energy
+                                    ws = WaveletSegment.WaveletSegment(spInfo={})
+                                    we = ws.computeWaveletEnergy(data=data, sampleRate=fs, nlevels=5, wpmode='new')
+                                    we = we.mean(axis=1)
+                                    if f_1 != 0 and f_2 != 0:
+                                        we = we[ind_flow:ind_fhigh]  # Limit the frequency to a fixed range f_1, f_2
+                                    f.append(we)
+                                elif feature == 'chroma':
+                                    chroma = librosa.feature.chroma_cqt(y=data, sr=fs)
+                                    # chroma = librosa.feature.chroma_stft(y=data, sr=fs)
+                                    chroma = scale(chroma, axis=1)
+                                    f.append(chroma)
+
+                            if self.featureStore is not None:
+                                feats = {"feat" + str(i): f[i] for i in range(len(f))}
+                                self.featureStore.put(key, syls=np.asarray(syls, dtype=int), **feats)
+
+                        inds = list(range(len(allfeatures), len(allfeatures) + len(f)))
+                        allfeatures.extend(f)
+                        allids.extend([(filename, seg[0] + s[0] / fs, seg[0] + s[1] / fs) for s in syls])
+                        segrecs.append([filename, seg, syls, f, inds])
+
+        # Distances between all syllables, computed once (or read from the feature store)
+        settings = {"species": species, "feature": feature, "n_mels": n_mels, "fs": fs, "f1": f_1, "f2": f_2,
+                    "minlen": minlen, "denoise": denoise}
+        dists = SyllableDistances(allfeatures, ids=allids, dist_method=distance, settings=settings,
+                                  store=self.featureStore, nprocs=nprocs)
+
+        # Ready for clustering
+        max_clusters = max_clusters
+        n_clusters = 0
+        clusters = []
+        for filename, seg, syls, f, inds in segrecs:
+            matched = False
+            if n_clusters == 0:
+                print('**Case 1: First class')
+                newclass = self.class_create(label=n_clusters, syl=syls, features=f, f_low=seg[2],
+                                             f_high=seg[3], segs=[(filename, seg)],
+                                             single=single, dist_method=distance,
+                                             inds=inds, dists=dists)
+                clusters.append(newclass)
+                n_clusters += 1
+                print('Created new class: Class ', "'", newclass["label"], "'", ',\tIn-class_d: ',
+                      newclass["d"], '\tf_low: ', newclass["f_low"], '\tf_high: ', newclass["f_high"])
+                matched = True
+            if not matched:
+                # See if the syllables in the current seg match with any existing class
+                min_ds = []  # Keep track of the minimum distances to each class
+                for c in range(len(clusters)):
+                    dist_c = dists.sub(clusters[c]["inds"], inds)  # distances to the current class c
+
+                    # Min distance to the current class
+                    print('Distance to Class ', clusters[c]["label"], ': ', np.amin(dist_c[dist_c != 0]),
+                          '( In-class distance: ', clusters[c]["d"], ')')
+                    min_ds.append(np.amin(dist_c[dist_c != 0]))
+
+                # Now get the clusters sorted according to the min dist
+                ind = np.argsort(min_ds, kind='stable')
+                min_ds = np.sort(min_ds)
+                # make the cluster order
+                clusters = [clusters[i] for i in ind]
+                for c in range(len(clusters)):
+                    if (clusters[c]["d"] != 0) and min_ds[c] < (clusters[c]["d"] + clusters[c]["d"] * 0.1):
+                        print('**Case 2: Found a match with a class > one syllable')
+                        print('Class ', clusters[c]["label"], ', dist ', min_ds[c])
+                        # Update this class
+                        clusters[c] = self.class_update(cluster=clusters[c], newfeatures=f, newf_low=seg[2],
+                                                   newf_high=seg[3], newsyl=syls,
+                                                   newseg=(filename, seg), single=single,
+                                                   dist_method=distance, newinds=inds, dists=dists)
+                        matched = True
+                        break  # found a match, exit from the for loop, go to the next segment
+
+                    elif c < len(clusters) - 1:
+                        continue  # continue to the next class
+
+            # Checked most of the classes by now, if still no match found, check the classes with only one
+            # data point (clusters[c]["d"] == 0).
+            # Note the arbitrary thr.
+            if not matched:
+                if distance == 'dtw':
+                    thr = 25
+                elif distance == 'xcor':
+                    thr = 1000
+                for c in range(len(clusters)):
+                    if clusters[c]["d"] == 0 and min_ds[c] < thr:
+                        print('**Case 3: In-class dist of ', clusters[c]["label"], '=', clusters[c]["d"],
+                              'and this example < ', thr, ' dist')
+                        print('Class ', clusters[c]["label"], ', dist ', min_ds[c])
+                        # Update this class
+                        clusters[c] = self.class_update(cluster=clusters[c], newfeatures=f, newf_low=seg[2],
+                                                   newf_high=seg[3], newsyl=syls,
+                                                   newseg=(filename, seg), single=single,
+                                                   dist_method=distance, newinds=inds, dists=dists)
+                        matched = True
+                        break  # Break the search and go to the next segment
+
+            # If no match found yet, check the max clusters
+            if not matched:
+                if n_clusters == max_clusters:
+                    print('**Case 4: Reached max classes, therefore adding current seg to the closest '
+                          'class... ')
+                    # min_ind = np.argmin(min_ds)
+                    # classes are sorted in ascending order of distance already
+                    for c in range(len(clusters)):
+                        if min_ds[c] <= 4 * clusters[c]["d"] or clusters[c]["d"] == 0:
+                            print('Class ', clusters[c]["label"], ', dist ', min_ds[c],
+                                  '(in-class distance:', clusters[c]["d"], ')')
+                            # Update this class
+                            clusters[c] = self.class_update(cluster=clusters[c], newfeatures=f, newf_low=seg[2],
+                                                       newf_high=seg[3], newsyl=syls,
+                                                       newseg=(filename, seg),
+                                                       single=single,
+                                                       dist_method=distance, newinds=inds, dists=dists)
                             matched = True
-                        if not matched:
-                            # See if the syllables in the current seg match with any existing class
-                            min_ds = []  # Keep track of the minimum distances to each class
-                            clusters = random.sample(clusters, len(clusters))  # Shuffle the clusters to avoid bias
-                            for c in range(len(clusters)):
-                                f_c = clusters[c]["features"]  # features of the current class c
-                                dist_c = np.zeros((len(f_c), len(f)))  # distances to the current class c
-                                for i in range(len(f_c)):
-                                    for j in range(len(f)):
-                                        if distance == 'dtw':
-                                            d, _ = librosa.sequence.dtw(f_c[i], f[j], metric='euclidean')
-                                            dist_c[i, j] = d[d.shape[0] - 1][d.shape[1] - 1]
-                                        elif distance == 'xcor':
-                                            corr = signal.correlate(f_c[i], f[j], mode='full')
-                                            dist_c[i, j] = np.sum(corr) / max(len(f_c[i]), len(f[j]))
-
-                                # Min distance to the current class
-                                print('Distance to Class ', clusters[c]["label"], ': ', np.amin(dist_c[dist_c != 0]),
-                                      '( In-class distance: ', clusters[c]["d"], ')')
-                                min_ds.append(np.amin(dist_c[dist_c != 0]))
-
-                            # Now get the clusters sorted according to the min dist
-                            ind = np.argsort(min_ds)
-                            min_ds = np.sort(min_ds)
-                            # make the cluster order
-                            clusters = [clusters[i] for i in ind]
-                            for c in range(len(clusters)):
-                                if (clusters[c]["d"] != 0) and min_ds[c] < (clusters[c]["d"] + clusters[c]["d"] * 0.1):
-                                    print('**Case 2: Found a match with a class > one syllable')
-                                    print('Class ', clusters[c]["label"], ', dist ', min_ds[c])
-                                    # Update this class
-                                    clusters[c] = self.class_update(cluster=clusters[c], newfeatures=f, newf_low=seg[2],
-                                                               newf_high=seg[3], newsyl=syls,
-                                                               newseg=(os.path.join(root, file), seg), single=single,
-                                                               dist_method=distance)
-                                    matched = True
-                                    break  # found a match, exit from the for loop, go to the next segment
-
-                                elif c < len(clusters) - 1:
-                                    continue  # continue to the next class
-
-                        # Checked most of the classes by now, if still no match found, check the classes with only one
-                        # data point (clusters[c]["d"] == 0).
-                        # Note the arbitrary thr.
-                        if not matched:
-                            if distance == 'dtw':
-                                thr = 25
-                            elif distance == 'xcor':
-                                thr = 1000
-                            for c in range(len(clusters)):
-                                if clusters[c]["d"] == 0 and min_ds[c] < thr:
-                                    print('**Case 3: In-class dist of ', clusters[c]["label"], '=', clusters[c]["d"],
-                                          'and this example < ', thr, ' dist')
-                                    print('Class ', clusters[c]["label"], ', dist ', min_ds[c])
-                                    # Update this class
-                                    clusters[c] = self.class_update(cluster=clusters[c], newfeatures=f, newf_low=seg[2],
-                                                               newf_high=seg[3], newsyl=syls,
-                                                               newseg=(os.path.join(root, file), seg), single=single,
-                                                               dist_method=distance)
-                                    matched = True
-                                    break  # Break the search and go to the next segment
-
-                        # If no match found yet, check the max clusters
-                        if not matched:
-                            if n_clusters == max_clusters:
-                                print('**Case 4: Reached max classes, therefore adding current seg to the closest '
-                                      'class... ')
-                                # min_ind = np.argmin(min_ds)
-                                # classes are sorted in ascending order of distance already
-                                for c in range(len(clusters)):
-                                    if min_ds[c] <= 4 * clusters[c]["d"] or clusters[c]["d"] == 0:
-                                        print('Class ', clusters[c]["label"], ', dist ', min_ds[c],
-                                              '(in-class distance:', clusters[c]["d"], ')')
-                                        # Update this class
-                                        clusters[c] = self.class_update(cluster=clusters[c], newfeatures=f, newf_low=seg[2],
-                                                                   newf_high=seg[3], newsyl=syls,
-                                                                   newseg=(os.path.join(root, file), seg),
-                                                                   single=single,
-                                                                   dist_method=distance)
-                                        matched = True
-                                        break
-                                if not matched:
-                                    print('Class ', clusters[0]["label"], ', dist ', min_ds[0],
-                                          '(in-class distance:', clusters[0]["d"], ')')
-                                    # Update this class
-                                    # TODO: don't update the class as it is an outlier?
-                                    clusters[0] = self.class_update(cluster=clusters[0], newfeatures=f, newf_low=seg[2],
-                                                               newf_high=seg[3], newsyl=syls,
-                                                               newseg=(os.path.join(root, file), seg), single=single,
-                                                               dist_method=distance)
-                                    matched = True
-                                continue  # Continue to next segment
-
-                        #  If still no luck, create a new class
-                        if not matched:
-                            print('**Case 5: None of Case 1-4')
-                            newclass = self.class_create(label=n_clusters, syl=syls, features=f, f_low=seg[2], f_high=seg[3],
-                                                    segs=[(os.path.join(root, file), seg)], single=single,
-                                                    dist_method=distance)
-                            print('Created a new class: Class ', n_clusters + 1)
-                            clusters.append(newclass)
-                            n_clusters += 1
-                            print('Created new class: Class ', "'", newclass["label"], "'", ',\tin-class_d: ',
-                                  newclass["d"], '\tf_low: ', newclass["f_low"], '\tf_high: ', newclass["f_high"])
+                            break
+                    if not matched:
+                        print('Class ', clusters[0]["label"], ', dist ', min_ds[0],
+                              '(in-class distance:', clusters[0]["d"], ')')
+                        # Update this class
+                        # TODO: don't update the class as it is an outlier?
+                        clusters[0] = self.class_update(cluster=clusters[0], newfeatures=f, newf_low=seg[2],
+                                                   newf_high=seg[3], newsyl=syls,
+                                                   newseg=(filename, seg), single=single,
+                                                   dist_method=distance, newinds=inds, dists=dists)
+                        matched = True
+                    continue  # Continue to next segment
+
+            #  If still no luck, create a new class
+            if not matched:
+                print('**Case 5: None of Case 1-4')
+                newclass = self.class_create(label=n_clusters, syl=syls, features=f, f_low=seg[2], f_high=seg[3],
+                                        segs=[(filename, seg)], single=single,
+                                        dist_method=distance, inds=inds, dists=dists)
+                print('Created a new class: Class ', n_clusters + 1)
+                clusters.append(newclass)
+                n_clusters += 1
+                print('Created new class: Class ', "'", newclass["label"], "'", ',\tin-class_d: ',
+                      newclass["d"], '\tf_low: ', newclass["f_low"], '\tf_high: ', newclass["f_high"])
 
         print('\n\n--------------Clusters created-------------------')
         clustered_segs = []
@@ -999,7 +1064,7 @@ class Clustering:
         return clustered_segs, fs, n_clusters, 1
         # return clustered_dataset, fs, nclasses, duration
 
-    def class_create(self, label, syl, features, f_low, f_high, segs, single=False, dist_method='dtw'):
+    def class_create(self, label, syl, features, f_low, f_high, segs, single=False, dist_method='dtw', inds=None, dists=None):
         """ Create a new class
         :param label: label of the new class
         :param syl: syllables
@@ -1008,42 +1073,29 @@ class Clustering:
         :param f_high:
         :param segs:
         :param single: True if only one syllable from the segment goes to the class templates
+        :param inds: indices of the syllables in dists, a SyllableDistances (if None, distances are computed here)
         :return:
         """
-        from scipy import signal
-        dist = np.zeros((len(features), len(features)))
-        shift = 0
-        for i in range(len(features)):
-            shift += 1
-            for j in range(shift, len(features)):
-                if dist_method == 'dtw':
-                    d, _ = librosa.sequence.dtw(features[i], features[j], metric='euclidean')
-                    dist[i, j] = d[d.shape[0] - 1][d.shape[1] - 1]
-                elif dist_method == 'xcor':
-                    corr = signal.correlate(features[i], features[j], mode='full')
-                    dist[i, j] = np.sum(corr) / max(len(features[i]), len(features[j]))
-
-        if np.count_nonzero(dist) > 0:
-            nonzero = dist > 0
-            inclass_d = np.percentile(dist[nonzero], 10)  # TODO: max? mean? a percentile?
-        else:
-            inclass_d = 0
+        inclass_d = self.inclassDist(features, dist_method, inds, dists)
 
         if single:
             features = [features[len(features) // 2]]  # get the features of the middle syllable
+            if inds is not None:
+                inds = [inds[len(inds) // 2]]
 
         newclass = {
             "label": label,
             "d": inclass_d,
             "syl": syl,
             "features": features,
+            "inds": inds,
             "f_low": f_low,
             "f_high": f_high,
             "segs": segs
         }
         return newclass
 
-    def class_update(self, cluster, newfeatures, newf_low, newf_high, newsyl, newseg, single, dist_method='dtw'):
+    def class_update(self, cluster, newfeatures, newf_low, newf_high, newsyl, newseg, single, dist_method='dtw', newinds=None, dists=None):
         """ Update an existing class
         :param cluster: the class to update
         :param newfeatures:
@@ -1051,42 +1103,27 @@ class Clustering:
         :param newf_high:
         :param newsyl:
         :param newsegs:
+        :param newinds: indices of the new syllables in dists, a SyllableDistances (if None, distances are computed here)
         :return: the updated cluster
         """
-        from scipy import signal
-
-        # Get in-class distance
-        f_c = cluster["features"]  # features of the current class c
-
         if single:
             newfeatures = [newfeatures[len(newfeatures) // 2]]
             newsyl = [newsyl[len(newsyl) // 2]]
+            if newinds is not None:
+                newinds = [newinds[len(newinds) // 2]]
 
-        for i in range(len(newfeatures)):
-            f_c.append(newfeatures[i])
-
-        dist_c = np.zeros((len(f_c), len(f_c)))  # distances to the current class c
-        shift = 0
-        for i in range(len(f_c)):
-            shift += 1
-            for j in range(shift, len(f_c)):
-                if dist_method == 'dtw':
-                    d, _ = librosa.sequence.dtw(f_c[i], f_c[j], metric='euclidean')
-                    dist_c[i, j] = d[d.shape[0] - 1][d.shape[1] - 1]
-                elif dist_method == 'xcor':
-                    corr = signal.correlate(f_c[i], f_c[j], mode='full')
-                    dist_c[i, j] = np.sum(corr) / max(len(f_c[i]), len(f_c[j]))
-
-        if np.count_nonzero(dist_c) > 0:
-            nonzero = dist_c > 0
-            inclass_d = np.percentile(dist_c[nonzero], 10)  # TODO: max? mean? a percentile?
+        # Get in-class distance
+        f_c = cluster["features"] + newfeatures  # features of the current class c
+        if newinds is not None:
+            inds_c = cluster["inds"] + newinds
         else:
-            inclass_d = 0
+            inds_c = None
+        inclass_d = self.inclassDist(f_c, dist_method, inds_c, dists)
 
         for s in newsyl:
             cluster["syl"].append(s)
-        for fe in newfeatures:
-            cluster["features"].append(fe)
+        cluster["features"] = f_c
+        cluster["inds"] = inds_c
         cluster["d"] = inclass_d
         cluster["f_low"] = (newf_low + cluster["f_low"]) / 2  # not sure if this is correct
         cluster["f_high"] = (newf_high + cluster["f_high"]) / 2
@@ -1095,3 +1132,231 @@ class Clustering:
               cluster["d"], '\tf_low: ', cluster["f_low"], '\tf_high: ',
               cluster["f_high"])
         return cluster
+
+    def inclassDist(self, features, dist_method='dtw', inds=None, dists=None):
+        """ In-class distance: 10th percentile of the non-zero distances between the class members.
+            Looked up in dists (a SyllableDistances) when the syllable indices are given.
+        """
+        if inds is not None and dists is not None:
+            dist = np.triu(dists.sub(inds, inds), k=1)
+        else:
+            dist = np.zeros((len(features), len(features)))
+            for i in range(len(features)):
+                for j in range(i + 1, len(features)):
+                    dist[i, j] = pairDistance(features[i], features[j], dist_method)
+
+        if np.count_nonzero(dist) > 0:
+            nonzero = dist > 0
+            return np.percentile(dist[nonzero], 10)  # TODO: max? mean? a percentile?
+        else:
+            return 0
+
+
+def pairDistance(x, y, dist_method='dtw', maxcost=np.inf):
+    """ Distance between the features of two syllables.
+        dist_method - 'dtw' (Euclidean frame cost, features x frames or 1D) or 'xcor'
+        maxcost - DTW distances above it are returned as np.inf
+    """
+    if dist_method == 'dtw':
+        return ce_dtw.DTW(np.asarray(x).T, np.asarray(y).T, maxcost=maxcost)
+    elif dist_method == 'xcor':
+        from scipy import signal
+        corr = signal.correlate(x, y, mode='full')
+        return np.sum(corr) / max(len(x), len(y))
+    else:
+        raise ValueError("ERROR: unrecognised distance method " + str(dist_method))
+
+
+class SyllableDistances:
+    """ Distances between all pairs of syllables of a dataset, computed once.
+        The distances are symmetric, so only the upper triangle is computed,
+        one row per job, optionally in a pool of nprocs processes (0 = all cores).
+        If a FeatureStore is given, the matrix is kept in it (so it is removed with the least
+        recently used entries), keyed by the feature settings, the syllable ids and the
+        modification times of their files, and read back on the next run with the same
+        settings and unchanged files.
+
+        features: list of syllable features (features x frames, or 1D)
+        ids: list of (file, start, end) identifying the syllables, in the order of features
+        D: the full distance matrix, D[i,j] is the distance between syllables i and j
+    """
+
+    def __init__(self, features, ids=None, dist_method='dtw', settings=None, store=None, nprocs=1):
+        if ids is None:
+            ids = range(len(features))
+        self.ids = [tuple(i) if isinstance(i, (list, tuple)) else i for i in ids]
+        self.idindex = {self.ids[i]: i for i in range(len(self.ids))}
+        self.dist_method = dist_method
+        self.D = None
+
+        key = None
+        if store is not None:
+            key = self.key(settings)
+            entry = store.get(key)
+            if entry is not None and "D" in entry and entry["D"].shape == (len(features), len(features)):
+                self.D = entry["D"]
+                print("Read stored syllable distances")
+
+        if self.D is None:
+            self.D = self.compute(features, nprocs)
+            if store is not None:
+                store.put(key, D=self.D)
+
+    def key(self, settings):
+        """ Hash of the feature settings, distance method, syllables and the modification times of their files """
+        files = sorted(set([i[0] for i in self.ids if isinstance(i, tuple)]))
+        mtimes = []
+        for filename in files:
+            try:
+                mtimes.append([os.path.abspath(filename), os.path.getmtime(filename)])
+            except OSError:
+                mtimes.append([os.path.abspath(filename), None])
+        s = json.dumps([settings, self.dist_method, self.ids, mtimes], sort_keys=True, default=str)
+        return "syllableDistances_" + hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def compute(self, features, nprocs=1):
+        n = len(features)
+        D = np.zeros((n, n))
+        if n < 2:
+            return D
+        if nprocs == 0:
+            nprocs = os.cpu_count()
+        nprocs = min(nprocs, n - 1)
+        print("Computing %d syllable distances using %d processes" % (n * (n - 1) // 2, nprocs))
+
+        if nprocs > 1:
+            import multiprocessing
+            # spawn, not fork: Qt does not survive forking
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(processes=nprocs, initializer=_initDistWorker, initargs=(features, self.dist_method)) as pool:
+                for i, row in pool.imap_unordered(_runDistWorker, range(n - 1)):
+                    D[i, i+1:] = row
+        else:
+            for i in range(n - 1):
+                D[i, i+1:] = distanceRow(features, i, self.dist_method)
+        D += D.T
+        return D
+
+    def index(self, id):
+        """ Index of the syllable with this id """
+        return self.idindex[tuple(id) if isinstance(id, (list, tuple)) else id]
+
+    def sub(self, rows, cols):
+        """ Distances between syllables rows and syllables cols (lists of indices) """
+        return self.D[np.ix_(rows, cols)]
+
+    def sortByTypicality(self, groups):
+        """ Order groups of syllables (e.g. the segments of one cluster, as lists of syllable indices)
+            by their mean distance to the syllables of the other groups, most typical first.
+            Returns the order as indices into groups.
+        """
+        if len(groups) < 2:
+            return list(range(len(groups)))
+        allinds = [i for g in groups for i in g]
+        meands = []
+        for g in groups:
+            others = [i for i in allinds if i not in g]
+            if len(g) == 0 or len(others) == 0:
+                meands.append(np.inf)
+            else:
+                meands.append(np.mean(self.sub(g, others)))
+        return list(np.argsort(meands, kind='stable'))
+
+
+def distanceRow(features, i, dist_method):
+    """ Distances from syllable i to the syllables after it """
+    return [pairDistance(features[i], features[j], dist_method) for j in range(i+1, len(features))]
+
+
+# Each process of the distance pool keeps its own copy of the features,
+# so that only the row numbers are sent to it.
+_distFeatures = None
+_distMethod = None
+
+def _initDistWorker(features, dist_method):
+    global _distFeatures, _distMethod
+    _distFeatures = features
+    _distMethod = dist_method
+
+def _runDistWorker(i):
+    return i, distanceRow(_distFeatures, i, _distMethod)
+
+
+class FeatureStore:
+    """ On-disk store of syllables and their features, so that clustering can be rerun
+        (e.g. with other parameters in the training wizard) without reading the audio again.
+        Entries are .npz files keyed by the audio file path and modification time,
+        the segment bounds, the sampling rate, the feature type and its parameters.
+        When the store grows over maxsize bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, cachedir, maxsize=500*1024*1024):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.size = sum([e[1] for e in self.entries()])
+
+    def entries(self):
+        """ List of (last use time, size, path) of the stored entries """
+        entries = []
+        for f in os.listdir(self.cachedir):
+            if f.endswith('.npz'):
+                path = os.path.join(self.cachedir, f)
+                try:
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, st.st_size, path))
+                except OSError:
+                    pass
+        return entries
+
+    def key(self, filename, start, end, fs, kind, params=None):
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+        s = json.dumps([os.path.abspath(filename), mtime, start, end, fs, kind, params], sort_keys=True, default=str)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ Returns a dict of the arrays stored under key, or None """
+        path = os.path.join(self.cachedir, key + ".npz")
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                entry = {k: f[k] for k in f.files}
+            # mark as recently used
+            os.utime(path)
+        except Exception as e:
+            print("Warning: could not read stored features:", e)
+            return None
+        return entry
+
+    def put(self, key, **arrays):
+        path = os.path.join(self.cachedir, key + ".npz")
+        tmppath = path + ".tmp"
+        try:
+            # write to a temporary file first, so that a partial entry is never read
+            with open(tmppath, 'wb') as f:
+                np.savez(f, **arrays)
+            self.size += os.path.getsize(tmppath)
+            os.replace(tmppath, path)
+        except Exception as e:
+            print("Warning: could not store features:", e)
+            return
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the store is under 90 % of maxsize """
+        entries = sorted(self.entries())
+        self.size = sum([e[1] for e in entries])
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.maxsize:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
@@ -214,6 +214,7 @@ class BuildRecAdvWizard(QWizard):
             self.config = config
             self.segsChanged = False
             self.hasCTannotations = True
+            self.cluster = None
 
             self.lblSpecies = QLabel()
             self.lblSpecies.setStyleSheet("QLabel { color : #808080; }")
@@ -288,7 +289,16 @@ class BuildRecAdvWizard(QWizard):
                     # self.nclasses: number of class_labels
                     # duration: median length of segments
                     self.cluster = Clustering.Clustering([], [], 5)
-                    self.segments, self.nclasses, self.duration = self.cluster.cluster(self.field("trainDir"), self.field("fs"), self.field("species"), feature=self.feature)
+                    # syllables and features are kept next to the filters dir, so reclustering skips reading audio
+                    store = None
+                    cachesize = self.config.get("featureCacheMB", 500)
+                    if cachesize > 0:
+                        cachedir = os.path.join(os.path.dirname(os.path.normpath(self.wizard().filtersDir)), "FeatureCache")
+                        try:
+                            store = Clustering.FeatureStore(cachedir, maxsize=cachesize*1024*1024)
+                        except OSError as e:
+                            print("Warning: could not use feature cache", cachedir, e)
+                    self.segments, self.nclasses, self.duration = self.cluster.cluster(self.field("trainDir"), self.field("fs"), self.field("species"), feature=self.feature, nprocs=self.config.get("batchProcesses", 1), featurestore=store)
                     # segments format: [[file1, seg1, [syl1, syl2], [features1, features2], predict], ...]
                     # self.segments, fs, self.nclasses, self.duration = self.cluster.cluster_by_dist(self.field("trainDir"),
                     #                                                                              self.field("species"),
@@ -837,17 +847,30 @@ class BuildRecAdvWizard(QWizard):
                 self.cboxes.append(cbox)
                 self.flowLayout.addWidget(self.cboxes[-1], r, c)
                 c += 1
-                # Find the segments under this class and show them
-                for segix in range(len(self.segments)):
-                    if self.segments[segix][-1] == r:
-                        self.flowLayout.addWidget(self.picbuttons[segix], r, c)
-                        c += 1
-                        self.picbuttons[segix].show()
+                # Find the segments under this class and show them, most typical first
+                segixs = [segix for segix in range(len(self.segments)) if self.segments[segix][-1] == r]
+                for segix in self.orderSegments(segixs):
+                    self.flowLayout.addWidget(self.picbuttons[segix], r, c)
+                    c += 1
+                    self.picbuttons[segix].show()
             self.flowLayout.adjustSize()
             self.flowLayout.update()
             # Apply colour and volume levels
             self.specControls.emitAll()
 
+        def orderSegments(self, segixs):
+            """ Order the segments of one cluster by their mean distance to the other segments in it,
+                looked up in the syllable distances stored by clustering. Outliers go last.
+            """
+            if self.hasCTannotations or self.cluster is None or self.cluster.distances is None:
+                return segixs
+            dists = self.cluster.distances
+            try:
+                groups = [[dists.index((self.segments[ix][0], syl[0], syl[1])) for syl in self.segments[ix][2]] for ix in segixs]
+            except KeyError:
+                return segixs
+            return [segixs[i] for i in dists.sortByTypicality(groups)]
+
         def clearButtons(self):
             """ Remove existing buttons, call when merging clusters
             """
@@ -1266,7 +1289,8 @@ class BuildRecAdvWizard(QWizard):
                     self.nodes, TP, FP, TN, FN = ws.waveletSegment_train(self.field("trainDir"),
                                                                     self.thrList, self.MList,
                                                                     d=False,
-                                                                    learnMode="recaa", window=window, inc=inc)
+                                                                    learnMode="recaa", window=window, inc=inc,
+                                                                    nprocs=self.wizard().clusterPage.config.get("batchProcesses", 1))
                 elif self.method=="chp":
                     # Note: using energies averaged over window size set before
                     numthr = 9
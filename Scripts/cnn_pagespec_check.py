@@ -0,0 +1,84 @@
+# Check of CNN features with spectrogram windows shared over a page ("CNNPageSpec" in config)
+
+# For each bundled CNN (Filters/*.txt with a "CNN" part, except bats), generates the features
+# of segments on a sound file (resampled to the CNN sample rate) with a spectrogram for each segment
+# and with the windows shared over the page (Segment.PostProcess.CNNPageSpec), and checks that
+# they are the same. Segments are on a detector-like time grid, and at random (unaligned) positions,
+# and are processed twice with the shared windows (as for two call types).
+# Run from the main AviaNZ folder:
+# python Scripts/cnn_pagespec_check.py -f "Sound Files/kiwi_1min.wav"
+
+import os
+import sys
+import contextlib
+import copy
+import io
+import numpy as np
+import click
+
+@click.command()
+@click.option('-f', '--file', 'wavfile', type=str, default=os.path.join("Sound Files", "kiwi_1min.wav"), help='Sound file to cut the segments from')
+@click.option('-n', '--nsegs', type=int, default=20, help='Number of random segments (and of grid segments) for each CNN')
+def check(wavfile, nsegs):
+    appdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(appdir)
+    sys.path.insert(0, appdir)
+    import SignalProc
+    import SupportClasses
+    import Segment
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        filters = SupportClasses.ConfigLoader().filters("Filters", bats=False)
+
+    rng = np.random.default_rng(0)
+    failed = []
+    for name, filt in sorted(filters.items()):
+        cnn = filt.get("CNN")
+        if not cnn:
+            continue
+        sp = SignalProc.SignalProc()
+        sp.readWav(wavfile, silent=True)
+        if filt["SampleRate"] > sp.sampleRate:
+            print("%s: skipped (sample rate above the file's)" % name)
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            sp.resample(filt["SampleRate"])
+        data = np.asarray(sp.data, dtype=np.float64)
+        duration = len(data) / sp.sampleRate
+
+        # CNNFeatures does not need the model itself
+        CNNmodel = [None, cnn["win"], cnn["inputdim"], cnn["output"], cnn["windowInc"], cnn["thr"], "fRange" in cnn, cnn.get("fRange")]
+        post = Segment.PostProcess(configdir="Config", audioData=data, sampleRate=sp.sampleRate, tgtsampleRate=filt["SampleRate"], CNNmodel=CNNmodel)
+        specFrameWidth = len(range(0, int(post.CNNwindow * post.tgtsampleRate - post.CNNwindowInc[0]), post.CNNwindowInc[1]))
+
+        # segments on a 0.1 s grid (as from a detector), and anywhere, some shorter than a CNN frame
+        segs = []
+        for i in range(nsegs):
+            start = rng.integers(0, int((duration - 5) * 10)) / 10
+            segs.append([start, start + rng.integers(1, 50) / 10])
+        for i in range(nsegs):
+            start = rng.uniform(0, duration - 5)
+            segs.append([start, start + rng.uniform(0.05, 5)])
+
+        pagesp = post.CNNPageSpec()
+        maxdiff = 0
+        same = True
+        for seg in segs + segs:
+            with contextlib.redirect_stdout(io.StringIO()):
+                f1 = post.CNNFeatures([copy.copy(seg), 0], specFrameWidth)
+                f2 = post.CNNFeatures([copy.copy(seg), 0], specFrameWidth, pagesp)
+            if f1.shape != f2.shape:
+                print("  %s: %d frames with a segment spectrogram, %d with shared windows" % (seg, f1.shape[0], f2.shape[0]))
+                same = False
+            elif f1.size > 0:
+                maxdiff = max(maxdiff, np.max(np.abs(f1 - f2)))
+        same = same and maxdiff <= 1e-5
+        print("%s: %d segments, %d shared windows, max. difference of the features %.2g, %s" % (name, len(segs), len(pagesp.sgframes), maxdiff, "same" if same else "DIFFERENT"))
+        if not same:
+            failed.append(name)
+
+    assert not failed, "features with shared windows differ for: %s" % ", ".join(failed)
+    print("All checked CNNs give the same features with shared spectrogram windows")
+
+if __name__ == "__main__":
+    check()
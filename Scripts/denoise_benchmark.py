@@ -0,0 +1,81 @@
+# Benchmark of wavelet denoising with time-varying noise estimates (WaveletFunctions.waveletDenoise)
+
+# Estimates the noise with the "ols" and "qr" models fitted for all time blocks at once
+# (batchfit=True) or block by block (batchfit=False, default),
+# and reports the times of the noise estimation (WaveletFunctions.blockNoise) and of
+# the full denoising, and the max. differences of the estimates and of the denoised signals.
+# Run from the main AviaNZ folder:
+# python Scripts/denoise_benchmark.py -n 3 -l 60
+
+import os
+import sys
+import contextlib
+import io
+import time
+import numpy as np
+import click
+
+def makeData(sampleRate, duration):
+    """ Returns duration (s) of white noise with gusts of low-frequency "wind" and some tonal calls """
+    rng = np.random.default_rng(0)
+    n = int(sampleRate*duration)
+    data = rng.standard_normal(n) * 100
+    # wind: brown-ish noise with a strength varying every second
+    wind = np.cumsum(rng.standard_normal(n))
+    wind = wind - np.convolve(wind, np.ones(64)/64, mode='same')
+    data += wind * 50 * np.repeat(rng.uniform(0, 1, int(np.ceil(duration))), sampleRate)[:n]
+    # calls: 0.5 s tones every 5 s
+    t = np.arange(sampleRate//2) / sampleRate
+    for start in range(0, n - len(t), 5*sampleRate):
+        data[start:start+len(t)] += 2000 * np.sin(2*np.pi*3000*t)
+    return data
+
+def timeCall(f, nrep):
+    """ Returns the wall times (s) of nrep calls of f, and its last output (f's prints are hidden) """
+    times = []
+    for i in range(nrep):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.time()
+            res = f()
+            times.append(time.time() - start)
+    return times, res
+
+@click.command()
+@click.option('-n', '--nrep', type=int, default=3, help='Number of repetitions of each measurement')
+@click.option('-l', '--length', type=float, default=60, help='Length of the test data (s)')
+@click.option('-f', '--samplerate', type=int, default=16000, help='Sample rate of the test data')
+def benchmark(nrep, length, samplerate):
+    appdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(appdir)
+    sys.path.insert(0, appdir)
+    import WaveletFunctions
+
+    data = makeData(samplerate, length)
+
+    # 1. Noise estimation only, for all 5th level leaves
+    # (block length as in waveletDenoise)
+    WF = WaveletFunctions.WaveletFunctions(data=data, wavelet="dmey2", maxLevel=5, samplerate=samplerate)
+    with contextlib.redirect_stdout(io.StringIO()):
+        WF.WaveletPacket(range(63), 'symmetric', False, antialiasFilter=True)
+    leaves = list(range(31, 63))
+    blocklen = round(0.15*samplerate/32)*32
+    for noiseest in ["ols", "qr"]:
+        batch, sdbatch = timeCall(lambda: WF.blockNoise(leaves, blocklen, noiseest, batchfit=True), nrep)
+        loop, sdloop = timeCall(lambda: WF.blockNoise(leaves, blocklen, noiseest, batchfit=False), nrep)
+        reldiff = np.abs(sdbatch - sdloop) / sdloop
+        print("Noise estimation (%s) for %d blocks: %.3f s all blocks at once, %.3f s block by block (median of %d). Relative difference of the estimates: mean %.2g, max. %.2g" % (noiseest, np.shape(sdloop)[1], np.median(batch), np.median(loop), nrep, np.mean(reldiff), np.max(reldiff)))
+
+    # 2. Full denoising
+    for noiseest in ["ols", "qr"]:
+        times = {}
+        denoised = {}
+        for batchfit in [True, False]:
+            def denoise():
+                WF = WaveletFunctions.WaveletFunctions(data=data, wavelet="dmey2", maxLevel=5, samplerate=samplerate)
+                return WF.waveletDenoise("soft", 3, 5, aaRec=True, aaWP=False, costfn="fixed", noiseest=noiseest, batchfit=batchfit)
+            times[batchfit], denoised[batchfit] = timeCall(denoise, nrep)
+        maxdiff = np.max(np.abs(denoised[True] - denoised[False]))
+        print("Denoising %d s (%s): %.2f s all blocks at once, %.2f s block by block (median of %d). Max. difference of the denoised signals: %.2g (%.2g of the max. amplitude)" % (length, noiseest, np.median(times[True]), np.median(times[False]), nrep, maxdiff, maxdiff / np.max(np.abs(denoised[False]))))
+
+if __name__ == "__main__":
+    benchmark()
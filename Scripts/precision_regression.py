@@ -0,0 +1,73 @@
+# Regression check of the single precision ("precision": "float32") wavelet signal path
+
+# Runs each bundled wavelet recogniser (Filters/*.txt, except bats) over a sound file
+# with the audio in float64 and in float32, as batch mode does (WaveletSegment.readBatch
+# and waveletSegment or waveletSegmentChp), and checks that the detections are the same.
+# Run from the main AviaNZ folder:
+# python Scripts/precision_regression.py -f "Sound Files/kiwi_1min.wav"
+
+import os
+import sys
+import contextlib
+import copy
+import io
+import numpy as np
+import click
+
+def detect(ws, data, sampleRate, filt, wind):
+    """ Detections (list over subfilters of lists of [start, end] in s) of one filter over data """
+    # (readBatch may adjust the nodes of the filter in place)
+    filt = copy.deepcopy(filt)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ws.readBatch(data, sampleRate, d=False, spInfo=[filt], wpmode="new", wind=wind>0)
+        if filt.get("method", "wv") == "chp":
+            segs = ws.waveletSegmentChp(0, alg=2, wind=wind)
+        else:
+            segs = ws.waveletSegment(0, wpmode="new")
+    return [np.asarray(subsegs, dtype=np.float64).reshape(-1, 2) for subsegs in segs]
+
+@click.command()
+@click.option('-f', '--file', 'wavfile', type=str, default=os.path.join("Sound Files", "kiwi_1min.wav"), help='Sound file to run the recognisers on')
+@click.option('-r', '--recogniser', type=str, default=None, help='Check only this recogniser (default: all bundled wavelet recognisers)')
+@click.option('-w', '--wind', type=int, default=0, help='Wind adjustment for changepoint recognisers (0=off, 1=OLS, 2=QR)')
+def check(wavfile, recogniser, wind):
+    appdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(appdir)
+    sys.path.insert(0, appdir)
+    import SignalProc
+    import SupportClasses
+    import WaveletSegment
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        filters = SupportClasses.ConfigLoader().filters("Filters", bats=False)
+    if recogniser is not None:
+        filters = {recogniser: filters[recogniser]}
+
+    sp = SignalProc.SignalProc()
+    sp.readWav(wavfile, silent=True)
+    data64 = np.asarray(sp.data, dtype=np.float64)
+    data32 = data64.astype(np.float32)
+
+    failed = []
+    for name, filt in sorted(filters.items()):
+        if not any(subfilter["WaveletParams"].get("nodes") for subfilter in filt["Filters"]):
+            print("%s: skipped (no wavelet nodes)" % name)
+            continue
+        if filt.get("method", "wv") == "chp" and wind and filt["SampleRate"] > sp.sampleRate:
+            print("%s: skipped (wind adjustment needs no upsampling)" % name)
+            continue
+        ws = WaveletSegment.WaveletSegment(wavelet='dmey2')
+        segs64 = detect(ws, data64, sp.sampleRate, filt, wind)
+        segs32 = detect(ws, data32, sp.sampleRate, filt, wind)
+        same = len(segs64) == len(segs32) and all(np.shape(s64) == np.shape(s32) and np.allclose(s64, s32) for s64, s32 in zip(segs64, segs32))
+        print("%s: %d segments in float64, %d in float32, %s" % (name, sum(len(s) for s in segs64), sum(len(s) for s in segs32), "same" if same else "DIFFERENT"))
+        if not same:
+            print("  float64:", [s.tolist() for s in segs64])
+            print("  float32:", [s.tolist() for s in segs32])
+            failed.append(name)
+
+    assert not failed, "float32 detections differ from float64 for: %s" % ", ".join(failed)
+    print("All checked recognisers give the same detections in float32 and float64")
+
+if __name__ == "__main__":
+    check()
@@ -0,0 +1,85 @@
+# Benchmark of AviaNZ CLI startup time (python AviaNZ.py -c -b ...)
+
+# Runs batch processing over a short generated wav file, using a recogniser without a CNN,
+# and compares the normal (lazy) startup with one where TensorFlow, librosa and skimage
+# are imported first, as all AviaNZ processes used to do.
+# Run from the main AviaNZ folder:
+# python Scripts/startup_benchmark.py -n 5 -r "Kakapo"
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import wave
+import numpy as np
+import click
+
+# modules that only need to be loaded for CNNs, resampling etc.
+HEAVYMODULES = ["tensorflow", "librosa", "skimage.measure"]
+
+def makeWav(filename, sampleRate, duration):
+    """ Writes a duration (s) long 16-bit mono wav of low noise """
+    data = (np.random.default_rng(0).standard_normal(int(sampleRate*duration)) * 1000).astype('<i2')
+    f = wave.open(filename, 'wb')
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(sampleRate)
+    f.writeframes(data.tobytes())
+    f.close()
+
+def timeCommand(args, nrep):
+    """ Returns the wall times (s) of nrep runs of the command """
+    times = []
+    for i in range(nrep):
+        start = time.time()
+        res = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.time() - start)
+        if res.returncode != 0:
+            print("ERROR: command failed:", " ".join(args))
+            print(res.stderr.decode(errors="replace"))
+            sys.exit(1)
+    return times
+
+def eagerImports():
+    """ Python code importing the heavy modules that are available """
+    code = ""
+    for m in HEAVYMODULES:
+        code += "\ntry:\n    import %s\nexcept ImportError:\n    pass" % m
+    return code
+
+@click.command()
+@click.option('-n', '--nrep', type=int, default=5, help='Number of repetitions of each measurement')
+@click.option('-r', '--recogniser', type=str, default="Kakapo", help='Recogniser to run (should not use a CNN)')
+@click.option('-l', '--length', type=float, default=60, help='Length of the test file (s)')
+def benchmark(nrep, recogniser, length):
+    appdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(appdir)
+
+    import json
+    filt = json.load(open(os.path.join("Filters", recogniser + ".txt")))
+    if filt.get("CNN"):
+        print("Warning: recogniser %s uses a CNN, so TensorFlow will be loaded anyway" % recogniser)
+
+    # 1. Imports of the batch processing modules only
+    importcode = "import AviaNZ_batch"
+    lazy = timeCommand([sys.executable, "-c", importcode], nrep)
+    eager = timeCommand([sys.executable, "-c", eagerImports() + "\n" + importcode], nrep)
+    print("Import of AviaNZ_batch: %.2f s (median of %d), with heavy modules preloaded %.2f s" % (np.median(lazy), nrep, np.median(eager)))
+
+    # 2. Full CLI batch run over one file
+    with tempfile.TemporaryDirectory() as sdir:
+        makeWav(os.path.join(sdir, "test.wav"), filt["SampleRate"], length)
+        cliargs = ["-c", "-b", "-d", sdir, "-r", recogniser]
+        runcode = "import sys, runpy\nsys.argv = ['AviaNZ.py'] + %s\nrunpy.run_path('AviaNZ.py', run_name='__main__')" % repr(cliargs)
+        lazy = timeCommand([sys.executable, "-c", runcode], nrep)
+        eager = timeCommand([sys.executable, "-c", eagerImports() + "\n" + runcode], nrep)
+    print("AviaNZ.py %s: %.2f s (median of %d), with heavy modules preloaded %.2f s" % (" ".join(cliargs[:2]), np.median(lazy), nrep, np.median(eager)))
+
+    # 3. Which heavy modules were actually loaded
+    code = importcode + "\nimport sys\nprint([m for m in %s if m in sys.modules])" % repr(HEAVYMODULES)
+    res = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    print("Heavy modules loaded by importing AviaNZ_batch:", res.stdout.decode().strip())
+
+if __name__ == "__main__":
+    benchmark()
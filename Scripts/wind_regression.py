@@ -0,0 +1,110 @@
+# Regression check of the wind adjustment in changepoint detection (detectCallsChp)
+
+# Runs each bundled changepoint recogniser (Filters/*.txt with "method": "chp") over a
+# sound file with wind adjustment, once with the wind models of all windows fitted at once
+# (WaveletFunctions.PolyFitBatch, QuantRegBatch) and once with a separate fit for each window
+# (Polynomial.fit, QuantReg), as before, and checks that the detections and fits are the same.
+# Run from the main AviaNZ folder:
+# python Scripts/wind_regression.py -f "Sound Files/kiwi_1min.wav" -w 2
+
+import os
+import sys
+import contextlib
+import copy
+import io
+import numpy as np
+import click
+
+def detect(ws, data, sampleRate, filt, wind):
+    """ Detections (list over subfilters of lists of [start, end] in s) of one filter over data """
+    # (readBatch may adjust the nodes of the filter in place)
+    filt = copy.deepcopy(filt)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ws.readBatch(data, sampleRate, d=False, spInfo=[filt], wpmode="new", wind=True)
+        segs = ws.waveletSegmentChp(0, alg=2, wind=wind)
+    return [np.asarray(subsegs, dtype=np.float64).reshape(-1, 2) for subsegs in segs]
+
+@click.command()
+@click.option('-f', '--file', 'wavfile', type=str, default=os.path.join("Sound Files", "kiwi_1min.wav"), help='Sound file to run the recognisers on')
+@click.option('-w', '--wind', type=click.Choice(["1", "2"]), default="2", help='Wind adjustment (1=OLS, 2=QR)')
+def check(wavfile, wind):
+    appdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(appdir)
+    sys.path.insert(0, appdir)
+    import SignalProc
+    import SupportClasses
+    import WaveletFunctions
+    import WaveletSegment
+    wind = int(wind)
+
+    # per-window fits, with the same interface as the batched ones
+    class PolyFitWindows():
+        def __init__(self, x, y, deg):
+            self.pols = [np.polynomial.polynomial.Polynomial.fit(x, regy, deg) for regy in y]
+        def __call__(self, x):
+            return np.asarray([pol(x) for pol in self.pols])
+
+    class QuantRegWindows():
+        def __init__(self, endog, exog, **kwargs):
+            self.pols = [WaveletFunctions.QuantReg(regy, exog, **kwargs) for regy in endog]
+            self.beta = np.asarray([pol.beta for pol in self.pols])
+        def __call__(self, x):
+            return np.asarray([pol(x) for pol in self.pols])
+
+    batchfits = (WaveletFunctions.PolyFitBatch, WaveletFunctions.QuantRegBatch)
+    windowfits = (PolyFitWindows, QuantRegWindows)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        filters = SupportClasses.ConfigLoader().filters("Filters", bats=False)
+
+    sp = SignalProc.SignalProc()
+    sp.readWav(wavfile, silent=True)
+    data = np.asarray(sp.data, dtype=np.float64)
+
+    failed = []
+    for name, filt in sorted(filters.items()):
+        if filt.get("method", "wv") != "chp":
+            continue
+        if filt["SampleRate"] > sp.sampleRate:
+            print("%s: skipped (wind adjustment needs no upsampling)" % name)
+            continue
+        segs = {}
+        for fits in [batchfits, windowfits]:
+            WaveletFunctions.PolyFitBatch, WaveletFunctions.QuantRegBatch = fits
+            ws = WaveletSegment.WaveletSegment(wavelet='dmey2')
+            segs[fits] = detect(ws, data, sp.sampleRate, filt, wind)
+        WaveletFunctions.PolyFitBatch, WaveletFunctions.QuantRegBatch = batchfits
+        segsb, segsw = segs[batchfits], segs[windowfits]
+        # OLS fits agree to rounding, QR fits exactly
+        if wind == 1:
+            same = len(segsb) == len(segsw) and all(np.shape(sb) == np.shape(sw) and np.allclose(sb, sw) for sb, sw in zip(segsb, segsw))
+        else:
+            same = len(segsb) == len(segsw) and all(np.array_equal(sb, sw) for sb, sw in zip(segsb, segsw))
+        print("%s: %d segments with batched fits, %d with per-window fits, %s" % (name, sum(len(s) for s in segsb), sum(len(s) for s in segsw), "same" if same else "DIFFERENT"))
+        if not same:
+            print("  batched:", [s.tolist() for s in segsb])
+            print("  per-window:", [s.tolist() for s in segsw])
+            failed.append(name)
+
+    # the fits themselves, on random log energies of 31 nodes
+    rng = np.random.default_rng(0)
+    regx = np.log(np.linspace(250, 7750, 31))
+    windE = rng.standard_normal((500, 31)) + 3 - regx/2
+    regx_poly = np.column_stack((np.ones(len(regx)), regx, regx**2, regx**3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        qrb = WaveletFunctions.QuantRegBatch(windE, regx_poly, q=0.2, max_iter=250, p_tol=1e-3)
+        qrw = QuantRegWindows(windE, regx_poly, q=0.2, max_iter=250, p_tol=1e-3)
+    if not np.array_equal(qrb.beta, qrw.beta):
+        print("QuantRegBatch differs from QuantReg in %d of %d fits" % (np.sum(np.any(qrb.beta != qrw.beta, axis=1)), len(windE)))
+        failed.append("QuantRegBatch")
+    polb = WaveletFunctions.PolyFitBatch(regx, windE, 3)
+    polw = PolyFitWindows(regx, windE, 3)
+    if not np.allclose(polb(regx), polw(regx), rtol=1e-10, atol=1e-10):
+        print("PolyFitBatch differs from Polynomial.fit")
+        failed.append("PolyFitBatch")
+
+    assert not failed, "batched wind fits differ from per-window fits for: %s" % ", ".join(failed)
+    print("All checked recognisers give the same detections with batched and per-window wind fits")
+
+if __name__ == "__main__":
+    check()
@@ -27,9 +27,9 @@ import Shapes
 import numpy as np
 import scipy.ndimage as spi
 from scipy import signal
-import librosa
 import time
 from ext import ce_denoise as ce
+from ext import ce_dtw
 import json
 import os
 import math
@@ -37,13 +37,8 @@ import copy
 import wavio
 from scipy.interpolate import interp1d
 from scipy.signal import medfilt
-import skimage.measure as skm
-import tensorflow as tf
-try:
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
-except:
-    pass
+# NOTE: tensorflow, librosa and skimage are slow to import,
+# so they are imported only in the functions that need them.
 
 class Segment(list):
     """ A single AviaNZ annotation ("segment" or "box" type).
@@ -869,42 +864,50 @@ class Segmenter:
         They then return the max-width:max+width segments for each max
         """
         data = np.abs(self.data)
-        E = np.zeros(len(data))
-        E[width] = np.sum(data[:2*width+1])
-        for i in range(width+1,len(data)-width):
-            E[i] = E[i-1] - data[i-width-1] + data[i+width]
+        N = len(data)
+        width = int(width)
+        if N <= 2*width:
+            print("Warning: data too short for energy segmentation")
+            return []
+
+        # Windowed sum from cumulative sums: E[i] = sum(data[i-width:i+width+1])
+        csum = np.concatenate(([0], np.cumsum(data, dtype=np.float64)))
+        E = np.zeros(N)
+        E[width:N-width] = csum[2*width+1:] - csum[:N-2*width]
         E = E/(2*width)
 
         # TODO: Automatic energy gain (normalisation method)
 
         # This thing is noisy, so I'm going to median filter it. SoundID doesn't seem to?
-        Em = np.zeros(len(data))
-        for i in range(width,len(data)-width):
-            Em[i] = np.median(E[i-width:i+width])
-        for i in range(width):
+        # Running median of E[i-width:i+width]: the window has even length,
+        # so average its two middle order statistics
+        Em = (spi.rank_filter(E, width-1, size=2*width) + spi.rank_filter(E, width, size=2*width))/2
+        # shrinking windows at the ends
+        Em[0] = E[0]
+        for i in range(1, width+1):
             Em[i] = np.median(E[0:2*i])
-            Em[-i] = np.median(E[-2 * i:])
+            Em[-i] = np.median(E[-2*i:])
 
         # TODO: Better way to do this?
         threshold = np.mean(Em) + thr*np.std(Em)
 
         # Pick out the regions above threshold and the argmax of each, assuming they are wide enough
-        starts = []
-        ends = []
-        insegment = False
-        for i in range(len(data)-1):
-            if not insegment:
-                if Em[i]<threshold and Em[i+1]>threshold:
-                    starts.append(i)
-                    insegment = True
-            if insegment:
-                if Em[i]>threshold and Em[i+1]<threshold:
-                    ends.append(i)
-                    insegment = False
-        if insegment:
-            ends.append(len(data))
+        # Upward and downward crossings, which have to alternate starting with an upward one
+        ups = np.flatnonzero((Em[:-1] < threshold) & (Em[1:] > threshold))
+        downs = np.flatnonzero((Em[:-1] > threshold) & (Em[1:] < threshold))
+        crossings = np.concatenate((ups, downs))
+        isup = np.concatenate((np.ones(len(ups), dtype=bool), np.zeros(len(downs), dtype=bool)))
+        order = np.argsort(crossings, kind='stable')
+        crossings = crossings[order]
+        isup = isup[order]
+        keep = isup != np.concatenate(([False], isup[:-1]))
+        crossings = crossings[keep]
+        starts = crossings[0::2].tolist()
+        ends = crossings[1::2].tolist()
+        if len(ends) < len(starts):
+            ends.append(N)
         maxpoints = []
-        Emm = np.zeros(len(data))
+        Emm = np.zeros(N)
         for i in range(len(starts)):
             if ends[i] - starts[i] > min_width:
                 maxpoints.append(np.argmax(Em[starts[i]:ends[i]]))
@@ -960,11 +963,14 @@ class Segmenter:
         segs = self.convert01(ind, self.incr / self.fs)
         return segs
 
-    def medianClip(self, thr=3.0, medfiltersize=5, minaxislength=5, minSegment=70):
+    def medianClip(self, thr=3.0, medfiltersize=5, minaxislength=5, minSegment=70, tilesize=None):
         """ Median clipping for segmentation
         Based on Lasseck's method
         minaxislength - min "length of the minor axis of the ellipse that has the same normalized second central moments as the region", based on skm.
         minSegment - min number of pixels exceeding thr to declare an area as segment.
+        tilesize - if set, the pixels are compared to the medians in tiles of this many spectrogram rows,
+            which bounds the temporary memory for very long pages. The medians are always those of
+            the whole page, so the result is the same as without tiles.
         This version only clips in time, ignoring frequency
         And it opens up the segments to be maximal (so assumes no overlap).
         The multitaper spectrogram helps a lot
@@ -978,12 +984,15 @@ class Segmenter:
 
         rowmedians = np.median(sg, axis=1)
         colmedians = np.median(sg, axis=0)
-
-        clipped = np.zeros(np.shape(sg),dtype=int)
-        for i in range(np.shape(sg)[0]):
-            for j in range(np.shape(sg)[1]):
-                if (sg[i, j] > thr * rowmedians[i]) and (sg[i, j] > thr * colmedians[j]):
-                    clipped[i, j] = 1
+        if tilesize is None:
+            tilesize = np.shape(sg)[0]
+        tilesize = max(int(tilesize), 1)
+
+        # A pixel is kept if it exceeds thr times both its row and its column median
+        clipped = np.zeros(np.shape(sg), dtype=int)
+        for start in range(0, np.shape(sg)[0], tilesize):
+            tile = sg[start:start+tilesize, :]
+            clipped[start:start+tilesize, :] = (tile > thr * rowmedians[start:start+tilesize, np.newaxis]) & (tile > thr * colmedians[np.newaxis, :])
         print("Found", np.sum(clipped), "pixels")
 
         # This is the stencil for the closing and dilation. It's a 5x5 diamond. Can also use a 3x3 diamond
@@ -999,6 +1008,7 @@ class Segmenter:
         clipped = spi.median_filter(clipped,size=medfiltersize)
         clipped = spi.binary_fill_holes(clipped)
 
+        import skimage.measure as skm
         blobs = skm.regionprops(skm.label(clipped.astype(int)))
 
         # Delete blobs that are too small
@@ -1056,6 +1066,7 @@ class Segmenter:
         There are no offset times -- compute an energy drop?
         A straw man really.
         """
+        import librosa
         o_env = librosa.onset.onset_strength(self.data, sr=self.fs, aggregate=np.median)
         cutoff = np.mean(o_env) + thr * np.std(o_env)
         o_env = np.where(o_env > cutoff, o_env, 0)
@@ -1114,26 +1125,27 @@ class Segmenter:
         indices = peakutils.indexes(matches, thres=threshold, min_dist=md)
         return indices
 
-    def findDTWMatches(self, seg, data):
-        # TODO: This is slow and crap. Note all the same length, for a start, and the fact that it takes forever!
-        # Use MFCC first?
-        d = np.zeros(len(data))
-        for i in range(len(data)):
-            d[i] = self.dtw(seg, data[i:i+len(seg)])
-        return d
+    def findDTWMatches(self, seg, data, band=None, thr=np.inf, subsequence=False):
+        """ DTW template matching of seg in data (1D, or frames x features).
+        Default: distance between seg and data[i:i+len(seg)] at every offset i.
+            band - Sakoe-Chiba radius in samples (None for unconstrained)
+            thr - distances above it are np.inf, which lets most offsets be skipped
+                (LB_Keogh bounds and early abandoning)
+        subsequence=True: subsequence DTW, the match can also stretch or shrink.
+            Returns the cost of the best match ending at each sample, and its start sample.
+        """
+        # TODO: Use MFCC first?
+        if subsequence:
+            return ce_dtw.SubsequenceDTW(seg, data)
+        return ce_dtw.DTWOffsets(seg, data, band, thr)
 
-    def dtw(self, x, y, wantDistMatrix=False):
+    def dtw(self, x, y, wantDistMatrix=False, band=None):
         # Compute the dynamic time warp between two 1D arrays
-        dist = np.zeros((len(x)+1,len(y)+1))
-        dist[1:, :] = np.inf
-        dist[:, 1:] = np.inf
-        for i in range(len(x)):
-            for j in range(len(y)):
-                dist[i+1, j+1] = np.abs(x[i]-y[j]) + min(dist[i, j+1], dist[i+1, j], dist[i, j])
+        # (compiled, optionally within a Sakoe-Chiba band)
         if wantDistMatrix:
-            return dist
+            return ce_dtw.DTWMatrix(x, y, band)
         else:
-            return dist[-1, -1]
+            return ce_dtw.DTW(x, y, band)
 
     def dtw_path(self, d):
         # Shortest path through DTW matrix
@@ -1239,9 +1251,11 @@ class PostProcess:
 
         return certainty
 
-    def CNN(self):
+    def CNN(self, pagesp=None):
         """
         Post-proc with CNN model, self.segments get updated
+        pagesp: None to compute a spectrogram for each segment, or a SignalProc
+            of the whole page (from CNNPageSpec) to share spectrogram windows between segments
         """
         if not self.CNNmodel:
             print("ERROR: no CNN model specified")
@@ -1252,8 +1266,6 @@ class PostProcess:
         ctkey = int(list(self.CNNoutputs.keys())[list(self.CNNoutputs.values()).index(self.calltype)])
         print('call type: ', self.calltype)
 
-        batchsize = 5   # TODO: read from learning parameters file
-
         # spectrograms of pre-cut segs are tiny bit shorter than expected
         # based on the segment length, because spectrogram does not use
         # the last bin: it uses len(data)-window bins
@@ -1261,52 +1273,23 @@ class PostProcess:
         # length for comparability:
         specFrameWidth = len(range(0, int(self.CNNwindow * self.tgtsampleRate - self.CNNwindowInc[0]), self.CNNwindowInc[1]))
 
+        # Features for all segments are generated first and stacked,
+        # so that the model can be called in large batches over the whole page.
+        allfeatures = []
+        numframes = []
+        for seg in self.segments:
+            featuress = self.CNNFeatures(seg, specFrameWidth, pagesp)
+            allfeatures.append(featuress)
+            numframes.append(featuress.shape[0])
+        probsall = self.CNNPredict(np.concatenate(allfeatures, axis=0))
+        del allfeatures
+
+        # split the probabilities back into segments
+        segends = np.cumsum(numframes)
         for ix in reversed(range(len(self.segments))):
-            seg = self.segments[ix]
-            print('\n--- Segment', seg)
-            # expand the segment if it's smaller than 1 frame
-            mincalllength = self.CNNwindow
-            duration = seg[0][1] - seg[0][0]
-            if mincalllength >= duration:
-                extend_by = (mincalllength-duration)/2 + 0.005
-                seg[0][0] -= extend_by
-                seg[0][1] += extend_by
-                if seg[0][0] < 0:
-                    seg[0][0] = 0
-                    seg[0][1] = mincalllength + 0.01
-                elif seg[0][1]*self.sampleRate > len(self.audioData):
-                    seg[0][0] = len(self.audioData)/self.sampleRate - mincalllength - 0.01
-                    seg[0][1] = len(self.audioData)/self.sampleRate
-                duration = seg[0][1] - seg[0][0]
-
-            # Extract the audiodata corresponding to the segment
-            data = self.audioData[int(seg[0][0] * self.sampleRate):int(seg[0][1] * self.sampleRate)]
-
-            # Generate features for CNN, overlapped windows
-            sp = SignalProc.SignalProc(window_width=self.CNNwindowInc[0],
-                                        incr=self.CNNwindowInc[1])
-            sp.data = data
-            sp.sampleRate = self.sampleRate
-            if self.sampleRate != self.tgtsampleRate:
-                sp.resample(self.tgtsampleRate)
-
-            featuress = sp.generateFeaturesCNN(seglen=duration, real_spec_width=specFrameWidth, frame_size=self.CNNwindow, frame_hop=self.CNNhop, CNNfRange=self.CNNfRange)
-            featuress = featuress.astype('float32')
-
-            # assert shape
-            if featuress.shape != (featuress.shape[0], self.CNNinputdim[0], self.CNNinputdim[1], 1):
-                print("ERROR: features shape incorrect", featuress.shape)
-                raise AssertionError
-            numframes = featuress.shape[0]
-
-            # predict with CNN
-            if numframes > 0:
-                # probs = self.CNNmodel(tf.convert_to_tensor(featuress, dtype=tf.float32))  # This might lead to OOM error, therefore show batches
-                probs = np.empty((numframes, len(self.CNNoutputs)))
-                for start in range(0, numframes, batchsize):
-                    end = min(numframes, start + batchsize)
-                    p = self.CNNmodel(tf.convert_to_tensor(featuress[start:end, :, :, :], dtype=tf.float32))
-                    probs[start:end, :] = p
+            print('\n--- Segment', self.segments[ix])
+            if numframes[ix] > 0:
+                probs = probsall[segends[ix]-numframes[ix] : segends[ix], :]
 
                 # convert probs to certainties for each frame
                 if self.activelength(probs[:, ctkey], self.CNNthrs[ctkey][-1]) >= self.subfilter['TimeRange'][0]:
@@ -1330,6 +1313,94 @@ class PostProcess:
 
         print("Segments remaining after CNN: ", len(self.segments))
 
+    def CNNPageSpec(self):
+        """
+        Prepares the whole page (self.audioData) with the CNN parameters, so that the
+        spectrogram windows (complex FTs) computed for one segment are reused for others.
+        Returns: SignalProc of the page, with the (initially empty) dict of its windows
+        by start sample in .sgframes, to be passed to self.CNN
+        """
+        sp = SignalProc.SignalProc(window_width=self.CNNwindowInc[0],
+                                    incr=self.CNNwindowInc[1])
+        sp.data = self.audioData
+        sp.sampleRate = self.sampleRate
+        sp.sgframes = {}
+        return sp
+
+    def CNNFeatures(self, seg, specFrameWidth, pagesp=None):
+        """
+        Generates CNN features (overlapped frames) for a single segment [[s, e], cert].
+        Very short segments are expanded to 1 frame in place.
+        pagesp: if a SignalProc of the page is provided (from CNNPageSpec), the spectrogram
+            of the segment is put together from windows computed for earlier segments where
+            possible (i.e. where they start at the same sample), which gives the same features.
+            Not used if the CNN needs resampling, as the page and the segments would be resampled
+            differently.
+        Returns: float32 ndarray of shape (numframes, inputdim[0], inputdim[1], 1)
+        """
+        # expand the segment if it's smaller than 1 frame
+        mincalllength = self.CNNwindow
+        duration = seg[0][1] - seg[0][0]
+        if mincalllength >= duration:
+            extend_by = (mincalllength-duration)/2 + 0.005
+            seg[0][0] -= extend_by
+            seg[0][1] += extend_by
+            if seg[0][0] < 0:
+                seg[0][0] = 0
+                seg[0][1] = mincalllength + 0.01
+            elif seg[0][1]*self.sampleRate > len(self.audioData):
+                seg[0][0] = len(self.audioData)/self.sampleRate - mincalllength - 0.01
+                seg[0][1] = len(self.audioData)/self.sampleRate
+            duration = seg[0][1] - seg[0][0]
+
+        if pagesp is not None and self.sampleRate == self.tgtsampleRate:
+            # Generate features for CNN, overlapped windows, sharing the spectrogram windows of the page
+            datarange = [int(seg[0][0] * self.sampleRate), min(int(seg[0][1] * self.sampleRate), len(self.audioData))]
+            featuress = pagesp.generateFeaturesCNN(seglen=duration, real_spec_width=specFrameWidth, frame_size=self.CNNwindow, frame_hop=self.CNNhop, CNNfRange=self.CNNfRange, datarange=datarange, sgframes=pagesp.sgframes)
+        else:
+            # Extract the audiodata corresponding to the segment
+            data = self.audioData[int(seg[0][0] * self.sampleRate):int(seg[0][1] * self.sampleRate)]
+
+            # Generate features for CNN, overlapped windows
+            sp = SignalProc.SignalProc(window_width=self.CNNwindowInc[0],
+                                        incr=self.CNNwindowInc[1])
+            sp.data = data
+            sp.sampleRate = self.sampleRate
+            if self.sampleRate != self.tgtsampleRate:
+                sp.resample(self.tgtsampleRate)
+
+            featuress = sp.generateFeaturesCNN(seglen=duration, real_spec_width=specFrameWidth, frame_size=self.CNNwindow, frame_hop=self.CNNhop, CNNfRange=self.CNNfRange)
+        featuress = featuress.astype('float32')
+
+        # assert shape
+        if featuress.shape != (featuress.shape[0], self.CNNinputdim[0], self.CNNinputdim[1], 1):
+            print("ERROR: features shape incorrect", featuress.shape)
+            raise AssertionError
+        return featuress
+
+    def CNNPredict(self, featuress):
+        """
+        Runs the CNN model over stacked features (N x inputdim x 1),
+        in batches of "batchsize_predict" images (from LearningParams).
+        Returns: N x number of outputs ndarray of probabilities
+        """
+        # TFLite models take numpy arrays directly, no need to load TF for them
+        lite = isinstance(self.CNNmodel, SupportClasses.TFLiteModel)
+        if not lite:
+            tf = SupportClasses.importTF()
+        # larger batches are faster, but may lead to OOM errors, esp. on GPU
+        batchsize = self.LearningDict.get('batchsize_predict', 64)
+        numframes = featuress.shape[0]
+        probs = np.empty((numframes, len(self.CNNoutputs)))
+        for start in range(0, numframes, batchsize):
+            end = min(numframes, start + batchsize)
+            if lite:
+                p = self.CNNmodel(featuress[start:end, :, :, :])
+            else:
+                p = self.CNNmodel(tf.convert_to_tensor(featuress[start:end, :, :, :], dtype=tf.float32))
+            probs[start:end, :] = p
+        return probs
+
     def activelength(self, probs, thr):
         """
         Returns the max length (secs) above thr given the probabilities of the images (overlapped)
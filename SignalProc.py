@@ -25,7 +25,6 @@ import scipy.signal as signal
 import scipy.fftpack as fft
 from scipy.stats import boxcox
 import wavio
-import librosa
 import copy
 import gc
 
@@ -47,8 +46,172 @@ except ImportError:
 
 # for fund freq
 from scipy.signal import medfilt
-# for impulse masking
-from itertools import chain, repeat
+# for the filter design cache
+from collections import OrderedDict
+import threading
+
+class DesignCache:
+    """ Memoises filter and window designs (FIR taps, IIR coefficients, SOS sections, windows),
+        as these are repeatedly recreated for every segment, node or page.
+        Keys should contain everything that determines the design, i.e. type, order,
+        and band in fractions of Nyquist (which accounts for the sample rate).
+        Least recently used designs are dropped when maxsize is reached.
+        Hit and miss counts are kept for profiling (see stats).
+        Safe to use from several threads.
+        NOTE: returned designs are shared, so must not be modified inplace.
+        (They are not made read-only as some scipy filters reject such arrays.)
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.designs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, designfn, *args):
+        """ Returns the design stored under key, or creates it with designfn(*args) """
+        with self.lock:
+            if key in self.designs:
+                self.hits += 1
+                self.designs.move_to_end(key)
+                return self.designs[key]
+            self.misses += 1
+        # designed outside the lock, so a slow design does not block other threads
+        # (two threads may occasionally both create the same design)
+        design = designfn(*args)
+        with self.lock:
+            self.designs[key] = design
+            while len(self.designs) > self.maxsize:
+                self.designs.popitem(last=False)
+        return design
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.designs)}
+
+    def clear(self):
+        with self.lock:
+            self.designs.clear()
+            self.hits = 0
+            self.misses = 0
+
+# a single cache for all SignalProc instances in this process
+designCache = DesignCache()
+
+def makeWindow(window, window_width):
+    """ Returns the spectrogram window function of this type and length """
+    if window=='Hann':
+        # This is the Hann window
+        w = 0.5 * (1 - np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)))
+    elif window=='Parzen':
+        # Parzen (window_width even)
+        n = np.arange(window_width) - 0.5*window_width
+        w = np.where(np.abs(n)<0.25*window_width,1 - 6*(n/(0.5*window_width))**2*(1-np.abs(n)/(0.5*window_width)), 2*(1-np.abs(n)/(0.5*window_width))**3)
+    elif window=='Welch':
+        # Welch
+        w = 1.0 - ((np.arange(window_width) - 0.5*(window_width-1))/(0.5*(window_width-1)))**2
+    elif window=='Hamming':
+        # Hamming
+        alpha = 0.54
+        beta = 1.-alpha
+        w = alpha - beta*np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1))
+    elif window=='Blackman':
+        # Blackman
+        alpha = 0.16
+        a0 = 0.5*(1-alpha)
+        a1 = 0.5
+        a2 = 0.5*alpha
+        w = a0 - a1*np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)) + a2*np.cos(4 * np.pi * np.arange(window_width) / (window_width - 1))
+    elif window=='BlackmanHarris':
+        # Blackman-Harris
+        a0 = 0.358375
+        a1 = 0.48829
+        a2 = 0.14128
+        a3 = 0.01168
+        w = a0 - a1*np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)) + a2*np.cos(4 * np.pi * np.arange(window_width) / (window_width - 1)) - a3*np.cos(6 * np.pi * np.arange(window_width) / (window_width - 1))
+    elif window=='Ones':
+        w = np.ones(window_width)
+    else:
+        print("Unknown window, using Hann")
+        w = 0.5 * (1 - np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)))
+    return w
+
+def designButterworth(lowPass, highPass, lowStop, highStop):
+    """ Filter design for SignalProc.ButterworthBandpass (freqs in fractions of Nyquist).
+        Identifies order of filter, max 10. If single-stage polynomial is unstable,
+        switches to order 30, second-order filter.
+        Returns: b, a, sos - with sos=None if the single-stage b, a filter is stable.
+    """
+    if lowPass == 0:
+        # Low pass
+        # calculate the best order
+        order,wN = signal.buttord(highPass, highStop, 3, 40)
+        if order>10:
+            order=10
+        b, a = signal.butter(order,wN, btype='lowpass')
+    elif highPass == 1:
+        # High pass
+        # calculate the best order
+        order,wN = signal.buttord(lowPass, lowStop, 3, 40)
+        if order>10:
+            order=10
+        b, a = signal.butter(order,wN, btype='highpass')
+    else:
+        # Band pass
+        # calculate the best order
+        order,wN = signal.buttord([lowPass, highPass], [lowStop, highStop], 3, 40)
+        if order>10:
+            order=10
+        b, a = signal.butter(order,wN, btype='bandpass')
+
+    # check if filter is stable
+    filterUnstable = np.any(np.abs(np.roots(a))>1)
+    sos = None
+    if filterUnstable:
+        # redesign to SOS
+        # uses order=30 because why not
+        print("single-stage filter unstable, switching to SOS filtering")
+        if lowPass == 0:
+            sos = signal.butter(30, wN, btype='lowpass', output='sos')
+        elif highPass == 1:
+            sos = signal.butter(30, wN, btype='highpass', output='sos')
+        else:
+            sos = signal.butter(30, wN, btype='bandpass', output='sos')
+    return b, a, sos
+
+def designFastButterworth(lowPass, highPass):
+    """ Filter design for SignalProc.FastButterworthBandpass (freqs in fractions of Nyquist).
+        Order 7, or order 30 SOS if the single-stage polynomial is unstable.
+        Returns: b, a, sos - with sos=None if the single-stage b, a filter is stable.
+    """
+    if lowPass == 0:
+        # Low pass
+        b, a = signal.butter(7, highPass, btype='lowpass')
+    elif highPass == 1:
+        # High pass
+        b, a = signal.butter(7, lowPass, btype='highpass')
+    else:
+        # Band pass
+        b, a = signal.butter(7, [lowPass, highPass], btype='bandpass')
+
+    # check if filter is stable
+    filterUnstable = True
+    try:
+        filterUnstable = np.any(np.abs(np.roots(a))>1)
+    except Exception as e:
+        print("Warning:", e)
+        filterUnstable = True
+    sos = None
+    if filterUnstable:
+        # redesign to SOS
+        # uses order=30 because why not
+        print("single-stage filter unstable, switching to SOS filtering")
+        if lowPass == 0:
+            sos = signal.butter(30, highPass, btype='lowpass', output='sos')
+        elif highPass == 1:
+            sos = signal.butter(30, lowPass, btype='highpass', output='sos')
+        else:
+            sos = signal.butter(30, [lowPass, highPass], btype='bandpass', output='sos')
+    return b, a, sos
 
 class SignalProc:
     """ This class reads and holds the audiodata and spectrogram, to be used in the main interface.
@@ -73,19 +236,16 @@ class SignalProc:
 
     def readWav(self, file, len=None, off=0, silent=False):
         """ Args the same as for wavio.read: filename, length in seconds, offset in seconds. """
-        wavobj = wavio.read(file, len, off)
-        self.data = wavobj.data
+        # The file is memory-mapped, so only the requested region is read and decoded,
+        # straight into floats.
+        wavobj = wavio.open_mmap(file)
+        start, end = wavobj.bounds(len, off)
 
-        # take only left channel
-        if np.shape(np.shape(self.data))[0] > 1:
-            self.data = self.data[:, 0]
+        # take only left channel, and force float type
+        self.data = wavobj.asfloat(channel=0)[start:end]
         if QtMM:
             self.audioFormat.setChannelCount(1)
 
-        # force float type
-        if self.data.dtype != 'float':
-            self.data = self.data.astype('float')
-
         # total file length in s read from header (useful for paging)
         self.fileLength = wavobj.nframes
 
@@ -110,6 +270,26 @@ class SignalProc:
             if QtMM:
                 print("Detected format: %d channels, %d Hz, %d bit samples" % (self.audioFormat.channelCount(), self.audioFormat.sampleRate(), self.audioFormat.sampleSize()))
 
+    def readWavPages(self, file, pagelen, overlap=0, dtype='float'):
+        """ Streaming version of readWav for long files, see wavio.readPages.
+            Generator, yields (start, left, data) for each page of pagelen samples:
+            start of the page and number of overlap samples before it (in samples),
+            and the page data with up to overlap samples on either side.
+            Like readWav, data is converted to float (or dtype, e.g. float32)
+            and only the left channel is kept, but self.data is not set.
+        """
+        for start, left, wavobj in wavio.readPages(file, pagelen, overlap):
+            data = wavobj.data
+            # take only left channel
+            if np.shape(np.shape(data))[0] > 1:
+                data = data[:, 0]
+            # force float type
+            if data.dtype != dtype:
+                data = data.astype(dtype)
+            self.fileLength = wavobj.nframes
+            self.sampleRate = wavobj.rate
+            yield start, left, data
+
     def readBmp(self, file, len=None, off=0, silent=False, rotate=True, repeat=True):
         """ Reads DOC-standard bat recordings in 8x row-compressed BMP format.
             For similarity with readWav, accepts len and off args, in seconds.
@@ -223,6 +403,8 @@ class SignalProc:
             print("No resampling needed")
             return
 
+        # (librosa is slow to import, so only done when resampling is needed)
+        import librosa
         self.data = librosa.core.audio.resample(self.data, self.sampleRate, target)
 
         self.sampleRate = target
@@ -393,51 +575,27 @@ class SignalProc:
         if len(self.data) <= window_width:
             window_width = len(self.data) - 1
 
-        self.sg = np.copy(self.data)
-        if self.sg.dtype != 'float':
-            self.sg = self.sg.astype('float')
-
-        # Set of window options
-        if window=='Hann':
-            # This is the Hann window
-            window = 0.5 * (1 - np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)))
-        elif window=='Parzen':
-            # Parzen (window_width even)
-            n = np.arange(window_width) - 0.5*window_width
-            window = np.where(np.abs(n)<0.25*window_width,1 - 6*(n/(0.5*window_width))**2*(1-np.abs(n)/(0.5*window_width)), 2*(1-np.abs(n)/(0.5*window_width))**3)
-        elif window=='Welch':
-            # Welch
-            window = 1.0 - ((np.arange(window_width) - 0.5*(window_width-1))/(0.5*(window_width-1)))**2
-        elif window=='Hamming':
-            # Hamming
-            alpha = 0.54
-            beta = 1.-alpha
-            window = alpha - beta*np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1))
-        elif window=='Blackman':
-            # Blackman
-            alpha = 0.16
-            a0 = 0.5*(1-alpha)
-            a1 = 0.5
-            a2 = 0.5*alpha
-            window = a0 - a1*np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)) + a2*np.cos(4 * np.pi * np.arange(window_width) / (window_width - 1))
-        elif window=='BlackmanHarris':
-            # Blackman-Harris
-            a0 = 0.358375
-            a1 = 0.48829
-            a2 = 0.14128
-            a3 = 0.01168
-            window = a0 - a1*np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)) + a2*np.cos(4 * np.pi * np.arange(window_width) / (window_width - 1)) - a3*np.cos(6 * np.pi * np.arange(window_width) / (window_width - 1))
-        elif window=='Ones':
-            window = np.ones(window_width)
+        if sgType=='Standard' and not equal_loudness:
+            # no copy needed, frames will be read through a strided view of the data
+            self.sg = self.data
         else:
-            print("Unknown window, using Hann")
-            window = 0.5 * (1 - np.cos(2 * np.pi * np.arange(window_width) / (window_width - 1)))
+            self.sg = np.copy(self.data)
+            if self.sg.dtype != 'float':
+                self.sg = self.sg.astype('float')
+
+        # Set of window options (see makeWindow), reused between calls
+        window = designCache.get(("window", window, window_width), makeWindow, window, window_width)
 
         if equal_loudness:
             self.sg = self.equalLoudness(self.sg)
 
+        datamean = 0
         if mean_normalise:
-            self.sg -= self.sg.mean()
+            if self.sg is self.data:
+                # will be subtracted from each frame instead
+                datamean = np.mean(self.data, dtype=np.float64)
+            else:
+                self.sg -= self.sg.mean()
 
         starts = range(0, len(self.sg) - window_width, incr)
         if sgType=='Multi-tapered':
@@ -476,37 +634,37 @@ class SignalProc:
 
             print("SG range:", np.min(self.sg),np.max(self.sg))
         else:
+            nframes = len(starts)
+            # need_even pads the spectrogram with empty frames
             if need_even:
-                starts = np.hstack((starts, np.zeros((window_width - len(self.sg) % window_width),dtype=int)))
-
-            # this mode is optimized for speed, but reportedly sometimes
-            # results in crashes when lots of large files are batch processed.
-            # The FFTs here could be causing this, but I'm not sure.
-            # hi_mem = False should switch FFTs to go over smaller vectors
-            # and possibly use less caching, at the cost of 1.5x longer CPU time.
-            hi_mem = True
-            if hi_mem:
-                ft = np.zeros((len(starts), window_width))
-                for i in starts:
-                    ft[i // incr, :] = self.sg[i:i + window_width]
-                ft = np.multiply(window, ft)
-
-                if onesided:
-                    self.sg = np.absolute(fft.fft(ft)[:, :window_width //2])
-                else:
-                    self.sg = np.absolute(fft.fft(ft))
+                nextra = window_width - len(self.sg) % window_width
+            else:
+                nextra = 0
+            if onesided:
+                nbins = window_width // 2
             else:
+                nbins = window_width
+
+            # Frames are a strided view of the data (no copying), and are
+            # windowed and transformed in chunks with a real-input FFT,
+            # so the temporary memory stays bounded for long files.
+            # (Two-sided spectra are mirrored from the real FFT, as the input is real.)
+            chunklen = max(1, 2**20 // window_width)
+            frames = np.lib.stride_tricks.as_strided(self.sg, shape=(nframes, window_width), strides=(self.sg.strides[0]*incr, self.sg.strides[0]), writeable=False)
+            sg = np.zeros((nframes + nextra, nbins))
+            ft = None
+            for chstart in range(0, nframes, chunklen):
+                chend = min(nframes, chstart + chunklen)
+                ft = frames[chstart:chend, :].astype('float')
+                ft -= datamean
+                ft = np.absolute(np.fft.rfft(window * ft, axis=1))
                 if onesided:
-                    ft = np.zeros((len(starts), window_width//2))
-                    for i in starts:
-                        winddata = window * self.sg[i:i + window_width]
-                        ft[i // incr, :] = fft.fft(winddata)[:window_width//2]
+                    sg[chstart:chend, :] = ft[:, :nbins]
                 else:
-                    ft = np.zeros((len(starts), window_width))
-                    for i in starts:
-                        winddata = window * self.sg[i:i + window_width]
-                        ft[i // incr, :] = fft.fft(winddata)
-                self.sg = np.absolute(ft)
+                    sg[chstart:chend, :ft.shape[1]] = ft
+                    sg[chstart:chend, ft.shape[1]:] = ft[:, window_width-ft.shape[1]:0:-1]
+            del frames
+            self.sg = sg
             print(np.min(self.sg),np.max(self.sg))
 
             del ft
@@ -602,15 +760,22 @@ class SignalProc:
 
         if start == 0:
             # Low pass
-            taps = signal.firwin(ntaps, cutoff=[end / nyquist], window=('hamming'), pass_zero=True)
+            cutoff = (end / nyquist,)
+            pass_zero = True
         elif end == sampleRate/2:
             # High pass
-            taps = signal.firwin(ntaps, cutoff=[start / nyquist], window=('hamming'), pass_zero=False)
+            cutoff = (start / nyquist,)
+            pass_zero = False
         else:
             # Bandpass
-            taps = signal.firwin(ntaps, cutoff=[start / nyquist, end / nyquist], window=('hamming'), pass_zero=False)
+            cutoff = (start / nyquist, end / nyquist)
+            pass_zero = False
+        taps = designCache.get(("firwin", ntaps, cutoff, pass_zero), lambda: signal.firwin(ntaps, cutoff=list(cutoff), window=('hamming'), pass_zero=pass_zero))
         #ntaps, beta = signal.kaiserord(ripple_db, width)
         #taps = signal.firwin(ntaps,cutoff = [500/nyquist,8000/nyquist], window=('kaiser', beta),pass_zero=False)
+        if data.dtype == np.float32:
+            # keep single precision data in single precision
+            return signal.lfilter(taps.astype(np.float32), np.ones(1, dtype=np.float32), data)
         return signal.lfilter(taps, 1.0, data)
 
     def ButterworthBandpass(self,data,sampleRate,low=0,high=None,band=0.005):
@@ -652,41 +817,9 @@ class SignalProc:
         if lowPass == 0 and highPass == 1:
             print("No filter needed!")
             return data
-        elif lowPass == 0:
-            # Low pass
-            # calculate the best order
-            order,wN = signal.buttord(highPass, highStop, 3, 40)
-            if order>10:
-                order=10
-            b, a = signal.butter(order,wN, btype='lowpass')
-        elif highPass == 1:
-            # High pass
-            # calculate the best order
-            order,wN = signal.buttord(lowPass, lowStop, 3, 40)
-            if order>10:
-                order=10
-            b, a = signal.butter(order,wN, btype='highpass')
-        else:
-            # Band pass
-            # calculate the best order
-            order,wN = signal.buttord([lowPass, highPass], [lowStop, highStop], 3, 40)
-            if order>10:
-                order=10
-            b, a = signal.butter(order,wN, btype='bandpass')
-
-        # check if filter is stable
-        filterUnstable = np.any(np.abs(np.roots(a))>1)
-        if filterUnstable:
-            # redesign to SOS and filter.
-            # uses order=30 because why not
-            print("single-stage filter unstable, switching to SOS filtering")
-            if lowPass == 0:
-                sos = signal.butter(30, wN, btype='lowpass', output='sos')
-            elif highPass == 1:
-                sos = signal.butter(30, wN, btype='highpass', output='sos')
-            else:
-                sos = signal.butter(30, wN, btype='bandpass', output='sos')
 
+        b, a, sos = designCache.get(("butter", lowPass, highPass, lowStop, highStop), designButterworth, lowPass, highPass, lowStop, highStop)
+        if sos is not None:
             # do the actual filtering
             data = signal.sosfiltfilt(sos, data)
         else:
@@ -719,40 +852,18 @@ class SignalProc:
         if lowPass == 0 and highPass == 1:
             print("No filter needed!")
             return data
-        elif lowPass == 0:
-            # Low pass
-            b, a = signal.butter(7, highPass, btype='lowpass')
-        elif highPass == 1:
-            # High pass
-            b, a = signal.butter(7, lowPass, btype='highpass')
-        else:
-            # Band pass
-            b, a = signal.butter(7, [lowPass, highPass], btype='bandpass')
-
-        # check if filter is stable
-        filterUnstable = True
-        try:
-            filterUnstable = np.any(np.abs(np.roots(a))>1)
-        except Exception as e:
-            print("Warning:", e)
-            filterUnstable = True
-        if filterUnstable:
-            # redesign to SOS and filter.
-            # uses order=30 because why not
-            print("single-stage filter unstable, switching to SOS filtering")
-            if lowPass == 0:
-                sos = signal.butter(30, highPass, btype='lowpass', output='sos')
-            elif highPass == 1:
-                sos = signal.butter(30, lowPass, btype='highpass', output='sos')
-            else:
-                sos = signal.butter(30, [lowPass, highPass], btype='bandpass', output='sos')
 
+        b, a, sos = designCache.get(("fastbutter", lowPass, highPass), designFastButterworth, lowPass, highPass)
+        if sos is not None:
             # do the actual filtering
-            data = signal.sosfilt(sos, data)
+            filtered = signal.sosfilt(sos, data)
         else:
-            data = signal.lfilter(b, a, data)
+            filtered = signal.lfilter(b, a, data)
 
-        return data
+        # the IIR is always run in double, but single precision data is returned as such
+        if data.dtype == np.float32:
+            filtered = filtered.astype(np.float32)
+        return filtered
 
     # The next functions perform spectrogram inversion
     def invertSpectrogram(self,sg,window_width=256,incr=64,nits=10, window='Hann'):
@@ -1305,7 +1416,7 @@ class SignalProc:
                     as having impulse noise
         blocksize - max number of consecutive blocks, 10 consecutive blocks (~1/25 sec) is a good value, to not to mask
                     very close-range calls
-        :return: a binary list of length len(data) indicating presence of impulsive noise (0) otherwise (1)
+        :return: a binary (uint8) array of length len(data) indicating presence of impulsive noise (0) otherwise (1)
         """
 
         # Calculate window length
@@ -1321,29 +1432,23 @@ class SignalProc:
 
         # For each frq band get sections where energy exceeds some (90%) percentile, engp
         # and generate a binary spectrogram
-        sgb = np.zeros((np.shape(sg)))
         ep = np.percentile(sg, engp, axis=0)    # note thr - 90% for energy percentile
-        for y in range(np.shape(sg)[1]):
-            ey = sg[:, y]
-            sgb[np.where(ey > ep[y]), y] = 1
+        sgb = sg > ep
 
         # If lots of frq bands got 1 then predict a click
         # 1 - presence of impulse noise, 0 - otherwise here
-        impulse = np.where(np.count_nonzero(sgb, axis=1) > np.shape(sgb)[1] * fp, 1, 0)     # Note thr fp
+        impulse = np.count_nonzero(sgb, axis=1) > np.shape(sgb)[1] * fp     # Note thr fp
+        del sgb
 
         # When an impulsive noise detected, it's better to check neighbours to make sure its not a bird call
         # very close to the microphone.
-        imp_inds = np.where(impulse > 0)[0].tolist()
+        imp_inds = np.where(impulse)[0]
         imp = self.countConsecutive(imp_inds, len(impulse))
 
-        impulse = []
-        for item in imp:
-            if item > blocksize or item == 0:        # Note threshold - blocksize, 10 consecutive blocks ~1/25 sec
-                impulse.append(1)
-            else:
-                impulse.append(0)
+        # Note threshold - blocksize, 10 consecutive blocks ~1/25 sec
+        impulse = ((imp > blocksize) | (imp == 0)).astype(np.uint8)
 
-        impulse = list(chain.from_iterable(repeat(e, window) for e in impulse))  # Make it same length as self.audioData
+        impulse = np.repeat(impulse, window)  # Make it same length as self.audioData
 
         if len(impulse) > len(self.data):      # Sanity check
             impulse = impulse[0:len(self.data)]
@@ -1354,19 +1459,21 @@ class SignalProc:
         return impulse
 
     def countConsecutive(self, nums, length):
-        gaps = [[s, e] for s, e in zip(nums, nums[1:]) if s + 1 < e]
-        edges = iter(nums[:1] + sum(gaps, []) + nums[-1:])
-        edges = list(zip(edges, edges))
-        edges_reps = [item[1] - item[0] + 1 for item in edges]
-        res = np.zeros((length)).tolist()
-        t = 0
-        for item in edges:
-            for i in range(item[0], item[1]+1):
-                res[i] = edges_reps[t]
-            t += 1
+        """ nums - sorted indices, length - size of the output.
+            Returns an int array where each index in nums is replaced by the length
+            of the run of consecutive indices it belongs to, and all others are 0.
+        """
+        nums = np.asarray(nums, dtype=int)
+        res = np.zeros(length, dtype=int)
+        if len(nums) == 0:
+            return res
+        # run-length encoding: runs are split where the indices jump
+        runstarts = np.flatnonzero(np.diff(nums) > 1) + 1
+        runlens = np.diff(np.concatenate(([0], runstarts, [len(nums)])))
+        res[nums] = np.repeat(runlens, runlens)
         return res
 
-    def generateFeaturesCNN(self, seglen, real_spec_width, frame_size, frame_hop=None, CNNfRange=None):
+    def generateFeaturesCNN(self, seglen, real_spec_width, frame_size, frame_hop=None, CNNfRange=None, datarange=None, sgframes=None):
         '''
         Prepare a syllable to input to the CNN model
         Returns the features (spectrogram for each frame)
@@ -1379,6 +1486,12 @@ class SignalProc:
             (i.e. hop by 1 frame_size)
         CNNfRange: frequency list [f1, f2], if not None, sets
             spectrogram pixels outside f1:f2 to 0
+        datarange: None to compute the spectrogram of self.data (the segment).
+            Otherwise, [start, end] samples of the segment in self.data (e.g. a whole page),
+            and sgframes is a dict of complex FTs of windows of self.data by start sample,
+            which is filled as needed. The spectrogram of the segment is then put together
+            from these (so segments sharing windows compute them once), without changing self.sg,
+            and is the same as the spectrogram of self.data[start:end].
         '''
         # determine the number of frames:
         if frame_hop is None:
@@ -1388,31 +1501,50 @@ class SignalProc:
             n = (seglen-frame_size) // frame_hop + 1
         n = int(n)
 
-        _ = self.spectrogram()
+        if datarange is None:
+            sg = self.spectrogram()
+        else:
+            # windows of the segment's own spectrogram
+            nbins = self.window_width // 2
+            winstarts = datarange[0] + np.arange(0, datarange[1] - datarange[0] - self.window_width, self.incr)
+            window = designCache.get(("window", 'Hann', self.window_width), makeWindow, 'Hann', self.window_width)
+            missing = np.asarray([st for st in winstarts if st not in sgframes], dtype=int)
+            if len(missing) > 0:
+                ft = self.data[missing[:, np.newaxis] + np.arange(self.window_width)].astype('float')
+                ft = np.fft.rfft(window * ft, axis=1)[:, :nbins]
+                for st, ftrow in zip(missing, ft):
+                    sgframes[st] = ftrow
+            # the segment mean is removed from each window, as spectrogram() does
+            segmean = np.mean(self.data[datarange[0]:datarange[1]], dtype=np.float64)
+            meanft = segmean * np.fft.rfft(window)[:nbins]
+            sg = np.zeros((len(winstarts), nbins))
+            for col, st in enumerate(winstarts):
+                sg[col, :] = np.absolute(sgframes[st] - meanft)
 
         # Mask out of band elements
-        spec_height = np.shape(self.sg)[1]
+        spec_height = np.shape(sg)[1]
         if CNNfRange is not None:
             bin_width = self.sampleRate / 2 / spec_height
             lb = int(np.ceil(CNNfRange[0] / bin_width))
             ub = int(np.floor(CNNfRange[1] / bin_width))
-            self.sg[:, 0:lb] = 0.0
-            self.sg[:, ub:] = 0.0
+            sg[:, 0:lb] = 0.0
+            sg[:, ub:] = 0.0
 
         # extract each frame:
         featuress = np.empty((n, spec_height, real_spec_width, 1), dtype=np.float32)
+        i = -1
         for i in range(n):
             sgstart = int(frame_hop * i * self.sampleRate / self.incr)
             sgend = sgstart + real_spec_width
             # Skip the last bits if they don't comprise a full frame:
-            if sgend > np.shape(self.sg)[0]:
+            if sgend > np.shape(sg)[0]:
                 print("Warning: dropping frame at", sgend, n)
                 # Alternatively could adjust:
                 # sgstart = np.shape(sp.sg)[0] - real_spec_width
                 # sgend = np.shape(sp.sg)[0]
                 i = i-1
                 break
-            sgRaw = self.sg[sgstart:sgend, :, np.newaxis]
+            sgRaw = sg[sgstart:sgend, :, np.newaxis]
 
             # Standardize/rescale here.
             # NOTE the resulting features are on linear scale, not dB
@@ -36,8 +36,21 @@ import math
 import numpy as np
 import os, json
 import re
-from tensorflow.keras.models import model_from_json
-from tensorflow.keras.models import load_model
+
+
+def importTF():
+    """ TensorFlow takes seconds and a lot of memory to import,
+        so it is only imported (by this) when a CNN is actually needed.
+        Also enables GPU memory growth on first import.
+        Returns the tensorflow module.
+    """
+    import tensorflow as tf
+    try:
+        physical_devices = tf.config.list_physical_devices('GPU')
+        tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    except:
+        pass
+    return tf
 
 class Log(object):
     """ Used for logging info during batch processing.
@@ -159,6 +172,61 @@ class Log(object):
                 self.appendFile(f)
 
 
+class TFLiteModel(object):
+    """ Inference-only CNN, stored as a TFLite flatbuffer.
+        Can be called like a Keras model (or its predict method) on an
+        N x inputdim x 1 array, and returns an N x outputs array of probabilities.
+        Uses the tflite_runtime interpreter if installed, so that TensorFlow
+        does not need to be loaded at all, otherwise tf.lite.
+    """
+    def __init__(self, file, nthreads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = importTF().lite.Interpreter
+        self.interpreter = Interpreter(model_path=file, num_threads=nthreads)
+        self.inputix = self.interpreter.get_input_details()[0]['index']
+        self.outputix = self.interpreter.get_output_details()[0]['index']
+        # input size is fixed until resized
+        self.inputshape = None
+
+    def __call__(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if x.shape != self.inputshape:
+            self.interpreter.resize_tensor_input(self.inputix, x.shape)
+            self.interpreter.allocate_tensors()
+            self.inputshape = x.shape
+        self.interpreter.set_tensor(self.inputix, x)
+        self.interpreter.invoke()
+        return np.copy(self.interpreter.get_tensor(self.outputix))
+
+    def predict(self, x):
+        return self(x)
+
+    @staticmethod
+    def cacheValid(file, sources):
+        """ True if the cached TFLite file exists and is newer than all its source files """
+        if not os.path.isfile(file):
+            return False
+        cachetime = os.path.getmtime(file)
+        for src in sources:
+            if os.path.isfile(src) and os.path.getmtime(src) > cachetime:
+                return False
+        return True
+
+    @staticmethod
+    def convert(model, file):
+        """ Converts a Keras model to TFLite and saves it to file """
+        tf = importTF()
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        flatbuffer = converter.convert()
+        # write to a temporary file first, so that parallel processes never read a partial file
+        tmpfile = file + ".%d.tmp" % os.getpid()
+        with open(tmpfile, 'wb') as f:
+            f.write(flatbuffer)
+        os.replace(tmpfile, file)
+
+
 class ConfigLoader(object):
     """ This deals with reading main config files.
         Not much functionality, but lots of exception handling,
@@ -212,6 +280,8 @@ class ConfigLoader(object):
                 # note that method may be empty for backwards compatibility:
                 if "method" in filt and filt["method"] not in ["wv", "chp"]:
                     raise ValueError("Filter JSON format wrong (unrecognised method), skipping")
+                if "precision" in filt and filt["precision"] not in ["float32", "float64"]:
+                    raise ValueError("Filter JSON format wrong (unrecognised precision), skipping")
                 for subfilt in filt["Filters"]:
                     if not isinstance(subfilt, dict) or "calltype" not in subfilt or "WaveletParams" not in subfilt or "TimeRange" not in subfilt:
                         raise ValueError("Subfilter JSON format wrong, skipping")
@@ -226,10 +296,12 @@ class ConfigLoader(object):
         print("Loaded filters:", list(goodfilters.keys()))
         return goodfilters
 
-    def CNNmodels(self, filters, dircnn, targetspecies):
+    def CNNmodels(self, filters, dircnn, targetspecies, backend="keras"):
         """ Returns a dict of target CNN models
             Filters - dict of loaded filter files
             Targetspecies - list of species names to load
+            backend - "keras" for full Keras models, or "tflite" for inference-only
+              TFLite models (cached next to the filter, and created from Keras on first use)
             """
         print("Loading CNN models from folder %s" % dircnn)
         targetmodels = dict()
@@ -240,7 +312,7 @@ class ConfigLoader(object):
             elif filt["CNN"]:
                 if species == "NZ Bats":
                     try:
-                        model = load_model(os.path.join(dircnn, filt["CNN"]["CNN_name"]+'.h5'))
+                        model = self.loadCNN(dircnn, filt["CNN"], backend, fullh5=True)
                         targetmodels[species] = [model, filt["CNN"]["win"], filt["CNN"]["inputdim"], filt["CNN"]["output"],
                                                  filt["CNN"]["windowInc"], filt["CNN"]["thr"]]
                         print('Loaded model:', os.path.join(dircnn, filt["CNN"]["CNN_name"]))
@@ -248,19 +320,8 @@ class ConfigLoader(object):
                         print("Could not load CNN model from file:", os.path.join(dircnn, filt["CNN"]["CNN_name"]), e)
                 else:
                     try:
-                        print(os.path.join(dircnn, filt["CNN"]["CNN_name"]) + '.h5')
-                        json_file = open(os.path.join(dircnn, filt["CNN"]["CNN_name"]) + '.json', 'r')
-                        loaded_model_json = json_file.read()
-                        print(loaded_model_json)
-                        print("**")
-                        json_file.close()
-                        model = model_from_json(loaded_model_json)
-                        print(model)
-                        print("***")
-                        model.load_weights(os.path.join(dircnn, filt["CNN"]["CNN_name"]) + '.h5')
-                        print("****")
+                        model = self.loadCNN(dircnn, filt["CNN"], backend)
                         print('Loaded model:', os.path.join(dircnn, filt["CNN"]["CNN_name"]))
-                        model.compile(loss=filt["CNN"]["loss"], optimizer=filt["CNN"]["optimizer"], metrics=['accuracy'])
                         if 'fRange' in filt["CNN"]:
                             targetmodels[filt["CNN"]["CNN_name"]] = [model, filt["CNN"]["win"], filt["CNN"]["inputdim"],
                                                      filt["CNN"]["output"],
@@ -276,6 +337,55 @@ class ConfigLoader(object):
         print("Loaded CNN models:", list(targetmodels.keys()))
         return targetmodels
 
+    def loadCNN(self, dircnn, cnnparams, backend="keras", fullh5=False):
+        """ Loads a single CNN model.
+            cnnparams - the "CNN" part of a filter
+            backend - "keras" or "tflite" (see CNNmodels)
+            fullh5 - True if the .h5 file stores the full model, False if it only
+              has the weights (and the architecture is in .json)
+            Returns: Keras model, or TFLiteModel (which can be used in the same way for prediction)
+        """
+        modelfile = os.path.join(dircnn, cnnparams["CNN_name"])
+        if fullh5:
+            sources = [modelfile + '.h5']
+        else:
+            sources = [modelfile + '.json', modelfile + '.h5']
+
+        # Use the cached inference-only model, if it is newer than the Keras one
+        if backend == "tflite":
+            if TFLiteModel.cacheValid(modelfile + '.tflite', sources):
+                try:
+                    model = TFLiteModel(modelfile + '.tflite')
+                    print("Using cached TFLite model", modelfile + '.tflite')
+                    return model
+                except Exception as e:
+                    print("Warning: could not load TFLite model, will use Keras", e)
+        elif backend != "keras":
+            print("Warning: unrecognized CNN backend %s, using keras" % backend)
+            backend = "keras"
+
+        importTF()
+        from tensorflow.keras.models import model_from_json, load_model
+        if fullh5:
+            model = load_model(modelfile + '.h5')
+        else:
+            json_file = open(modelfile + '.json', 'r')
+            loaded_model_json = json_file.read()
+            json_file.close()
+            model = model_from_json(loaded_model_json)
+            model.load_weights(modelfile + '.h5')
+            model.compile(loss=cnnparams["loss"], optimizer=cnnparams["optimizer"], metrics=['accuracy'])
+
+        if backend == "tflite":
+            # convert and store, so that the next runs can skip Keras completely
+            try:
+                TFLiteModel.convert(model, modelfile + '.tflite')
+                model = TFLiteModel(modelfile + '.tflite')
+                print("Converted to TFLite model", modelfile + '.tflite')
+            except Exception as e:
+                print("Warning: could not convert the model to TFLite, will use Keras", e)
+        return model
+
     def shortbl(self, file, configdir):
         # A fallback shortlist will be confirmed to exist in configdir.
         # This list is necessary
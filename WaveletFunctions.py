@@ -138,6 +138,10 @@ class WaveletFunctions:
         self.maxLevel = maxLevel
         self.tree = None
         self.treefs = samplerate
+        # set of nodes stored non-decimated, or None if all are (see WaveletPacket)
+        self.fullnodes = None
+        # non-decimated length of each node
+        self.treelen = None
 
         self.wavelet = Wavelet.Wavelet(name=wavelet)
 
@@ -244,21 +248,26 @@ class WaveletFunctions:
     # from memory_profiler import profile
     # fp = open('memory_profiler_wp.log', 'w+')
     # @profile(stream=fp)
-    def WaveletPacket(self, nodes, mode='symmetric', antialias=False, antialiasFilter=True):
+    def WaveletPacket(self, nodes, mode='symmetric', antialias=False, antialiasFilter=True, fullnodes=None):
         """ Reimplementation of pywt.WaveletPacket, but allowing for antialias
             following Strang & Nguyen (1996) or
             An anti-aliasing algorithm for discrete wavelet transform. Jianguo Yang & S.T. Park (2003) or
             An Anti-aliasing and De-noising Hybrid Algorithm for Wavelet Transform. Yuding Cui, Caihua Xiong, and Ronglei Sun (2013)
 
             Data and wavelet are taken from current instance of WF. Therefore, ALWAYS use this together with WF, unless you're sure what you're doing.
+            Nodes are stored in the precision of the data (float32 data gives a float32 tree, anything else float64).
 
             Args:
             1. nodes - list of integers, mandatory! will determine decomposition level from it
             2. mode - symmetric by default, as in pywt.WaveletPacket
             3. antialias - on/off switch
             4. antialiasFilter - switches between using filters or fft zeroing
+            5. fullnodes - None to store all nodes before downsampling (as needed for reconstruction).
+               Otherwise, a list of nodes to be stored like that; all other nodes
+               are stored downsampled (i.e. only the WCs), which halves their size.
+               Use isFull/getWCs to read such a tree, and only reconstruct the full nodes.
 
-            Return: none - sets self.tree.
+            Return: none - sets self.tree (and self.fullnodes, self.treelen).
         """
         if len(self.data) > 910*16000 and antialias:
             print("ERROR: processing files larger than 15 min in slow antialiasing mode is disabled. Enable this only if you are ready to wait.")
@@ -284,10 +293,22 @@ class WaveletFunctions:
         # object with dec_lo, dec_hi, rec_lo, rec_hi properties. Can be pywt.Wavelet or WF.wavelet
         wavelet = self.wavelet
 
+        # single precision trees use single precision filters, so that convolutions stay in float32
+        dtype = np.float32 if self.data.dtype == np.float32 else np.float64
+        dec_lo = np.asarray(wavelet.dec_lo, dtype=dtype)
+        dec_hi = np.asarray(wavelet.dec_hi, dtype=dtype)
+
         # filter length for extension modes
         flen = max(len(wavelet.dec_lo), len(wavelet.dec_hi), len(wavelet.rec_lo), len(wavelet.rec_hi))//2
         # this tree will store non-downsampled coefs for reconstruction
         self.tree = [self.data]
+        self.treelen = [len(self.data)]
+        if fullnodes is None:
+            self.fullnodes = None
+        else:
+            # (the root is never downsampled anyway)
+            self.fullnodes = set(fullnodes)
+            self.fullnodes.add(0)
 
         if mode != 'symmetric':
             print("ERROR: only symmetric WP mode implemented so far")
@@ -298,8 +319,8 @@ class WaveletFunctions:
         # manually confirmed that this filter is stable hence no SOS option.
         if antialiasFilter:
             low = 0.5
-            hb,ha = signal.butter(20, low, btype='highpass')
-            lb,la = signal.butter(20, low, btype='lowpass')
+            hb,ha = SignalProc.designCache.get(("butter", 20, low, "highpass"), signal.butter, 20, low, 'highpass')
+            lb,la = SignalProc.designCache.get(("butter", 20, low, "lowpass"), signal.butter, 20, low, 'lowpass')
 
         # loop over possible parent nodes (so down to leaf level-1)
         for node in range(2**maxlevel-1):
@@ -310,12 +331,13 @@ class WaveletFunctions:
             if childa not in nodes and childd not in nodes:
                 self.tree.append(np.array([]))
                 self.tree.append(np.array([]))
+                self.treelen.extend([0, 0])
                 continue
 
             # retrieve parent node from J level
             data = self.tree[node]
             # downsample all non-root nodes because that wasn't done
-            if node != 0:
+            if self.isFull(node) and node != 0:
                 data = data[0::2]
 
             # symmetric mode
@@ -328,7 +350,7 @@ class WaveletFunctions:
             if childa in nodes:
                 # fftconvolve seems slower and the caching results in high RAM usage
                 # nexta = signal.fftconvolve(data, wavelet.dec_lo, 'same')[1:-1]
-                nexta = np.convolve(data, wavelet.dec_lo, 'same')[flen:-flen]
+                nexta = np.convolve(data, dec_lo, 'same')[flen:-flen]
                 # antialias A_j+1
                 if antialias:
                     if antialiasFilter:
@@ -337,15 +359,20 @@ class WaveletFunctions:
                         ft = pyfftw.interfaces.scipy_fftpack.fft(nexta)
                         ft[ll//4 : 3*ll//4] = 0
                         nexta = np.real(pyfftw.interfaces.scipy_fftpack.ifft(ft))
-                # store A before downsampling
-                self.tree.append(nexta)
+                # store A before downsampling (or after, if it will not be reconstructed)
+                self.treelen.append(len(nexta))
+                if self.isFull(childa):
+                    self.tree.append(nexta.astype(dtype, copy=False))
+                else:
+                    self.tree.append(nexta[0::2].astype(dtype))
                 # explicit garbage collection - it helps somehow:
                 del nexta
             else:
                 self.tree.append(np.array([]))
+                self.treelen.append(0)
 
             if childd in nodes:
-                nextd = np.convolve(data, wavelet.dec_hi, 'same')[flen:-flen]
+                nextd = np.convolve(data, dec_hi, 'same')[flen:-flen]
                 # antialias D_j+1
                 if antialias:
                     if antialiasFilter:
@@ -355,18 +382,35 @@ class WaveletFunctions:
                         ft[:ll//4] = 0
                         ft[3*ll//4:] = 0
                         nextd = np.real(pyfftw.interfaces.scipy_fftpack.ifft(ft))
-                # store D before downsampling
-                self.tree.append(nextd)
+                # store D before downsampling (or after, if it will not be reconstructed)
+                self.treelen.append(len(nextd))
+                if self.isFull(childd):
+                    self.tree.append(nextd.astype(dtype, copy=False))
+                else:
+                    self.tree.append(nextd[0::2].astype(dtype))
                 # explicit garbage collection - it helps somehow:
                 del nextd
             else:
                 self.tree.append(np.array([]))
+                self.treelen.append(0)
 
             if antialias:
                 print("Node ", node, " complete.")
 
         # Note: no return value, as it sets a tree on the WF object.
 
+    def isFull(self, node):
+        """ True if this node is stored before downsampling (i.e. can be reconstructed). """
+        return self.fullnodes is None or node in self.fullnodes
+
+    def getWCs(self, node):
+        """ Returns the (downsampled) wavelet coefficients of node,
+            regardless of how it is stored in the tree.
+        """
+        if node != 0 and self.isFull(node):
+            return self.tree[node][0::2]
+        return self.tree[node]
+
     def extractE(self, node, winsize, wpantialias=True):
         """ Extracts mean energies of node over windows of size winsize (s).
             Winsize will be adjusted to obtain integer number of WCs in this node.
@@ -383,6 +427,9 @@ class WaveletFunctions:
             if wpantialias:
                 print("Warning: you assumed antialias for a root node, this is probably not intended and will be reset now")
             wpantialias = False
+        # nodes stored downsampled already contain just the WCs
+        # (but the window count must match that of the full node)
+        decimated = not self.isFull(node)
 
         # ratio of current WC size to data ("how many samples went into one WC")
         level = math.floor(math.log2(node+1))
@@ -398,7 +445,9 @@ class WaveletFunctions:
         realwindow = WCperWindow / nodefs
 
         # or nwindows = math.floor(datalengthSec / realwindow)
-        if wpantialias:
+        if decimated:
+            nwindows = math.floor(self.treelen[node]/2 / WCperWindow)
+        elif wpantialias:
             nwindows = math.floor(len(self.tree[node])/2 / WCperWindow)
         else:
             nwindows = math.floor(len(self.tree[node]) / WCperWindow)
@@ -410,7 +459,9 @@ class WaveletFunctions:
             return
 
         # WC from test node(s), trimmed to non-padded size
-        if wpantialias:
+        if decimated:
+            C = self.tree[node][:maxnumwcs]
+        elif wpantialias:
             C = self.tree[node][:maxnumwcs*2:2]
         else:
             C = self.tree[node][:maxnumwcs]
@@ -424,7 +475,8 @@ class WaveletFunctions:
         # print("DC offset = %.3f" % np.mean(C))
 
         # convert into a matrix (seconds x wcs in sec), and get the energy of each row (second)
-        E = (C**2).reshape((nwindows, WCperWindow)).mean(axis=1)
+        # (accumulated in double, also for float32 trees)
+        E = (C**2).reshape((nwindows, WCperWindow)).mean(axis=1, dtype=np.float64)
 
         # cleanup
         C = None
@@ -437,9 +489,12 @@ class WaveletFunctions:
             Takes Data and Wavelet from current WF instance.
             Antialias option controls freq squashing in final step.
 
-            Return: the reconstructed signal, ndarray.
+            Return: the reconstructed signal, ndarray (float32 for float32 trees, float64 otherwise).
         """
         wv = self.wavelet
+        if not self.isFull(node):
+            print("ERROR: node %d was stored downsampled, rebuild the WP with it in fullnodes to reconstruct" % node)
+            return
         data = self.tree[node]
         sp = SignalProc.SignalProc()
 
@@ -453,8 +508,9 @@ class WaveletFunctions:
         numnodes = 2**(lvl+1)
 
         # do the actual convolutions + upsampling
-        if not isinstance(data, np.ndarray):
+        if not isinstance(data, np.ndarray) or data.dtype != np.float32:
             data = np.asarray(data, dtype='float64')
+        dtype = data.dtype
         data = ce.reconstruct(data, node, np.array(wv.rec_hi), np.array(wv.rec_lo), lvl)
 
         if antialias:
@@ -486,10 +542,75 @@ class WaveletFunctions:
                     ft[-ll*nodepos//numnodes : ] = 0
                 data = np.real(pyfftw.interfaces.scipy_fftpack.ifft(ft))
 
-        return data
+        return data.astype(dtype, copy=False)
 
 
-    def waveletDenoise(self,thresholdType='soft',thrMultiplier=4.5,maxLevel=5, costfn='threshold', aaRec=False, aaWP=False, noiseest="const"):
+    def blockNoise(self, bestleaves, blocklen, noiseest, batchfit=False):
+        """ Time-varying noise estimates for waveletDenoise: fits a smooth model
+            of the log energies of 5th level nodes vs. their log center freqs in each time block,
+            and predicts at the centers of bestleaves.
+            Args:
+              1. bestleaves - sorted list of nodes to estimate the noise for
+              2. blocklen - block length in samples (multiple of 32)
+              3. noiseest - model: "ols" (cubic least squares) or "qr" (cubic 0.2 quantile regression)
+              4. batchfit - fit all blocks at once (T, faster), or block by block (F).
+                 The estimates agree to rounding, but that can still change
+                 the denoised output slightly (see Scripts/denoise_benchmark.py)
+            Return: noise sd, ndarray of nodes x blocks
+        """
+        blocklen_s = blocklen / self.treefs  # in s
+        numblocks = math.floor(len(self.tree[0])/blocklen)
+        threshold = np.zeros((len(bestleaves), numblocks))
+
+        # Regression X: Extract log center freqs of appropriate nodes
+        # (all 5th lvl leaves except top one which has filter edge effects):
+        wind_nodes = list(range(31, 63))
+        wind_nodes.remove(47)
+        windnodecenters = [sum(getWCFreq(n, self.treefs))/2 for n in wind_nodes]
+        regx = np.log(windnodecenters)
+
+        # Regression Y: Extract log energies from the same nodes
+        print("extracting node energy...")
+        windE = np.zeros((numblocks, len(windnodecenters)))
+        for node_ix in range(len(windnodecenters)):
+            node = wind_nodes[node_ix]
+            windE[:, node_ix], _ = self.extractE(node, blocklen_s)
+        windE = np.log(windE)
+
+        # X positions to interpolate at (can be non-5th lvl nodes)
+        bestleafcenters = [sum(getWCFreq(n, self.treefs))/2 for n in bestleaves]
+        interpx = np.log(bestleafcenters)
+
+        # Will fit the log energies at log center freqs of each node
+        # w/ a smooth interpolator, and then retrieve the smoothed values.
+        if batchfit:
+            # all blocks at once: pol(x) returns the predictions at x in each block
+            if noiseest == "ols":
+                pol = PolyFitBatch(regx, windE, 3)
+            else:
+                regx_poly = np.column_stack((np.ones(len(regx)), regx, regx**2, regx**3))
+                pol = QuantRegBatch(windE, regx_poly, q=0.20, max_iter=250, p_tol=1e-3)
+            threshold = pol(interpx).T
+        elif noiseest == "ols":
+            # Fill the thr array w/ OLS estimates
+            for t in range(numblocks):
+                regy = windE[t, :]
+                pol = np.polynomial.polynomial.Polynomial.fit(regx, regy, 3)
+                for node_ix in range(len(interpx)):
+                    threshold[node_ix, t] = pol(interpx[node_ix])
+        elif noiseest == "qr":
+            # Create the polynomial features manually
+            regx_poly = np.column_stack((np.ones(len(regx)), regx, regx**2, regx**3))
+            # Fill the thr array w/ QR estimates
+            for t in range(numblocks):
+                regy = windE[t, :]
+                pol = QuantReg(regy, regx_poly, q=0.20, max_iter=250, p_tol=1e-3)
+                for node_ix in range(len(interpx)):
+                    threshold[node_ix, t] = pol(interpx[node_ix])
+        # Threshold so far contains the predicted log-energies
+        return np.sqrt(np.exp(threshold))
+
+    def waveletDenoise(self,thresholdType='soft',thrMultiplier=4.5,maxLevel=5, costfn='threshold', aaRec=False, aaWP=False, noiseest="const", batchfit=False):
         """ Perform wavelet denoising.
         Constructs the wavelet tree to max depth (either specified or found), constructs the best tree, and then
         thresholds the coefficients (soft or hard thresholding), reconstructs the data and returns the data at the root.
@@ -502,6 +623,8 @@ class WaveletFunctions:
           6. antialias while reconstructing (T/F)
           7. antialias while building the WP ('full'), (T/F)
           8. noise energy estimation ("const"/"ols"/"qr")
+          9. batchfit - fit the "ols"/"qr" models of all time blocks at once (T, faster),
+             or block by block (F; see blockNoise for the differences)
         Return: reconstructed signal (ndarray)
         """
         print("Wavelet Denoising-Modified requested, with the following parameters: type %s, threshold %f, maxLevel %d, costfn %s, noiseest %s" % (thresholdType, thrMultiplier, maxLevel, costfn, noiseest))
@@ -520,8 +643,6 @@ class WaveletFunctions:
         self.WaveletPacket(allnodes, 'symmetric', aaWP, antialiasFilter=True)
         print("Checkpoint 1, %.5f" % (time.time() - opstartingtime))
 
-        datalen = len(self.tree[0])
-
         # Determine the best basis, or use all leaves ("fixed")
         # NOTE: nodes must be sorted here, very important!
         if costfn=="fixed":
@@ -560,51 +681,9 @@ class WaveletFunctions:
             # Here we round it to obtain integer number of WCs:
             minwin = 32/self.treefs
             blocklen = round(ADJBLOCKLEN/minwin)*32  # in samples
-            blocklen_s = blocklen / self.treefs  # in s
-
-            # Estimate the thr for each node x block
-            numblocks = math.floor(datalen/blocklen)
-            threshold = np.zeros((len(bestleaves), numblocks))
-
-            # Regression X: Extract log center freqs of appropriate nodes
-            # (all 5th lvl leaves except top one which has filter edge effects):
-            wind_nodes = list(range(31, 63))
-            wind_nodes.remove(47)
-            windnodecenters = [sum(getWCFreq(n, self.treefs))/2 for n in wind_nodes]
-            regx = np.log(windnodecenters)
-
-            # Regression Y: Extract log energies from the same nodes
-            print("extracting node energy...")
-            windE = np.zeros((numblocks, len(windnodecenters)))
-            for node_ix in range(len(windnodecenters)):
-                node = wind_nodes[node_ix]
-                windE[:, node_ix], _ = self.extractE(node, blocklen_s)
-            windE = np.log(windE)
-
-            # X positions to interpolate at (can be non-5th lvl nodes)
-            bestleafcenters = [sum(getWCFreq(n, self.treefs))/2 for n in bestleaves]
-            interpx = np.log(bestleafcenters)
-
-            # Will fit the log energies at log center freqs of each node
-            # w/ a smooth interpolator, and then retrieve the smoothed values.
-            if noiseest == "ols":
-                # Fill the thr array w/ OLS estimates
-                for t in range(numblocks):
-                    regy = windE[t, :]
-                    pol = np.polynomial.polynomial.Polynomial.fit(regx, regy, 3)
-                    for node_ix in range(len(interpx)):
-                        threshold[node_ix, t] = pol(interpx[node_ix])
-            elif noiseest == "qr":
-                # Create the polynomial features manually
-                regx_poly = np.column_stack((np.ones(len(regx)), regx, regx**2, regx**3))
-                # Fill the thr array w/ QR estimates
-                for t in range(numblocks):
-                    regy = windE[t, :]
-                    pol = QuantReg(regy, regx_poly, q=0.20, max_iter=250, p_tol=1e-3)
-                    for node_ix in range(len(interpx)):
-                        threshold[node_ix, t] = pol(interpx[node_ix])
-            # Threshold so far contains the predicted log-energies
-            threshold = np.sqrt(np.exp(threshold))
+
+            # Estimate the sd for each node x block
+            threshold = self.blockNoise(bestleaves, blocklen, noiseest, batchfit)
 
             # for the highest freq node, just use the default MAD estimator
             # b/c filtering effects cause deviations from smooth models there
@@ -701,3 +780,94 @@ class QuantReg():
             and reads off model polynomial order based on beta length.
         """
         return sum([self.beta[i] * (x**i) for i in range(len(self.beta))])
+
+
+class QuantRegBatch():
+    def __init__(self, endog, exog, q=.5, max_iter=500, p_tol=1e-5):
+        """
+        Same model as QuantReg, fitted at once for many responses
+        that share the explanatory variables (e.g. all time windows of a file).
+        The IRLS iterations run together, with the same operations as QuantReg
+        for each problem, and each problem stops being updated once it has converged,
+        so the estimates are those of separate QuantReg fits.
+
+        Parameters
+        ----------
+        endog : array
+            m x n, one row per response
+        exog : array
+            n x 4, shared explanatory variables (polynomial features)
+        q : float
+            Quantile must be strictly between 0 and 1
+        """
+        # Very much a hardcoded normalization, knowing that X is polynomial features
+        exog = exog * np.asarray([1000, 100, 10, 1])
+        endog = np.atleast_2d(endog)
+
+        exog_rank = 4
+        n_iter = 0
+        # weighted X of each problem (m x n x 4), unweighted in the first iteration
+        xstar = None
+        beta = np.ones((len(endog), exog_rank))
+        # problems that have not converged yet
+        active = np.arange(len(endog))
+
+        while n_iter < max_iter and len(active) > 0:
+            n_iter += 1
+            # NOTE: matmul solves each problem with the same BLAS calls as np.dot
+            # in QuantReg, which keeps the (sensitive) IRLS path identical
+            y = endog[active, :, np.newaxis]
+            if xstar is None:
+                xtx = np.dot(exog.T, exog)
+                xty = np.matmul(exog.T, y)
+                xstar = np.empty(np.shape(endog) + (exog_rank,))
+            else:
+                xstarT = np.swapaxes(xstar[active], 1, 2)
+                xtx = np.matmul(xstarT, exog)
+                xty = np.matmul(xstarT, y)
+            betanew = np.matmul(np.linalg.pinv(xtx), xty)
+            resid = y[:, :, 0] - np.matmul(exog, betanew)[:, :, 0]
+            betanew = betanew[:, :, 0]
+
+            mask = np.abs(resid) < .000001
+            resid[mask] = ((resid[mask] >= 0) * 2 - 1) * .000001
+            resid = np.where(resid < 0, q * resid, (1-q) * resid)
+            resid = np.abs(resid)
+            xstar[active] = exog / resid[:, :, np.newaxis]
+            diff = np.max(np.abs(betanew - beta[active]), axis=1)
+            beta[active] = betanew
+            active = active[diff > p_tol]
+
+        if n_iter == max_iter:
+            print("Warning: maximum number of iterations (" + str(max_iter) + ") reached.")
+
+        # un-transform the betas to allow predicting w/o normalizing
+        self.beta = beta * np.asarray([1000, 100, 10, 1])
+
+    def __call__(self, x):
+        """ Predicts for the x value(s) using a polynomial model and self.beta.
+            Returns an array of predictions for each response (m x shape of x).
+        """
+        xpow = np.asarray(x)[..., np.newaxis] ** np.arange(np.shape(self.beta)[1])
+        return np.tensordot(self.beta, xpow, axes=([1], [-1]))
+
+
+class PolyFitBatch():
+    def __init__(self, x, y, deg):
+        """ Least squares polynomial fits of degree deg for many responses
+            at the same x (y: m x len(x), one row per response), in one solve.
+            Same estimates as numpy.polynomial.Polynomial.fit(x, y[i,:], deg) for each row.
+        """
+        # like Polynomial.fit, x is mapped from its range to [-1, 1] for stability
+        self.domain = [np.min(x), np.max(x)]
+        self.coef = np.polynomial.polynomial.polyfit(self.mapx(x), np.atleast_2d(y).T, deg)
+
+    def mapx(self, x):
+        off, scl = np.polynomial.polyutils.mapparms(self.domain, [-1, 1])
+        return off + scl * np.asarray(x)
+
+    def __call__(self, x):
+        """ Predicts for the x value(s), returns an array of predictions
+            for each response (m x shape of x).
+        """
+        return np.polynomial.polynomial.polyval(self.mapx(x), self.coef, tensor=True)
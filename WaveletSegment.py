@@ -20,7 +20,6 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import WaveletFunctions
-import librosa
 import copy
 import numpy as np
 import time, os, math, csv, gc
@@ -29,13 +28,17 @@ import Segment
 from ext import ce_denoise as ce
 from ext import ce_detect
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
 
 
 class WaveletSegment:
     # This class implements wavelet segmentation for the AviaNZ interface
 
-    def __init__(self, spInfo={}, wavelet='dmey2'):
+    def __init__(self, spInfo={}, wavelet='dmey2', nthreads=1):
+        # nthreads: nodes of a page are analysed in this many threads in detectCalls(Chp).
+        # The C parts (reconstruction, energy curve, detectors) run without the GIL.
         self.wavelet = wavelet
+        self.nthreads = max(1, int(nthreads))
         self.spInfo = spInfo
         self.currentSR = 0
         if not spInfo == {}:
@@ -43,18 +46,22 @@ class WaveletSegment:
             print("Detected %d subfilters in this filter" % len(spInfo["Filters"]))
 
         self.sp = SignalProc.SignalProc(256, 128)
+        # per-page cache of reconstructed nodes, reset by readBatch
+        self.recCache = None
 
-    def readBatch(self, data, sampleRate, d, spInfo, wpmode="new", wind=False):
+    def readBatch(self, data, sampleRate, d, spInfo, wpmode="new", wind=False, noiseest="const"):
         """ File (or page) loading for batch mode. Must be followed by self.waveletSegment.
             Args:
-            1. data to be segmented, ndarray
+            1. data to be segmented, ndarray. If float32, the whole wavelet analysis
+               will be done in single precision (see WaveletFunctions.WaveletPacket).
             2. sampleRate of the data, int
             3. d - turn on denoising before calling?
             4. spInfo - List of filters to determine which nodes are needed & target sample rate
             5. wpmode - old/new/aa to indicate no/partial/full antialias
             6. wind - if True, will produce a WP with all nodes to be used in de-winding
+            7. noiseest - noise estimator for denoising ("const"/"ols"/"qr", see WaveletFunctions.waveletDenoise)
         """
-        if data is None or data == [] or len(data) == 0:
+        if data is None or len(data) == 0:
             print("ERROR: data must be provided for WS")
             return
 
@@ -109,26 +116,44 @@ class WaveletSegment:
             print("ERROR: upsampling will cause problems for wind removal. Either turn off the wind filter, or retrain your recognizer to match the sampling rate of these files.")
             return
 
-        denoisedData = self.preprocess(data, sampleRate, fsOut, d=d, fastRes=True)
+        denoisedData = self.preprocess(data, sampleRate, fsOut, d=d, fastRes=True, noiseest=noiseest)
 
         # Find out which nodes will be needed:
         allnodes = []
         if wind:
             allnodes = list(range(31, 63))
+        # and which of them will be reconstructed (only by the "wv" method).
+        # Others, incl. wind nodes, only need energies, so can be stored downsampled.
+        recnodes = []
         for filt in self.spInfo:
             for subfilter in filt["Filters"]:
                 allnodes.extend(subfilter["WaveletParams"]["nodes"])
+                if "method" not in filt or filt["method"]=="wv":
+                    recnodes.extend(subfilter["WaveletParams"]["nodes"])
         allnodes = list(set(allnodes))
 
+        # Nodes reconstructed by several subfilters/species will be cached
+        # for this page, so count how many times each one is needed.
+        # (detectCalls drops cache entries after their last use.)
+        self.recCache = {}
+        self.recUses = {}
+        for filt in self.spInfo:
+            if "method" not in filt or filt["method"]=="wv":
+                for subfilter in filt["Filters"]:
+                    for node in subfilter["WaveletParams"]["nodes"]:
+                        self.recUses[node] = self.recUses.get(node, 0) + 1
+                        freqkey = (node, tuple(subfilter["FreqRange"]))
+                        self.recUses[freqkey] = self.recUses.get(freqkey, 0) + 1
+
         # Generate a full 5 level wavelet packet decomposition (stored in WF.tree)
         self.WF = WaveletFunctions.WaveletFunctions(data=denoisedData, wavelet=self.wavelet, maxLevel=20, samplerate=fsOut)
         if wpmode == "pywt":
             print("ERROR: pywt wpmode is deprecated, use new or aa")
             return
         if wpmode == "new" or wpmode == "old":
-            self.WF.WaveletPacket(allnodes, mode='symmetric', antialias=False)
+            self.WF.WaveletPacket(allnodes, mode='symmetric', antialias=False, fullnodes=recnodes)
         if wpmode == "aa":
-            self.WF.WaveletPacket(allnodes, mode='symmetric', antialias=True, antialiasFilter=True)
+            self.WF.WaveletPacket(allnodes, mode='symmetric', antialias=True, antialiasFilter=True, fullnodes=recnodes)
         print("File loaded in", time.time() - opst)
 
         # no return, just preloaded self.WF
@@ -152,7 +177,7 @@ class WaveletSegment:
             print("-- Identifying calls using subfilter %s --" % subfilter["calltype"])
             goodnodes = subfilter['WaveletParams']["nodes"]
 
-            detected = self.detectCalls(self.WF, nodelist=goodnodes, subfilter=subfilter, rf=True, aa=wpmode!="old")
+            detected = self.detectCalls(self.WF, nodelist=goodnodes, subfilter=subfilter, rf=True, aa=wpmode!="old", cache=True)
 
             # merge neighbours in order to convert the detections into segments
             # note: detected np[0 1 1 1] becomes [[1,3]]
@@ -205,7 +230,7 @@ class WaveletSegment:
         return detected_allsubf
 
     def waveletSegment_train(self, dirName, thrList, MList, d=False, learnMode='recaa', window=1,
-                             inc=None):
+                             inc=None, nprocs=1):
         """ Entry point to use during training, called from DialogsTraining.py.
             Switches between various training methods, orders data loading etc.,
             then just passes the arguments to the right training method and returns the results.
@@ -227,6 +252,7 @@ class WaveletSegment:
             learnMode=="recaafull":
             reconstruct signal from each node individually,
             using homebrew antialiased WPs (SLOW), and antialiased reconstruction.
+            nprocs - number of processes for the grid search (0 = all cores)
             Return: tuple of arrays (nodes, tp, fp, tn, fn)
         """
         # 1. read wavs and annotations into self.annotation, self.audioList
@@ -294,7 +320,7 @@ class WaveletSegment:
         # self.maxEs now is a list of [files][M][TxN] ndarrays
 
         # 4. mark calls and learn threshold
-        res = self.gridSearch(self.maxEs, thrList, MList, learnMode, window, inc)
+        res = self.gridSearch(self.maxEs, thrList, MList, learnMode, window, inc, nprocs=nprocs)
 
         return res
 
@@ -665,7 +691,7 @@ class WaveletSegment:
 
         return detected_out
 
-    def computeWaveletEnergy(self, data, sampleRate, nlevels=5, wpmode="new", window=1, inc=1):
+    def computeWaveletEnergy(self, data, sampleRate, nlevels=5, wpmode="new", window=1, inc=1, overlap=False):
         """ Computes the energy of the nodes in the wavelet packet decomposition
         Args:
         1. data (waveform)
@@ -673,6 +699,8 @@ class WaveletSegment:
         3. max levels for WP decomposition
         4. WP style ("new"-our non-downsampled, "aa"-our fully AA'd)
         5-6. window and inc in seconds, as in other functions. NOTE: this does NOT take into account annotation length
+        7. overlap - if True, window t starts at t*inc, so windows overlap when inc<window.
+           By default, the windows are consecutive blocks of window length (and there are len/inc of them).
         There are 62 coefficients up to level 5 of the wavelet tree (without root!!), and 300 seconds [N sliding window] in 5 mins
         Hence returned coefs would then be a 62*300 matrix [62*N matrix]
         For smaller windows (controlled by window and inc args), returns the energy within each window, so the return has len/inc columns.
@@ -703,37 +731,42 @@ class WaveletSegment:
             allnodes = range(2 ** (nlevels + 1) - 1)
             WF.WaveletPacket(allnodes, mode='symmetric', antialias=True, antialiasFilter=True)
 
-        # TODO this nonsense could be replaced w/ WF.extractE for consistency
-
-        # for each sliding window:
-        # start,end are its coordinates (in samples)
-        start = 0
-        for t in range(N):
-            E = []
-            end = min(len(data), start+win_sr)
-
-            # Calculate energies of all nodes EXCEPT ROOT - from 1 to 2^(nlevel+1)-1
-            for level in range(1, nlevels + 1):
-                # Calculate the window position in WC coordinates
-                dsratio = 2**level
-                WCperWindow = math.ceil(win_sr/dsratio)
-                if wpmode=="aa" or wpmode=="new": # account for non-downsampled tree
-                    WCperWindow = 2*WCperWindow
-                # (root would not require this, but is skipped here anyway)
-
-                startwc = t*WCperWindow
-                endwc = startwc+WCperWindow
-
-                # Extract the energy
-                lvlnodes = WF.tree[2 ** level - 1:2 ** (level + 1) - 1]
-                e = np.array([np.sum(n[startwc:endwc] ** 2) for n in lvlnodes])
-                if np.sum(e) > 0:
-                    e = 100.0 * e / np.sum(e)  # normalize per-level
-                E = np.concatenate((E, e), axis=0)
-
-            start += inc_sr
+        # Calculate energies of all nodes EXCEPT ROOT - from 1 to 2^(nlevel+1)-1,
+        # for all windows of a node at once
+        for level in range(1, nlevels + 1):
+            # Calculate the window size in WC coordinates
+            dsratio = 2**level
+            WCperWindow = math.ceil(win_sr/dsratio)
+            WCperInc = math.ceil(inc_sr/dsratio)
+            if wpmode=="aa" or wpmode=="new": # account for non-downsampled tree
+                WCperWindow = 2*WCperWindow
+                WCperInc = 2*WCperInc
+            # (root would not require this, but is skipped here anyway)
+
+            lvlnodes = WF.tree[2 ** level - 1:2 ** (level + 1) - 1]
+            e = np.zeros((len(lvlnodes), N), dtype=lvlnodes[0].dtype)
+            for i in range(len(lvlnodes)):
+                n2 = lvlnodes[i] ** 2
+                if overlap:
+                    # window sums as differences of the cumulative sum
+                    cs = np.concatenate(([0], np.cumsum(n2)))
+                    startwc = np.minimum(np.arange(N) * WCperInc, len(n2))
+                    endwc = np.minimum(startwc + WCperWindow, len(n2))
+                    e[i, :] = cs[endwc] - cs[startwc]
+                else:
+                    # window t is WCs [t*WCperWindow, (t+1)*WCperWindow), so full windows are rows of a reshape
+                    nfull = min(N, len(n2) // WCperWindow)
+                    e[i, :nfull] = n2[:nfull*WCperWindow].reshape(nfull, WCperWindow).sum(axis=1)
+                    if nfull < N:
+                        # last, partial window (windows past the end stay 0)
+                        e[i, nfull] = np.sum(n2[nfull*WCperWindow:(nfull+1)*WCperWindow])
+
+            # normalize per-level, in each window
+            levelE = np.ascontiguousarray(e.T).sum(axis=1)
+            pos = levelE > 0
+            e[:, pos] = 100.0 * e[:, pos] / levelE[pos]
             # so now 0-1 is the first level, 2-5 the second etc.
-            coefs[:,t] = E
+            coefs[2 ** level - 2:2 ** (level + 1) - 2, :] = e
         return coefs
 
     def fBetaScore_fast(self, annotation, predicted, T, beta=2):
@@ -924,7 +957,6 @@ class WaveletSegment:
                 C = C[:duration]
 
             C = np.abs(C)
-            N = len(C)
 
             # Compute threshold using mean & sd from non-call sections
             if annotation is not None:
@@ -944,12 +976,9 @@ class WaveletSegment:
                 M = int(MList[indexM] * win_sr/samples_wc)
                 E = ce.EnergyCurve(C, M)
                 # for each sliding window, find largest E
-                start = 0
-                for j in range(nw):
-                    end = min(N, int(start + win_sr/samples_wc))
-                    # NOTE: here we determine the statistic (mean/max...) for detecting calls
-                    maxE[indexM, j, nodenum] = (np.log(np.mean(E[start:end])) - meanC) / stdC
-                    start += int(inc_sr/samples_wc)
+                # NOTE: here we determine the statistic (mean/max...) for detecting calls
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    maxE[indexM, :, nodenum] = (np.log(self.windowMeans(E, nw, int(win_sr/samples_wc), int(inc_sr/samples_wc))) - meanC) / stdC
             nodenum += 1
 
         C = None
@@ -959,7 +988,43 @@ class WaveletSegment:
         gc.collect()
         return maxE
 
-    def detectCalls(self, wf, nodelist, subfilter, rf=True, annotation=None, window=1, inc=None, aa=True):
+    def windowMeans(self, E, nw, win, inc):
+        """ Means of E over nw sliding windows, all at once:
+            window j is E[j*inc : j*inc+win], cut at the end of E (empty windows give nan, like np.mean).
+            E is first summed in blocks of gcd(win, inc) samples, and the windows are
+            differences of the cumulative block sums, so the cumsum stays short and accurate.
+        """
+        N = len(E)
+        blk = math.gcd(win, inc)
+        if blk == 0:
+            # win = inc = 0: all windows are empty
+            return np.full(nw, np.nan)
+        nfull = N // blk
+        nblk = int(math.ceil(N / blk))
+        bsums = np.zeros(nblk)
+        bsums[:nfull] = np.reshape(E[:nfull*blk], (nfull, blk)).sum(axis=1)
+        if nfull < nblk:
+            bsums[nfull] = np.sum(E[nfull*blk:])
+        csum = np.concatenate(([0], np.cumsum(bsums)))
+
+        starts = np.arange(nw) * (inc // blk)
+        ends = starts + win // blk
+        sums = csum[np.minimum(ends, nblk)] - csum[np.minimum(starts, nblk)]
+        counts = np.minimum(ends * blk, N) - np.minimum(starts * blk, N)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts
+
+    def dropCached(self, usekey, cachekey):
+        """ Registers one use of a cached page reconstruction,
+            and frees it after the last subfilter has used it.
+        """
+        if usekey not in self.recUses:
+            return
+        self.recUses[usekey] -= 1
+        if self.recUses[usekey] <= 0:
+            self.recCache.pop(cachekey, None)
+
+    def detectCalls(self, wf, nodelist, subfilter, rf=True, annotation=None, window=1, inc=None, aa=True, cache=False):
         """
         For wavelet TESTING and general SEGMENTATION
         Regenerates the signal from the node and threshold.
@@ -971,6 +1036,8 @@ class WaveletSegment:
         5. annotation - for calculating noise properties during training
         6-7. window, inc
         8. antialias - True/False
+        9. cache - reuse reconstructions (and their statistics) of nodes shared
+           with other subfilters on this page. Only valid for wf=self.WF after readBatch.
 
         Return: ndarray of 1/0 annotations for each of T windows
         """
@@ -998,72 +1065,31 @@ class WaveletSegment:
         inc_sr = math.ceil(inc * wf.treefs)
         resol_sr = math.ceil(resol * wf.treefs)
 
-        thr = subfilter['WaveletParams']['thr']
         # Compute the number of samples in a window -- species specific
         # Virginia: changed sampleRate with win_sr
         M = int(subfilter['WaveletParams']['M'] * win_sr)
         nw = int(np.ceil(duration / inc_sr))
         detected = np.zeros((nw, len(nodelist)))
+        if cache and (self.recCache is None or wf is not self.WF or annotation is not None):
+            print("Warning: reconstruction cache only valid for the tree from readBatch, not using it")
+            cache = False
+        # nodes are independent (incl. their cache entries, which are keyed by node),
+        # so they can be reconstructed and scored in parallel threads
+        nodeargs = (wf, subfilter, rf, annotation, aa, cache, duration, win_sr, inc_sr, resol_sr, M, nw)
+        if self.nthreads > 1 and len(nodelist) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, len(nodelist))) as pool:
+                results = list(pool.map(lambda node: self.detectNode(node, *nodeargs), nodelist))
+        else:
+            results = (self.detectNode(node, *nodeargs) for node in nodelist)
         count = 0
-        for node in nodelist:
-            # put WC from test node(s) on the new tree
-            C = wf.reconstructWP2(node, antialias=aa, antialiasFilter=True)
-            # Sanity check for all zero case
-            if not any(C):
-                continue    # return np.zeros(nw)
-
-            if len(C) > duration:
-                C = C[:duration]
-
-            # Filter
-            if rf:
-                C = self.sp.bandpassFilter(C, win_sr, subfilter['FreqRange'][0], subfilter['FreqRange'][1])
-
-            C = np.abs(C)
-            N = len(C)
-            # Virginia: number of segments = number of centers of length inc
-            # nw=int(np.ceil(N / inc_sr))
-            # detected = np.zeros(nw)
-
-            if len(C) > 2*M+1:
-                # Compute the energy curve (a la Jinnai et al. 2012)
-                E = ce.EnergyCurve(C, M)
-            else:
+        for res in results:
+            if res is None:
+                # all-zero node
+                continue
+            if res is False:
+                # node too short for the energy curve
                 break
-            # Compute threshold using mean & sd from non-call sections
-            # Virginia: changed the base. I'm using resol_sr as a base. Cause I'm looking for detections on windows.
-            #This step is not so clear for me
-            if annotation is not None:
-                noiseSamples = np.repeat(annotation == 0, resol_sr)
-                noiseSamples = noiseSamples[:len(C)]
-                C = C[noiseSamples]
-            C = np.log(C)
-            threshold = np.exp(np.mean(C) + np.std(C) * thr)
-
-            # If there is a call anywhere in the window, report it as a call
-            # Virginia-> for each sliding window:
-            # start is the sample start of a window
-            # end is the sample end of a window
-            # The window are sliding windows: starting from data start
-            #center = int(math.ceil(inc_sr/2)) #keeped if neede in future
-            start = 0
-            for j in range(nw):
-                #start = max(0, center - win_sr2) keeped if needed in future
-                end = min(N, start + win_sr)
-                # max/ mean/median
-                # detected[j, count] = np.any(E[start:end] > threshold)
-                # mean
-                # inds2use = np.intersect1d(np.arange(start, end), indstouse)
-                if np.mean(E[start:end]) > threshold:
-                    detected[j, count] = 1
-                # if len(inds2use)== 0:
-                #     detected[j, count] = 0
-                # elif np.mean(E[inds2use]) > threshold:
-                #     detected[j, count] = 1
-                # # median
-                # if np.median(E[start:end]) > threshold:
-                #     detected[j, count] = 1
-                start += inc_sr  # Virginia: corrected
+            detected[:, count] = res
             count += 1
 
         #print(nw, np.shape(detected))
@@ -1096,6 +1122,86 @@ class WaveletSegment:
         gc.collect()
         return detected
 
+    def detectNode(self, node, wf, subfilter, rf, annotation, aa, cache, duration, win_sr, inc_sr, resol_sr, M, nw):
+        """ Detections on one node for detectCalls (see there for the args).
+            Returns an array of nw True/False window detections,
+            None if the node is all zero, or False if it is too short for the energy curve.
+        """
+        # the bandpassed |C| and its log stats are shared by subfilters w/ the same freq range
+        freqkey = (node, tuple(subfilter['FreqRange']))
+        statkey = (node, aa, rf, freqkey[1])
+        if cache and statkey in self.recCache:
+            C, logmean, logstd = self.recCache[statkey]
+            self.dropCached(node, (node, aa))
+        else:
+            if cache and (node, aa) in self.recCache:
+                C = self.recCache[(node, aa)]
+            else:
+                # put WC from test node(s) on the new tree
+                C = wf.reconstructWP2(node, antialias=aa, antialiasFilter=True)
+                if cache and self.recUses.get(node, 0) > 1:
+                    self.recCache[(node, aa)] = C
+            if cache:
+                self.dropCached(node, (node, aa))
+
+            # Sanity check for all zero case
+            if not any(C):
+                return None
+
+            if len(C) > duration:
+                C = C[:duration]
+
+            # Filter
+            if rf:
+                C = self.sp.bandpassFilter(C, win_sr, subfilter['FreqRange'][0], subfilter['FreqRange'][1])
+
+            C = np.abs(C)
+            logmean = None
+
+        # Virginia: number of segments = number of centers of length inc
+        # nw=int(np.ceil(N / inc_sr))
+        # detected = np.zeros(nw)
+
+        if len(C) > 2*M+1:
+            # Compute the energy curve (a la Jinnai et al. 2012)
+            E = ce.EnergyCurve(C, M)
+        else:
+            return False
+        # Compute threshold using mean & sd from non-call sections
+        # Virginia: changed the base. I'm using resol_sr as a base. Cause I'm looking for detections on windows.
+        #This step is not so clear for me
+        if annotation is not None:
+            noiseSamples = np.repeat(annotation == 0, resol_sr)
+            noiseSamples = noiseSamples[:len(C)]
+            C = C[noiseSamples]
+        if logmean is None:
+            if C.dtype == np.float32:
+                # tiny values (e.g. in the bandpass filter transients) can underflow to 0
+                # in single precision, so keep them at the smallest float32 instead of log(0)
+                logC = np.log(np.maximum(C, np.nextafter(np.float32(0), np.float32(1))))
+            else:
+                logC = np.log(C)
+            logmean = np.mean(logC, dtype=np.float64)
+            logstd = np.std(logC, dtype=np.float64)
+            del logC
+            if cache and annotation is None and self.recUses.get(freqkey, 0) > 1:
+                self.recCache[statkey] = (C, logmean, logstd)
+        if cache:
+            self.dropCached(freqkey, statkey)
+        threshold = np.exp(logmean + logstd * subfilter['WaveletParams']['thr'])
+
+        # If there is a call anywhere in the window, report it as a call
+        # Virginia-> for each sliding window:
+        # start is the sample start of a window
+        # end is the sample end of a window
+        # The window are sliding windows: starting from data start
+        #center = int(math.ceil(inc_sr/2)) #keeped if neede in future
+        # window j is E[j*inc_sr : j*inc_sr+win_sr]
+        # max/ mean/median
+        # detected[:, count] = [np.any(E[start:end] > threshold) ...]
+        # mean
+        return self.windowMeans(E, nw, win_sr, inc_sr) > threshold
+
     def detectCallsChp(self, wf, nodelist, alpha, maxlen, window=1, alg=1, printing=1, wind=0):
         """
         For wavelet TESTING and general SEGMENTATION using changepoint detection
@@ -1151,18 +1257,25 @@ class WaveletSegment:
                     continue
                 wind_nodes.append(node)
                 windnodecenters.append(nodecenter)
+        else:
+            wind_nodes = []
 
-            # Regression y: extract energies from all nodes
-            print("extracting wind node energy...")
-            datalen = math.floor(len(wf.tree[0])/wf.treefs/window)
-            windE = np.zeros((datalen, len(wind_nodes)))
-            for node_ix in range(len(wind_nodes)):
-                node = wind_nodes[node_ix]
-                windE[:, node_ix], _ = wf.extractE(node, window)
+        # Extract the energies (and the realized window sizes) of all needed nodes once per page.
+        # Window size will be adjusted to realwindow (in s), b/c it needs to
+        # correspond to an integer number of WCs at each node.
+        extractnodes = list(nodelist) + wind_nodes
+        if self.nthreads > 1 and len(extractnodes) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, len(extractnodes))) as pool:
+                nodeE = dict(zip(extractnodes, pool.map(lambda node: wf.extractE(node, window, wpantialias=True), extractnodes)))
+        else:
+            nodeE = {node: wf.extractE(node, window, wpantialias=True) for node in extractnodes}
+
+        if wind:
+            # Regression y: energies from all wind nodes, windows x nodes
+            windE = np.column_stack([nodeE[node][0] for node in wind_nodes])
 
             # For oversubtraction, roughly estimate background level
             # from 10% quietest frames in each node:
-            # TODO optimize all this to avoid re-extracting same nodes
             OVERSUBALPHA = 1.0
             print("Will oversubtract with alpha=", OVERSUBALPHA)
             rootE, _ = wf.extractE(0, window, wpantialias=False)
@@ -1170,11 +1283,10 @@ class WaveletSegment:
             quietframes = np.argpartition(rootE, numframes)[:numframes]
             bgpow = np.zeros(len(nodelist))
             for node_ix in range(len(nodelist)):
-                E, _ = wf.extractE(nodelist[node_ix], window, wpantialias=True)
+                E = nodeE[nodelist[node_ix]][0]
                 bgpow[node_ix] = np.mean(np.log(E[quietframes]))
 
-            # for each window, interpolate wind (log) energy in each target node:
-            pred = np.zeros((datalen, len(nodelist)))
+            # interpolate wind (log) energy in each target node, for all windows at once:
             regx = np.log(windnodecenters)  # NOTE that here and further centers are in log(freq)!
             qrbiasadjust = 0
             # need to prepare polynomial features manually for non-OLS methods
@@ -1190,37 +1302,37 @@ class WaveletSegment:
 
             tgtnodecenters = np.log([sum(WaveletFunctions.getWCFreq(node, wf.treefs))/2 for node in nodelist])
             windE = np.log(windE)
-            for w in range(datalen):
-                regy = windE[w, :]
-                # ---- REGRESSION IS DONE HERE ----
-                if wind==1:
-                    pol = np.polynomial.polynomial.Polynomial.fit(regx,regy,3)
-                elif wind==2:
-                    # TODO sklearn will add quantreg in v1.0, see if it is any better
-                    pol = WaveletFunctions.QuantReg(regy, regx, q=0.2, max_iter=250, p_tol=1e-3)
+            # ---- REGRESSION IS DONE HERE ----
+            # one model per window (row of windE), all fitted together;
+            # pol(x) returns the predictions at x in each window
+            if wind==1:
+                pol = WaveletFunctions.PolyFitBatch(regx, windE, 3)
+            elif wind==2:
+                # TODO sklearn will add quantreg in v1.0, see if it is any better
+                pol = WaveletFunctions.QuantRegBatch(windE, regx, q=0.2, max_iter=250, p_tol=1e-3)
+            else:
+                print("ERROR: unrecognized wind adjustment %s" % wind)
+                raise
+
+            # Interpolate using the fitted model:
+            pred = np.zeros((len(windE), len(nodelist)))
+            for node_ix in range(len(nodelist)):
+                # for higher level nodes, need to (linearly) average the nearest predictions:
+                if nodelist[node_ix] in range(15, 31):
+                    delta = wf.treefs/128   # half width of a leaf node band = Fs/2/numnodes/2
+                    f1 = np.exp(tgtnodecenters[node_ix]) - delta
+                    f2 = np.exp(tgtnodecenters[node_ix]) + delta
+                    pred1 = pol(np.log(f1))
+                    pred2 = pol(np.log(f2))
+                    # oversubtraction:
+                    pred1 = (pred1 - bgpow[node_ix])*OVERSUBALPHA + bgpow[node_ix]
+                    pred2 = (pred2 - bgpow[node_ix])*OVERSUBALPHA + bgpow[node_ix]
+                    pred[:, node_ix] = np.log((np.exp(pred1) + np.exp(pred2))/2)
                 else:
-                    print("ERROR: unrecognized wind adjustment %s" % wind)
-                    raise
-
-                # Interpolate using the fitted model:
-                for node_ix in range(len(nodelist)):
-                    # for higher level nodes, need to (linearly) average the nearest predictions:
-                    if nodelist[node_ix] in range(15, 31):
-                        delta = wf.treefs/128   # half width of a leaf node band = Fs/2/numnodes/2
-                        f1 = np.exp(tgtnodecenters[node_ix]) - delta
-                        f2 = np.exp(tgtnodecenters[node_ix]) + delta
-                        pred1 = pol(np.log(f1))
-                        pred2 = pol(np.log(f2))
-                        # oversubtraction:
-                        pred1 = (pred1 - bgpow[node_ix])*OVERSUBALPHA + bgpow[node_ix]
-                        pred2 = (pred2 - bgpow[node_ix])*OVERSUBALPHA + bgpow[node_ix]
-                        pred[w, node_ix] = np.log((np.exp(pred1) + np.exp(pred2))/2)
-                    else:
-                        # Straightforward for 5th lvl nodes
-                        pred[w, node_ix] = pol(tgtnodecenters[node_ix])
-                        # Oversubtraction:
-                        pred[w, node_ix] = (pred[w, node_ix] - bgpow[node_ix])*OVERSUBALPHA + bgpow[node_ix]
-                # print("Predictions (log): ", pred[w,:])
+                    # Straightforward for 5th lvl nodes
+                    pred[:, node_ix] = pol(tgtnodecenters[node_ix])
+                    # Oversubtraction:
+                    pred[:, node_ix] = (pred[:, node_ix] - bgpow[node_ix])*OVERSUBALPHA + bgpow[node_ix]
             # TODO would probably be faster to predict all nodes and then average
             # to obtain upper level nodes, but difficult to keep track of nodes then.
 
@@ -1228,56 +1340,17 @@ class WaveletSegment:
             pred = np.exp(pred+qrbiasadjust)
 
         # Compute the number of samples in a window -- species specific
+        # nodes are independent, so they can be scored in parallel threads
+        # (the detectors run without the GIL)
+        nodepreds = [pred[:, node_ix] if wind else None for node_ix in range(len(nodelist))]
+        nodeargs = (maxlen, alg, alpha, printing, wind)
+        if self.nthreads > 1 and len(nodelist) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, len(nodelist))) as pool:
+                results = list(pool.map(lambda node, prednode: self.detectNodeChp(*nodeE[node], prednode, *nodeargs), nodelist, nodepreds))
+        else:
+            results = [self.detectNodeChp(*nodeE[node], prednode, *nodeargs) for node, prednode in zip(nodelist, nodepreds)]
         detected = np.empty((0,3))
-        for node_ix in range(len(nodelist)):
-            node = nodelist[node_ix]
-            # Extracts energies (i.e. integral of square magnitudes) over windows.
-            # Window size will be adjusted to realwindow (in s), b/c it needs to
-            # correspond to an integer number of WCs at this node,
-            # Returns E: vector of energies
-            E, realwindow = wf.extractE(node, window, wpantialias=True)
-
-            # Convert max segment length from s to realized windows
-            # (segments exceeding this length will be marked as 'n')
-            realmaxlen = math.ceil(maxlen / realwindow)
-
-            if np.max(E)>1e-2:  # (checking so that the hardcoded epsilon would be relatively small)
-                E = E + 1e-5 # add epsilon in case there is a short quiet period
-                # NOTE: any non-negligible adjustments need to be applied to pred too
-
-            # Estimate of the global background for this file/page
-            sigma2 = np.percentile(E, 10)
-            print("Global var: %.1f, range of E: %.1f-%.1f, Q10: %.1f" % (np.mean(E), np.min(E), np.max(E), sigma2))
-
-            if wind:
-                # ---- LOG SP SUB ----
-                # retrieve and adjust for the predicted wind strength
-                print("Wind strength summary: mean %.2f, median %.2f" % (np.mean(pred[:, node_ix]), np.median(pred[:, node_ix])))
-                E = np.maximum(1, E / pred[:, node_ix])
-                # This implicitly normalizes to sigma2=1
-            else:
-                # just normalize, same as passing sigma2 to the detectors
-                E = E / sigma2
-
-            # sqrt because the detector squares the data itself (sign not important)
-            # Note that no transformation is applied otherwise (i.e. linear, not log scale)
-            E = np.sqrt(E)
-
-            # analyze by our algorithms.
-            # returns a matrix of n x [s, e, type]
-            # type is an int corresponding to 'n'=NUIS, 's'=SEG, 'o'=SEGonNUIS
-            if alg==1:
-                segm1 = ce_detect.launchDetector1(E, realmaxlen, alpha=alpha).astype('float')
-            else:
-                segm1 = ce_detect.launchDetector2(E, 1, realmaxlen, alpha=alpha, printing=printing).astype('float')
-
-            # here's how you would extract segment means:
-            # for seg in segm1:
-            #     print(seg, round(np.mean(E[int(seg[0]):int(seg[1])]**2)))
-
-            # convert from the window scale into actual seconds
-            segm1[:,:2] = segm1[:,:2] * realwindow
-
+        for segm1 in results:
             detected = np.vstack((detected, np.asarray(segm1)))
 
         # keep only S and their positions:
@@ -1295,12 +1368,64 @@ class WaveletSegment:
         gc.collect()
         return outsegs
 
-    def gridSearch(self, E, thrList, MList, learnMode=None, window=1, inc=None):
+    def detectNodeChp(self, E, realwindow, prednode, maxlen, alg, alpha, printing, wind):
+        """ Changepoint detections on one node for detectCallsChp (see there for the other args).
+            E - energies (i.e. integral of square magnitudes) of this node over windows, from extractE
+            realwindow - the window size (in s) that was used for E
+            prednode - predicted wind energy in each window of this node (if wind)
+            Returns an n x [s, e, type] array of segments, with s, e in seconds.
+        """
+        # Convert max segment length from s to realized windows
+        # (segments exceeding this length will be marked as 'n')
+        realmaxlen = math.ceil(maxlen / realwindow)
+
+        if np.max(E)>1e-2:  # (checking so that the hardcoded epsilon would be relatively small)
+            E = E + 1e-5 # add epsilon in case there is a short quiet period
+            # NOTE: any non-negligible adjustments need to be applied to pred too
+
+        # Estimate of the global background for this file/page
+        sigma2 = np.percentile(E, 10)
+        print("Global var: %.1f, range of E: %.1f-%.1f, Q10: %.1f" % (np.mean(E), np.min(E), np.max(E), sigma2))
+
+        if wind:
+            # ---- LOG SP SUB ----
+            # retrieve and adjust for the predicted wind strength
+            print("Wind strength summary: mean %.2f, median %.2f" % (np.mean(prednode), np.median(prednode)))
+            E = np.maximum(1, E / prednode)
+            # This implicitly normalizes to sigma2=1
+        else:
+            # just normalize, same as passing sigma2 to the detectors
+            E = E / sigma2
+
+        # sqrt because the detector squares the data itself (sign not important)
+        # Note that no transformation is applied otherwise (i.e. linear, not log scale)
+        E = np.sqrt(E)
+
+        # analyze by our algorithms.
+        # returns a matrix of n x [s, e, type]
+        # type is an int corresponding to 'n'=NUIS, 's'=SEG, 'o'=SEGonNUIS
+        if alg==1:
+            segm1 = ce_detect.launchDetector1(E, realmaxlen, alpha=alpha).astype('float')
+        else:
+            segm1 = ce_detect.launchDetector2(E, 1, realmaxlen, alpha=alpha, printing=printing).astype('float')
+
+        # here's how you would extract segment means:
+        # for seg in segm1:
+        #     print(seg, round(np.mean(E[int(seg[0]):int(seg[1])]**2)))
+
+        # convert from the window scale into actual seconds
+        segm1[:,:2] = segm1[:,:2] * realwindow
+
+        return segm1
+
+    def gridSearch(self, E, thrList, MList, learnMode=None, window=1, inc=None, nprocs=1):
         """ Take list of energy peaks of dimensions:
             [files] [MListxTxN ndarrays],
             perform grid search over thr and M parameters,
             do a stepwise search for best nodes for detecting calls.
             In turn, calls are detected when the peaks exceed thrList (provided peaks can be max, mean...)
+            The stepwise search runs for all thresholds at once (see gridSearchFile),
+            and each M x file pair is a separate job, optionally run in a pool of nprocs processes (0 = all cores).
             Output structure:
             1. 2d list of [nodes]
                 (1st d runs over M, 2nd d runs over thr)
@@ -1320,114 +1445,56 @@ class WaveletSegment:
         finalnodes = []
         top_nodes = []
 
-        # Grid search over M x thr x Files
+        # detections are mapped to non-standard annotation windows
+        remap = window != 1 or inc is not None
+        if inc is None:
+            inc2 = window
+        else:
+            inc2 = inc
+
+        # load the annotations for each file
+        annots = []
+        for indexF in range(len(E)):
+            if (inc is not None and inc!=1) or window!=1:
+                annots.append(self.annotation2[indexF])
+            else:
+                annots.append(self.annotation[indexF])
+            # fill top node lists
+            if np.sum(annots[indexF]) > 0:
+                top_nodes.extend(self.bestNodes[indexF][0:2])
+
+        # Stepwise search over M x Files, for all thr at once
+        jobs = [(E[indexF][indexM,:,:], self.bestNodes[indexF], annots[indexF], thrList, remap, inc2)
+                for indexM in range(len(MList)) for indexF in range(len(E))]
+        if nprocs == 0:
+            nprocs = os.cpu_count()
+        nprocs = min(nprocs, len(jobs))
+        if nprocs > 1:
+            import multiprocessing
+            print("Grid search over %d M x file pairs using %d processes" % (len(jobs), nprocs))
+            # spawn, not fork: Qt does not survive forking
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(processes=nprocs) as pool:
+                results = pool.starmap(gridSearchFile, jobs)
+        else:
+            results = [gridSearchFile(*job) for job in jobs]
+        jobs = None
+        gc.collect()
+
         for indexM in range(len(MList)):
             finalnodesT = []
+            fileres = results[indexM*len(E):(indexM+1)*len(E)]
             for indext in range(len(thrList)):
                 # Accumulate nodes for the set of files for this M and thr
                 finalnodesMT = []
                 detected_all = []
                 annot_all = []
-                # loop over files:
                 for indexF in range(len(E)):
-                    # Best nodes found within this file:
-                    finalnodesF = []
-                    bestBetaScore = 0
-                    bestRecall = 0
-
-                    EfileM = E[indexF][indexM,:,:]
-                    nodesToTest = self.bestNodes[indexF]
-                    # load the annotations for this file
-                    if (inc is not None and inc!=1) or window!=1:
-                        annot = self.annotation2[indexF]
-                    else:
-                        annot = self.annotation[indexF]
-
-                    # In addition to the correlation, re-order nodes according to fB. The order of nodes seems really
-                    # important.
-                    thisfile_fBs = []
-                    for nodenum in range(len(nodesToTest)):
-                        detect_onenode = EfileM[:,nodenum] > thrList[indext]
-                        if window != 1 or inc is not None:
-                            if inc is None:
-                                inc2 = window
-                            else:
-                                inc2 = inc
-                            # detected length is equal to the number of windows.
-                            N = len(annot)
-                            detect_ann = np.zeros(N)
-                            start = 0
-                            # map detect_onenode to non-standard annotation windows
-                            for i in range(len(detect_onenode)):
-                                if detect_onenode[i] == 1:
-                                    end = int(min(math.ceil(start + 1), N))
-                                    detect_ann[int(math.floor(start)):end] = 1
-                                start += inc2
-                            detect_onenode = detect_ann
-
-                        thisnode_fB, _, _, _, _, _ = self.fBetaScore(annot, detect_onenode)
-                        if thisnode_fB:
-                            thisfile_fBs.append(thisnode_fB)
-                        else:
-                            thisfile_fBs.append(0.0)
-                    thisfile_node_ix = np.argsort(np.array(thisfile_fBs)).tolist()[::-1]
-                    print('thisfile_fBs:%s, nodes:%s' % (str(thisfile_fBs), str(nodesToTest)))
-
-                    ### STEPWISE SEARCH for best node combination:
-                    # (try to detect using thr, add node if it improves F2)
-                    print("Starting stepwise search. Possible nodes:", list(np.array(nodesToTest)[thisfile_node_ix]))
-                    detect_best = np.zeros(len(EfileM[:,0]))
-                    for nodenum in thisfile_node_ix:
-                        print("Testing node ", nodesToTest[nodenum])
-                        detect_onenode = EfileM[:,nodenum] > thrList[indext]
-
-                        if window != 1 or inc is not None:
-                            if inc is None:
-                                inc2 = window
-                            else:
-                                inc2 = inc
-                            # detected length is equal to the number of windows.
-                            N = len(annot)
-                            detect_ann = np.zeros(N)
-                            start = 0
-                            # map detect_onenode to non-standard annotation windows
-                            for i in range(len(detect_onenode)):
-                                if detect_onenode[i] == 1:
-                                    end = int(min(math.ceil(start + 1), N))
-                                    detect_ann[int(math.floor(start)):end] = 1
-                                start += inc2
-                            detect_onenode = detect_ann
-
-                        # What do we detect if we add this node to currently best detections?
-                        detect_allnodes = np.maximum.reduce([detect_best, detect_onenode])
-                        fB, recall, tp, fp, tn, fn = self.fBetaScore(annot, detect_allnodes)
-
-                        # If this node improved fB,
-                        # store it and update fB, recall, best detections, and optimum nodes
-                        if fB is not None and fB > bestBetaScore:
-                            bestBetaScore = fB
-                            bestRecall = recall
-                            detect_best = detect_allnodes
-                            finalnodesF.append(nodesToTest[nodenum])
-                        # Adding more nodes will not reduce FPs, so this is sufficient to stop:
-                        # Stopping a bit earlier to have fewer nodes and fewer FPs:
-                        if bestBetaScore == 0.95 or bestRecall == 0.95:
-                            break
-
                     # Store the best nodes for this file
-                    finalnodesMT.append(finalnodesF)
-                    print("Iteration f %d/%d complete" % (indexF + 1, len(self.audioList)))
-
-                    # fill top node lists
-                    if np.sum(annot) > 0:
-                        top_nodes.extend(nodesToTest[0:2])
-
-                    # Memory cleanup:
-                    gc.collect()
-
+                    finalnodesMT.append(fileres[indexF][0][indext])
                     # build long vectors of detections and annotations
-                    detected_all.extend(detect_best)
-                    annot_all.extend(annot)
+                    detected_all.extend(fileres[indexF][1][indext])
+                    annot_all.extend(annots[indexF])
 
                 # One iteration done, store results
                 finalnodesMT = [y for x in finalnodesMT for y in x]
@@ -1501,25 +1568,32 @@ class WaveletSegment:
 
         return (bestnodes, worstnodes)
 
-    def preprocess(self, data, sampleRate, fsOut, d=False, fastRes=False):
+    def preprocess(self, data, sampleRate, fsOut, d=False, fastRes=False, noiseest="const"):
         """ Downsamples, denoises, and filters the data.
             sampleRate - actual sample rate of the input. Will be resampled based on spInfo.
             fsOut - target sample rate
             d - boolean, perform denoising?
             fastRes - use kaiser_fast instead of best. Twice faster but pretty similar output.
+            noiseest - noise estimator for denoising ("const"/"ols"/"qr"). The "ols" and "qr" models
+              of all time blocks are fitted at once.
+            The output keeps the precision of data (float32 or float64).
         """
         # resample (implies this hasn't been done by node adjustment before)
         if sampleRate != fsOut:
             print("Resampling from", sampleRate, "to", fsOut)
+            dtype = data.dtype
+            # (librosa is slow to import, so only done when resampling is needed)
+            import librosa
             if not fastRes:
                 data = librosa.core.audio.resample(data, sampleRate, fsOut, res_type='kaiser_best')
             else:
                 data = librosa.core.audio.resample(data, sampleRate, fsOut, res_type='kaiser_fast')
+            data = data.astype(dtype, copy=False)
 
         # Get the five level wavelet decomposition
         if d:
             WF = WaveletFunctions.WaveletFunctions(data=data, wavelet=self.wavelet, maxLevel=20, samplerate=fsOut)
-            denoisedData = WF.waveletDenoise(thresholdType='soft', maxLevel=5)
+            denoisedData = WF.waveletDenoise(thresholdType='soft', maxLevel=5, noiseest=noiseest)
             del WF
         else:
             denoisedData = data  # this is to avoid washing out very fade calls during the denoising
@@ -1709,3 +1783,106 @@ class WaveletSegment:
         presblocks = sum(fileAnnotations)
         totalblocks = sum([len(a) for a in self.annotation])
         print("%d blocks read, %d presence blocks found. %d blocks stored so far.\n" % (nwins, presblocks, totalblocks))
+
+
+def fBetaScores(annotation, detected, beta=2):
+    """ Same as WaveletSegment.fBetaScore without printouts, for many sets of predictions at once.
+        annotation - 1D array of T 1/0 annotations
+        detected - TxK array, each column a set of 1/0 predictions
+        Return: arrays of K fB scores and K recalls, nan where fBetaScore gives None
+    """
+    annotation = np.asarray(annotation)
+    TP = np.sum((annotation == 1)[:, np.newaxis] & (detected == 1), axis=0).astype(float)
+    T = float(np.sum(annotation))
+    P = np.sum(detected, axis=0).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if T != 0:
+            recall = TP / T  # TruePositive/#True
+        else:
+            recall = np.full(len(P), np.nan)
+        precision = np.where(P != 0, TP / P, np.nan)  # TruePositive/#Positive
+        fB = ((1. + beta ** 2) * recall * precision) / (recall + beta ** 2 * precision)
+    fB[np.isnan(recall) | np.isnan(precision) | ((recall == 0) & (precision == 0))] = np.nan
+    return fB, recall
+
+
+def mapToAnnotation(detected, N, inc):
+    """ Maps detections in windows starting every inc annotation windows (TxK, 0/1)
+        to N annotation windows: window i marks [floor(i*inc), ceil(i*inc+1)).
+        Return: NxK array
+    """
+    n = len(detected)
+    # window starts, summed in the same order as start += inc
+    starts = np.zeros(n)
+    starts[1:] = np.cumsum(np.full(n - 1, inc, dtype=float))
+    lo = np.floor(starts).astype(int)
+    hi = np.minimum(np.ceil(starts + 1), N).astype(int)
+    mapped = np.zeros((N,) + np.shape(detected)[1:])
+    if n == 0:
+        return mapped
+    detected = np.asarray(detected, dtype=float)
+    # each window covers at most 2 annotation windows
+    for offset in range(max(0, np.max(hi - lo))):
+        k = lo + offset
+        valid = k < hi
+        np.maximum.at(mapped, k[valid], detected[valid])
+    return mapped
+
+
+def gridSearchFile(EfileM, nodesToTest, annot, thrList, remap=False, inc=1):
+    """ Stepwise search for the best nodes in one file, for one M and all thresholds at once
+        (one job of WaveletSegment.gridSearch; module-level so that it can run in a process pool).
+        Nodes are tried in the order of their own fB, and kept if they improve the fB of the detections.
+        EfileM - TxN energies of the N nodesToTest
+        remap, inc - map detections to non-standard annotation windows starting every inc
+        Return: list of the selected nodes for each thr, and Kx(T) array of detections with them
+    """
+    thrs = np.asarray(thrList)
+    annot = np.asarray(annot)
+    K = len(thrs)
+    nnodes = len(nodesToTest)
+    finalnodes = [[] for k in range(K)]
+    if nnodes == 0:
+        return finalnodes, np.zeros((K, len(EfileM)))
+
+    # detections of each node at all thresholds: nodes x T x K
+    D = []
+    for nodenum in range(nnodes):
+        detect_onenode = EfileM[:, nodenum][:, np.newaxis] > thrs[np.newaxis, :]
+        if remap:
+            detect_onenode = mapToAnnotation(detect_onenode, len(annot), inc)
+        D.append(detect_onenode)
+    D = np.array(D, dtype=float)
+
+    # In addition to the correlation, re-order nodes according to fB. The order of nodes seems really
+    # important.
+    fBs = np.array([np.nan_to_num(fBetaScores(annot, D[nodenum])[0], nan=0.0) for nodenum in range(nnodes)])
+    order = np.array([np.argsort(fBs[:, k]).tolist()[::-1] for k in range(K)])
+
+    ### STEPWISE SEARCH for best node combination:
+    # (try to detect using thr, add node if it improves F2)
+    detect_best = np.zeros((D.shape[1], K))
+    bestBetaScore = np.zeros(K)
+    bestRecall = np.zeros(K)
+    searching = np.ones(K, dtype=bool)
+    for step in range(nnodes):
+        # node tested at this step, for each thr
+        nodeix = order[:, step]
+        # What do we detect if we add this node to currently best detections?
+        detect_allnodes = np.maximum(detect_best, D[nodeix, :, np.arange(K)].T)
+        fB, recall = fBetaScores(annot, detect_allnodes)
+
+        # If this node improved fB,
+        # store it and update fB, recall, best detections, and optimum nodes
+        improved = searching & (fB > bestBetaScore)
+        bestBetaScore[improved] = fB[improved]
+        bestRecall[improved] = recall[improved]
+        detect_best[:, improved] = detect_allnodes[:, improved]
+        for k in np.flatnonzero(improved):
+            finalnodes[k].append(nodesToTest[nodeix[k]])
+        # Adding more nodes will not reduce FPs, so this is sufficient to stop:
+        # Stopping a bit earlier to have fewer nodes and fewer FPs:
+        searching &= ~((bestBetaScore == 0.95) | (bestRecall == 0.95))
+        if not np.any(searching):
+            break
+    return finalnodes, detect_best.T
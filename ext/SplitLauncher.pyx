@@ -1,8 +1,16 @@
-cdef extern from "SplitWav.h":
+cdef extern from "SplitWav.h" nogil:
 		int split(char *infilearg, char *outfilearg, int t, int hasDt)
 		
 def launchCython(infile_c, outfile_c, cutLen, wavHasDt):
-		succ = split(infile_c, outfile_c, cutLen, wavHasDt)
+		# infile_c, outfile_c: bytes. The splitter runs without the GIL,
+		# so several files can be split in parallel threads.
+		cdef char *cin = infile_c
+		cdef char *cout = outfile_c
+		cdef int ct = cutLen
+		cdef int chasdt = wavHasDt
+		cdef int succ
+		with nogil:
+			succ = split(cin, cout, ct, chasdt)
 		return(succ)
 
 
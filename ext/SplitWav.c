@@ -61,7 +61,8 @@ int strptime2(char *s, char *format, struct tm *temp){
 
 int split(char *infilearg, char *outfilearg, int t, int hasDt){
         // parse arguments
-        FILE *infile, *outfile;
+        FILE *infile = NULL, *outfile;
+        char *linebuf = NULL;
 		
         // for you non-win people, just use this instead:
 		// char outfilestem[strlen(outfilearg)], outfilename[strlen(outfilearg)+5];
@@ -69,7 +70,7 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
 		char *outfilename = malloc(sizeof(char) * (strlen(outfilearg)+5));
 		if(outfilestem==NULL || outfilename==NULL){
 			fprintf(stderr, "ERROR: could not allocate memory for arguments\n");
-			exit(1);
+			goto fail;
 		}
 
         /*if(argc != 4){
@@ -79,13 +80,13 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
         infile = fopen(infilearg, "rb");
         if(infile == NULL){
                 fprintf(stderr, "ERROR: couldn't open input file\n");
-                exit(1);
+                goto fail;
         }
 
         // int t = atoi(cutlen);
         if(t<1 || t>36000){
                 fprintf(stderr, "ERROR: time must be between 1 s and 10 h\n");
-                exit(1);
+                goto fail;
         }
 
         // read header in two parts:
@@ -97,7 +98,7 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
         // RIFF chunk
         if(header.ChunkSize<1000 || header.ChunkID!=1179011410){
                 fprintf(stderr, "ERROR: file empty or header malformed\n");
-                exit(1);
+                goto fail;
         }
         if(header.Subchunk1Size>16){
                 printf("%d extra format bytes found, skipping\n", header.Subchunk1Size-16);
@@ -123,7 +124,7 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
                 csafecount++;
                 if (csafecount>20){
                         fprintf(stderr, "ERROR: unexpectedly many chunks found, probably misaligned WAV\n");
-                        exit(1);
+                        goto fail;
                 }
         }
         printf("Subchunk2ID %u\n", header2.Subchunk2ID); // should be 1635017060 for data
@@ -145,10 +146,10 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
 		
         // for Win compatibility:
         // char linebuf[BUFSIZE];
-	char *linebuf = malloc(sizeof(char) * BUFSIZE);
+	linebuf = malloc(sizeof(char) * BUFSIZE);
 	if(linebuf==NULL){
 		fprintf(stderr, "ERROR: could not allocate memory for reading\n");
-		exit(1);
+		goto fail;
 	}
 		
         // parse file name		
@@ -162,7 +163,6 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
         struct tm validated_timestruc;
         char timestr[17];
 
-	setlocale(LC_ALL,"/QSYS.LIB/EN_NZ.LOCALE");
         printf("%s\n", infilearg);
 		
         // wish I had unix
@@ -205,7 +205,7 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
                 outfile = fopen(outfilename, "wb");
                 if (outfile == NULL){
                         fprintf(stderr, "ERROR: couldn't open output file\n");
-                        exit(1);
+                        goto fail;
                 }
 
                 // file opened, so read and copy second-by-second:
@@ -239,4 +239,14 @@ int split(char *infilearg, char *outfilearg, int t, int hasDt){
 		free(outfilename);
         
         return(0);
+
+        // errors return instead of exiting, as this runs inside the GUI process
+fail:
+        if(infile!=NULL){
+                fclose(infile);
+        }
+        free(linebuf);
+        free(outfilestem);
+        free(outfilename);
+        return(1);
 }
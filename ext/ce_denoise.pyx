@@ -3,32 +3,53 @@ import numpy as np
 
 import time
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
         double log(double arg)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
         double ce_getcost(double *in_array, int size, double threshold, char costfn, int step)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
+        double ce_getcost_f(float *in_array, int size, double threshold, char costfn, int step)
+
+cdef extern from "ce_functions.h" nogil:
         double ce_thresnode(double *in_array, double *out_array, int size, double threshold, char type)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
         int ce_thresnode2(double *in_array, int size, double threshold, int type)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
+        int ce_thresnode2_f(float *in_array, int size, double threshold, int type)
+
+cdef extern from "ce_functions.h" nogil:
         int ce_thresnode2_block(double *in_array, int size, int blocklen, double *threshold, int type)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
+        int ce_thresnode2_block_f(float *in_array, int size, int blocklen, double *threshold, int type)
+
+cdef extern from "ce_functions.h" nogil:
         void ce_energycurve(double *arrE, double *arrC, int N, int M)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
+        void ce_energycurve_f(float *arrE, float *arrC, int N, int M)
+
+cdef extern from "ce_functions.h" nogil:
         void ce_sumsquares(double *arr, const size_t arrs, const int W, double *besttau, const double thr)
 
-cdef extern from "ce_functions.h":
+cdef extern from "ce_functions.h" nogil:
         int upsampling_convolution_valid_sf(const double * const input, const size_t N,
                 const double * const filter, const size_t F,
                 double * const output, const size_t O)
 
+cdef extern from "ce_functions.h" nogil:
+        int upsampling_convolution_valid_sf_f(const float * const input, const size_t N,
+                const float * const filter, const size_t F,
+                float * const output, const size_t O)
+
+# The C functions are re-entrant and run without the GIL, so the wrappers below
+# can be used in parallel threads (e.g. over nodes in WaveletSegment.detectCalls).
+# Arrays passed to them must not be modified by other threads meanwhile.
+
 
 # Simplified caller to the cost calculator. Useful for testing purposes
 def JustCost(np.ndarray array, threshold, costfn):
@@ -46,35 +67,57 @@ def JustCost(np.ndarray array, threshold, costfn):
          return(cost)
 
 
-def BestTree2(wp,threshold,costfn='threshold'):
+def BestTree2(wp,threshold,costfn='threshold',fullnodes=None):
         """ Compute the best wavelet tree using one of three cost functions: threshold, entropy, or SURE.
         Scores each node and uses those scores to identify new leaves of the tree by working up the tree.
         Returns the list of new leaves of the tree.
 
         This version works on our custom WPs (ndarrays), not pywt trees.
+        Nodes can be float64 or float32.
+        fullnodes - None if all nodes are stored before downsampling, otherwise
+        the set of such nodes (all others are already downsampled, see WF.WaveletPacket).
         """
         nnodes = len(wp)
         cost = np.zeros(nnodes)
         count = 0
-        step = 1
+        cdef int step = 1
+        cdef double cthr = threshold
+        cdef double c
+        cdef size_t length
+        cdef double *pd
+        cdef float *pf
+        cdef char cfn
+        if costfn == 'threshold':
+                # Thr cost is +1 for each WC that exceeds t
+                cfn = ord('t')
+        elif costfn == 'entropy':
+                # Entr cost is -p*logp
+                cfn = ord('e')
+        else:
+                cfn = ord('*')
         opstartingtime = time.time()
 
-        # Get costs. Thr cost is +1 for each WC that exceeds t, Entr cost is -p*logp
+        # Get costs
         for n in range(nnodes):
-                node = wp[n]
-                if node.dtype != 'float64':
+                node = np.ascontiguousarray(wp[n])
+                if node.dtype != 'float64' and node.dtype != 'float32':
                         node = node.astype('float64')
                 # downsample non-root nodes to keep compatible w/ pywt WCs:
                 if n!=0:
-                        step = 2
-                if costfn == 'threshold':
-                        # Threshold
-                        cost[count] = ce_getcost(<double*> np.PyArray_DATA(node), node.shape[0], threshold, 't', step)
-                elif costfn == 'entropy':
-                        # Entropy
-                        cost[count] = ce_getcost(<double*> np.PyArray_DATA(node), node.shape[0], threshold, 'e', step)
+                        if fullnodes is None or n in fullnodes:
+                                step = 2
+                        else:
+                                step = 1
+                length = node.shape[0]
+                if node.dtype == 'float32':
+                        pf = <float*> np.PyArray_DATA(node)
+                        with nogil:
+                                c = ce_getcost_f(pf, length, cthr, cfn, step)
                 else:
-                        cost[count] = ce_getcost(<double*> np.PyArray_DATA(node), node.shape[0], threshold, '*', step)
+                        pd = <double*> np.PyArray_DATA(node)
+                        with nogil:
+                                c = ce_getcost(pd, length, cthr, cfn, step)
+                cost[count] = c
 
                 count += 1
         print("Best basis selected in %.5f s" % (time.time() - opstartingtime))
@@ -138,9 +181,10 @@ def JustThreshold(self, np.ndarray indata, threshold, type):
         return indata
 
 
-def ThresholdNodes2(list oldtree, list bestleaves, threshold, str thrtype, int blocklen=0):
+def ThresholdNodes2(list oldtree, list bestleaves, threshold, str thrtype, int blocklen=0, fullnodes=None):
     """ Thresholds nodes of our ndarray-type WPs
         Uses inplace thresholding, so use with care! (i.e. arg oldtree will be overwritten)
+        Nodes can be float64 or float32, and keep their precision.
         Args:
         1. oldtree - custom WP, a list of 2^(J+1)-1 ndarrays
         2. bestleaves - list of N nodes to be thresholded
@@ -149,7 +193,16 @@ def ThresholdNodes2(list oldtree, list bestleaves, threshold, str thrtype, int b
             Otherwise if NxT ndarray, thresholding will be node- and time-specific (for each of T blocks).
             IMPORTANT: assumes that row i matches SORTED bestleaves[i]!
         4. blocklen - int, in samples. Required if threshold is NxT. T*blocklen must be greater or equal to datalength.
+        5. fullnodes - None if all nodes are stored before downsampling, otherwise
+            the set of such nodes (all others are already downsampled, see WF.WaveletPacket).
     """
+    cdef double *pd
+    cdef float *pf
+    cdef double *pthr
+    cdef double cthr
+    cdef size_t clength, cblocklen
+    cdef int ctype
+    cdef bint single
     bestleavesset = set(bestleaves)
     N = len(bestleavesset)
     if list(bestleavesset) != bestleaves:
@@ -220,35 +273,68 @@ def ThresholdNodes2(list oldtree, list bestleaves, threshold, str thrtype, int b
         if node in bestleavesset:
             # then keep & threshold (inplace)
             length = oldtree[node].shape[0]
-            oldtree[node] = np.ascontiguousarray(oldtree[node])
+            if oldtree[node].dtype == 'float32':
+                oldtree[node] = np.ascontiguousarray(oldtree[node])
+            else:
+                oldtree[node] = np.ascontiguousarray(oldtree[node], dtype=np.float64)
+            single = oldtree[node].dtype == 'float32'
             nodeix = list(bestleavesset).index(node)
+            clength = length
+            ctype = thrtype_ce
+            if single:
+                pf = <float*> np.PyArray_DATA(oldtree[node])
+            else:
+                pd = <double*> np.PyArray_DATA(oldtree[node])
             if blocklen==0:
-                ce_thresnode2(<double*> np.PyArray_DATA(oldtree[node]), length, threshold[nodeix,0], thrtype_ce)
+                cthr = threshold[nodeix,0]
+                with nogil:
+                    if single:
+                        ce_thresnode2_f(pf, clength, cthr, ctype)
+                    else:
+                        ce_thresnode2(pd, clength, cthr, ctype)
             else:
                 # adjust blocklength for the wavelet downsampling
-                # (assuming last level is not downsampled)
+                # (assuming last level is not downsampled, unless stored so)
                 if node>0:
                     nodelvl = np.floor(np.log2(node+1))
-                    blocklen_adj = blocklen // 2**(nodelvl-1)
-                thresarray = np.ascontiguousarray(threshold[nodeix,:])
-                # ce_thresnode2(<double*> np.PyArray_DATA(oldtree[node]), length, threshold[nodeix,0], thrtype_ce)
-                ce_thresnode2_block(<double*> np.PyArray_DATA(oldtree[node]), length, blocklen_adj, <double*> np.PyArray_DATA(thresarray), thrtype_ce)
+                    if fullnodes is None or node in fullnodes:
+                        blocklen_adj = blocklen // 2**(nodelvl-1)
+                    else:
+                        blocklen_adj = blocklen // 2**nodelvl
+                thresarray = np.ascontiguousarray(threshold[nodeix,:], dtype=np.float64)
+                pthr = <double*> np.PyArray_DATA(thresarray)
+                cblocklen = int(blocklen_adj)
+                with nogil:
+                    if single:
+                        ce_thresnode2_block_f(pf, clength, cblocklen, pthr, ctype)
+                    else:
+                        ce_thresnode2_block(pd, clength, cblocklen, pthr, ctype)
         else:
             # zero-out all the other nodes
             # NOT USED because current reconstruction already assumes all other nodes are 0.
-            oldtree[node] = np.zeros(len(oldtree[node]))
+            oldtree[node] = np.zeros(len(oldtree[node]), dtype=oldtree[node].dtype)
 
     # note: no useful return b/c oldtree is edited inplace.
     return 0
 
 def EnergyCurve(np.ndarray C, M):
-        assert C.dtype==np.float64
+        assert C.dtype==np.float64 or C.dtype==np.float32
         assert len(C)>2*M+1
         # Args: 1. wav data 2. M (int), expansion in samples
-        N = len(C)
-        E = np.zeros(N)
-        E[M] = np.sum(C[:2*M+1])
-        ce_energycurve(<double*> np.PyArray_DATA(E), <double*> np.PyArray_DATA(C), N, M)
+        # Output has the same precision as C
+        C = np.ascontiguousarray(C)
+        cdef size_t N = len(C)
+        cdef int cM = M
+        E = np.zeros(N, dtype=C.dtype)
+        E[M] = np.sum(C[:2*M+1], dtype=np.float64)
+        cdef void *pE = np.PyArray_DATA(E)
+        cdef void *pC = np.PyArray_DATA(C)
+        if C.dtype==np.float32:
+            with nogil:
+                ce_energycurve_f(<float*> pE, <float*> pC, N, cM)
+        else:
+            with nogil:
+                ce_energycurve(<double*> pE, <double*> pC, N, cM)
         return E
 
 def FundFreqYin(np.ndarray data, int W, double thr, double fs):
@@ -262,7 +348,10 @@ def FundFreqYin(np.ndarray data, int W, double thr, double fs):
 
         # Compute sum of squared diff (autocorrelation)
         # C code will return array of best tau for each window start
-        ce_sumsquares(<double*> np.PyArray_DATA(data), arrs, W, <double*> np.PyArray_DATA(besttau), thr)
+        cdef double *pdata = <double*> np.PyArray_DATA(data)
+        cdef double *ptau = <double*> np.PyArray_DATA(besttau)
+        with nogil:
+            ce_sumsquares(pdata, arrs, W, ptau, thr)
 
         for i in range(len(starts)):
             # -1 is an error code for no ff found / correlation too weak / numeric error
@@ -273,9 +362,18 @@ def FundFreqYin(np.ndarray data, int W, double thr, double fs):
         return pitch
 
 def reconstruct(np.ndarray data, int node, np.ndarray wv_rec_hi, np.ndarray wv_rec_lo, int lvl):
-    assert data.dtype==np.float64
-    cdef np.ndarray datau = np.zeros(2**(lvl-1) * len(data), dtype=np.float64)
-    cdef int datau_len, wv_hi_len, wv_lo_len, data_len
+    # Works in float64 or float32, following data
+    assert data.dtype==np.float64 or data.dtype==np.float32
+    cdef np.ndarray datau
+    cdef int datau_len, wv_hi_len, wv_lo_len, data_len, wv_len, c_exit_code
+    cdef void *pdata
+    cdef void *pwv
+    cdef void *pdatau
+    cdef bint single
+    dtype = data.dtype
+    single = dtype==np.float32
+    wv_rec_hi = np.ascontiguousarray(wv_rec_hi, dtype=dtype)
+    wv_rec_lo = np.ascontiguousarray(wv_rec_lo, dtype=dtype)
 
     if lvl==0:
         print("Warning: reconstruction from level 0 requested")
@@ -310,18 +408,25 @@ def reconstruct(np.ndarray data, int node, np.ndarray wv_rec_hi, np.ndarray wv_r
             datau_len = 2*data_len - wv_hi_len + 2
         else:
             datau_len = 2*data_len - wv_lo_len + 2
-        datau = np.zeros(datau_len, dtype=np.float64)
+        datau = np.zeros(datau_len, dtype=dtype)
         
         # pray to gods all arrays are C_CONTIGUOUS
         # and upsample o convolve:
         if node % 2 == 0:
-            c_exit_code = upsampling_convolution_valid_sf(<double*> np.PyArray_DATA(data), data_len,
-                <double*> np.PyArray_DATA(wv_rec_hi), wv_hi_len,
-                <double*> np.PyArray_DATA(datau), datau_len)
+            pwv = np.PyArray_DATA(wv_rec_hi)
+            wv_len = wv_hi_len
         else:
-            c_exit_code = upsampling_convolution_valid_sf(<double*> np.PyArray_DATA(data), data_len,
-                <double*> np.PyArray_DATA(wv_rec_lo), wv_lo_len,
-                <double*> np.PyArray_DATA(datau), datau_len)
+            pwv = np.PyArray_DATA(wv_rec_lo)
+            wv_len = wv_lo_len
+        pdata = np.PyArray_DATA(data)
+        pdatau = np.PyArray_DATA(datau)
+        with nogil:
+            if single:
+                c_exit_code = upsampling_convolution_valid_sf_f(<float*> pdata, data_len,
+                    <float*> pwv, wv_len, <float*> pdatau, datau_len)
+            else:
+                c_exit_code = upsampling_convolution_valid_sf(<double*> pdata, data_len,
+                    <double*> pwv, wv_len, <double*> pdatau, datau_len)
 
         if c_exit_code!=0:
             print("ERROR: Cythonized convolution failed")
@@ -3,72 +3,128 @@ import numpy as np
 
 cdef extern from "detector.h":
     int alg1_mean(double xs[], size_t n, double sd, double penalty);
-cdef extern from "detector.h":
-    int alg1_var(double xs[], size_t n, size_t maxlb, double mu0, double penalty, int outstarts[], int outends[], char outtypes[]);
-cdef extern from "detector.h":
-    int alg2_var(double xs[], size_t nn, size_t maxlb, double sigma0, double penalty_s, double penalty_n, int outstarts[], int outends[], char outtypes[], size_t printing);
+cdef extern from "detector.h" nogil:
+    ctypedef struct ChpDetector:
+        pass
+    ChpDetector *chp_new(int alg, size_t maxlb, double mu0, double sigma0, double penalty_s, double penalty_n, size_t printing, int allsub);
+    int chp_push(ChpDetector *d, double xs[], size_t n);
+    int chp_finalise(ChpDetector *d);
+    int chp_finish(ChpDetector *d);
+    size_t chp_pending(ChpDetector *d);
+    size_t chp_pop(ChpDetector *d, long outstarts[], long outends[], char outtypes[], size_t maxout);
+    void chp_free(ChpDetector *d);
+
+
+cdef class ChangepointDetector:
+    """ Online changepoint detection for change in variance.
+        Data can be pushed in pieces of any length, and each push returns the segments
+        that no further data can change. Memory use depends on maxlookback, not on the
+        length of the series, so whole files or live streams can be processed in one pass:
+        O(maxlookback) for alg 1, and O(maxlookback^2) at most for alg 2, which keeps a detector
+        with up to maxlookback candidate starts for each open nuisance (plus, if not allsub,
+        the segment choices of each detector, at most one per point of its nuisance).
+        alg - 1: signal segments on a background of tracked variance,
+              2: signal and nuisance segments on a background of variance sigma2
+        penalty - segment penalty (the launchers use 1.1*alpha*log(n) for n points)
+        allsub - alg 2 only: if True, returns all signal segments on a nuisance found by
+              backtracking its detector. Default False returns those found by the original
+              detector, which only checks every second point and so may miss some of them.
+        Segments are returned as an m x 3 array of [start, end, type] window positions,
+        with the interval [start, end), in chronological order.
+        type is ord('s') for signal, ord('n') for nuisance or ord('o') for signal on a nuisance
+        (these follow their nuisance).
+        The C detector runs without the GIL, so several detectors can run in parallel threads,
+        but one instance must only be used by one thread at a time.
+    """
+    cdef ChpDetector *det
+
+    def __cinit__(self, int alg, int maxlookback, double penalty, double sigma2=1, double mu0=0, int printing=0, bint allsub=False):
+        if maxlookback<1:
+            raise ValueError("ERROR: maxlookback must be positive")
+        self.det = chp_new(alg, maxlookback, mu0, sigma2, penalty, penalty, printing, allsub)
+        if self.det is NULL:
+            raise MemoryError("ERROR: could not create C detector")
+
+    def __dealloc__(self):
+        if self.det is not NULL:
+            chp_free(self.det)
+
+    def push(self, xs, emit=True):
+        """ Add datapoints. emit=False skips looking for final segments,
+            which saves time if finish() is called next anyway.
+        """
+        xs = np.ascontiguousarray(xs, dtype='float64')
+        cdef double *pxs = <double*> np.PyArray_DATA(xs)
+        cdef size_t n = len(xs)
+        cdef int err = 0
+        cdef bint cemit = emit
+        if n>0:
+            assert np.min(xs)>0, "ERROR: all datapoints must be strictly > 0 for variance detection"
+        with nogil:
+            if n>0:
+                err = chp_push(self.det, pxs, n)
+            if err==0 and cemit:
+                err = chp_finalise(self.det)
+        if err>0:
+            raise MemoryError("ERROR: C detector failure")
+        return self._pop()
+
+    def finish(self):
+        """ End of data: returns all remaining segments. """
+        cdef int err
+        with nogil:
+            err = chp_finish(self.det)
+        if err>0:
+            raise MemoryError("ERROR: C detector failure")
+        return self._pop()
+
+    def _pop(self):
+        cdef size_t m = chp_pending(self.det)
+        cdef np.ndarray outst = np.zeros(m, dtype='l')
+        cdef np.ndarray oute = np.zeros(m, dtype='l')
+        cdef np.ndarray outt = np.zeros(m, dtype='uint8')
+        if m>0:
+            chp_pop(self.det, <long*> np.PyArray_DATA(outst), <long*> np.PyArray_DATA(oute), <char*> np.PyArray_DATA(outt), m)
+        # NOTE: detector.c outputs 0-indexed window positions, inclusive.
+        # This conversion here makes the interval [s,e).
+        # true timestamp can be obtained simply by multiply it by window size
+        res = np.vstack((outst, oute+1, outt))
+        return(res.T)
 
 
 def launchDetector1(xs, int maxlookback, float alpha):
+    """ Detects signal segments in xs in one pass.
+        Returns an m x 3 array of [start, end, type] in chronological order
+        (before the streaming detector, these were returned in reverse order).
+    """
     xs = np.asarray(xs, dtype='float64')
     print("using %d datapoints" % len(xs))
 
-    cdef double sd = 1
     cdef int n = len(xs)
     cdef double penalty = 1.1*alpha*np.log(n)
     cdef double mu0 = 0
 
     assert np.min(xs)>0, "ERROR: all datapoints must be strictly > 0 for variance detection"
-    if n>10000:
-        print("ERROR: n=%d exceeds max permitted series size" % n)
-        return
-
-    # outputs:
-    cdef np.ndarray[int] outst = np.zeros(n, dtype=np.intc)
-    cdef np.ndarray[int] oute = np.zeros(n, dtype=np.intc)
-    cdef np.ndarray[np.uint8_t] outt = np.zeros(n, dtype='uint8')
-    succ = alg1_var(<double*> np.PyArray_DATA(xs), n, maxlookback, mu0, penalty, <int*> np.PyArray_DATA(outst), <int*> np.PyArray_DATA(oute), <char*> np.PyArray_DATA(outt))
-    if succ>0:
-        print("ERROR: C detector failure")
-        return
-    # print(outt)
-    outnum = outt.tolist().index(0)
-    # print(outnum)
-    # NOTE: detector.c outputs 0-indexed window positions, inclusive.
-    # This conversion here makes the interval [s,e).
-    # true timestamp can be obtained simply by multiply it by window size
-    res = np.vstack((outst[:outnum], oute[:outnum]+1, outt[:outnum]))
-    return(res.T)
+
+    det = ChangepointDetector(1, maxlookback, penalty, mu0=mu0, printing=1)
+    det.push(xs, emit=False)
+    return det.finish()
 
 def launchDetector2(xs, float sigma2, int maxlookback, float alpha, int printing=1):
+    """ Detects signal and nuisance segments in xs in one pass.
+        Returns an m x 3 array of [start, end, type] in chronological order, with the
+        signal segments on each nuisance ('o') right after it, also in chronological order
+        (before the streaming detector, all of these were returned in reverse order).
+    """
     # printing=1 means that more details will be printed, 0="silent"
     xs = np.asarray(xs, dtype='float64')
     print("using %d datapoints" % len(xs))
 
-    # Type conversion, not sure if needed
-    cdef double csigma2 = sigma2
     cdef int n = len(xs)
     cdef double penalty = 1.1*alpha*np.log(n)
 
     assert np.min(xs)>0, "ERROR: all datapoints must be strictly > 0 for variance detection"
-    if n>10000:
-        print("ERROR: n=%d exceeds max permitted series size" % n)
-        return
-
-    # outputs:
-    cdef np.ndarray[int] outst = np.zeros(n, dtype=np.intc)
-    cdef np.ndarray[int] oute = np.zeros(n, dtype=np.intc)
-    cdef np.ndarray[np.uint8_t] outt = np.zeros(n, dtype='uint8')
-    succ = alg2_var(<double*> np.PyArray_DATA(xs), n, maxlookback, csigma2, penalty, penalty, <int*> np.PyArray_DATA(outst), <int*> np.PyArray_DATA(oute), <char*> np.PyArray_DATA(outt), printing)
-    if succ>0:
-        print("ERROR: C detector failure")
-        return
-    # print(outst)
-    # print(oute)
-    # print(outt)
-    outnum = outt.tolist().index(0)
-    # NOTE: detector.c outputs 0-indexed window positions, inclusive.
-    # This conversion here makes the interval [s,e).
-    # true timestamp can be obtained simply by multiply it by window size
-    res = np.vstack((outst[:outnum], oute[:outnum]+1, outt[:outnum]))
-    return(res.T)
+
+    det = ChangepointDetector(2, maxlookback, penalty, sigma2=sigma2, printing=printing)
+    det.push(xs, emit=False)
+    return det.finish()
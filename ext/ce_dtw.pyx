@@ -0,0 +1,111 @@
+cimport numpy as np
+import numpy as np
+
+cdef extern from "dtw.h":
+    double dtw_dist(double x[], size_t n, double y[], size_t m, size_t d, long band, double maxcost);
+cdef extern from "dtw.h":
+    int dtw_matrix(double x[], size_t n, double y[], size_t m, size_t d, long band, double D[]);
+cdef extern from "dtw.h":
+    int dtw_envelope(double y[], size_t m, size_t n, size_t d, long band, double upper[], double lower[]);
+cdef extern from "dtw.h":
+    double dtw_lbkeogh(double x[], size_t n, size_t d, double upper[], double lower[], double maxcost);
+cdef extern from "dtw.h":
+    int dtw_offsets(double q[], size_t n, double data[], size_t N, size_t d, long band, double maxcost, double out[]);
+cdef extern from "dtw.h":
+    int dtw_subsequence(double q[], size_t n, double data[], size_t N, size_t d, double outcost[], long outstart[]);
+
+# Dynamic time warping.
+# All series are 1D arrays, or 2D arrays of frames x features (i.e. time along the first axis;
+# transpose librosa-style features x frames matrices).
+# band is the Sakoe-Chiba radius in frames around the (rescaled) diagonal, None for no constraint.
+
+
+def _frames(x):
+    x = np.ascontiguousarray(x, dtype='float64')
+    if x.ndim == 1:
+        x = x[:, np.newaxis]
+    return x
+
+def _pair(x, y):
+    x = _frames(x)
+    y = _frames(y)
+    if x.shape[1] != y.shape[1]:
+        raise ValueError("ERROR: DTW series have different numbers of features (%d, %d)" % (x.shape[1], y.shape[1]))
+    return x, y
+
+def _band(band):
+    if band is None:
+        return -1
+    return int(band)
+
+
+def DTW(x, y, band=None, double maxcost=np.inf):
+    """ DTW distance between x and y.
+        maxcost - distances above it are returned as np.inf. The calculation is abandoned
+        as soon as that is certain, and LB_Keogh is checked before it starts.
+    """
+    x, y = _pair(x, y)
+    cdef long cband = _band(band)
+    if len(x)==0 or len(y)==0:
+        return np.inf
+    cdef np.ndarray[np.float64_t, ndim=2] upper
+    cdef np.ndarray[np.float64_t, ndim=2] lower
+    if np.isfinite(maxcost):
+        upper = np.empty_like(x)
+        lower = np.empty_like(x)
+        if dtw_envelope(<double*> np.PyArray_DATA(y), len(y), len(x), x.shape[1], cband, <double*> np.PyArray_DATA(upper), <double*> np.PyArray_DATA(lower))>0:
+            raise MemoryError("ERROR: C DTW failure")
+        if dtw_lbkeogh(<double*> np.PyArray_DATA(x), len(x), x.shape[1], <double*> np.PyArray_DATA(upper), <double*> np.PyArray_DATA(lower), maxcost) > maxcost:
+            return np.inf
+    d = dtw_dist(<double*> np.PyArray_DATA(x), len(x), <double*> np.PyArray_DATA(y), len(y), x.shape[1], cband, maxcost)
+    if np.isnan(d):
+        raise MemoryError("ERROR: C DTW failure")
+    return d
+
+def DTWMatrix(x, y, band=None):
+    """ Accumulated cost matrix of shape (len(x)+1, len(y)+1),
+        with an infinite first row and column (D[0,0]=0) and infinite cells outside the band.
+        The distance is D[-1,-1].
+    """
+    x, y = _pair(x, y)
+    cdef np.ndarray[np.float64_t, ndim=2] D = np.empty((len(x)+1, len(y)+1))
+    dtw_matrix(<double*> np.PyArray_DATA(x), len(x), <double*> np.PyArray_DATA(y), len(y), x.shape[1], _band(band), <double*> np.PyArray_DATA(D))
+    return D
+
+def LBKeogh(x, y, band=None):
+    """ LB_Keogh lower bound of DTW(x, y, band) """
+    x, y = _pair(x, y)
+    if len(x)==0 or len(y)==0:
+        return np.inf
+    cdef np.ndarray[np.float64_t, ndim=2] upper = np.empty_like(x)
+    cdef np.ndarray[np.float64_t, ndim=2] lower = np.empty_like(x)
+    if dtw_envelope(<double*> np.PyArray_DATA(y), len(y), len(x), x.shape[1], _band(band), <double*> np.PyArray_DATA(upper), <double*> np.PyArray_DATA(lower))>0:
+        raise MemoryError("ERROR: C DTW failure")
+    return dtw_lbkeogh(<double*> np.PyArray_DATA(x), len(x), x.shape[1], <double*> np.PyArray_DATA(upper), <double*> np.PyArray_DATA(lower), np.inf)
+
+def DTWOffsets(q, data, band=None, double maxcost=np.inf):
+    """ DTW distance between q and data[i:i+len(q)] at every offset i.
+        With a finite maxcost, distances above it are np.inf,
+        and most windows are rejected by LB_Keogh without running the DTW.
+    """
+    q, data = _pair(q, data)
+    cdef np.ndarray[np.float64_t] out = np.full(len(data), np.inf)
+    if len(q)==0:
+        return out
+    if dtw_offsets(<double*> np.PyArray_DATA(q), len(q), <double*> np.PyArray_DATA(data), len(data), q.shape[1], _band(band), maxcost, <double*> np.PyArray_DATA(out))>0:
+        raise MemoryError("ERROR: C DTW failure")
+    return out
+
+def SubsequenceDTW(q, data):
+    """ Subsequence DTW search of q in data: the match can start and end anywhere in data.
+        Returns two arrays of length len(data): the cost of the best match ending at each frame,
+        and the frame where that match starts.
+    """
+    q, data = _pair(q, data)
+    cdef np.ndarray[np.float64_t] cost = np.full(len(data), np.inf)
+    cdef np.ndarray start = np.zeros(len(data), dtype='l')
+    if len(q)==0 or len(data)==0:
+        return cost, start
+    if dtw_subsequence(<double*> np.PyArray_DATA(q), len(q), <double*> np.PyArray_DATA(data), len(data), q.shape[1], <double*> np.PyArray_DATA(cost), <long*> np.PyArray_DATA(start))>0:
+        raise MemoryError("ERROR: C DTW failure")
+    return cost, start
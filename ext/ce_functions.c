@@ -40,6 +40,41 @@ double ce_getcost(double *in, size_t size, double threshold, char costfn, int st
 	return cost;
 }
 
+// Same as ce_getcost, for single precision nodes
+double ce_getcost_f(float *in, size_t size, double threshold, char costfn, int step)
+{
+	double cost=0.0;
+	if(costfn=='t'){
+		// Threshold
+		for(size_t i=0; i<size; i+=step){
+			if(fabs(in[i]) > threshold){
+				cost++;
+			}
+		}
+	} else if(costfn=='e'){
+		// Entropy
+		for(size_t i=0; i<size; i+=step){
+			if(in[i]!=0){
+				double in2 = (double)in[i] * in[i];
+				cost -= in2 * log(in2);
+			}
+		}
+	} else {
+		// SURE
+		for(size_t i=0; i<size; i+=step){
+			double in2 = (double)in[i] * in[i];
+			if(in2 <= threshold*threshold){
+				cost += in2;
+			} else {
+				cost += threshold*threshold + 2;
+			}
+		}
+		cost -= size;
+	}
+
+	return cost;
+}
+
 // Threshold a node in a wp tree and put output in a new wp tree
 void ce_thresnode(double *in_array, double *out_array, size_t size, double threshold, char type)
 {
@@ -98,6 +133,35 @@ int ce_thresnode2(double *in_array, size_t size, double threshold, int type)
 	}
 }
 
+// Same as ce_thresnode2, for single precision nodes
+int ce_thresnode2_f(float *in_array, size_t size, double threshold, int type)
+{
+	if(type==2){
+		// Hard thresholding
+		for(size_t i=0; i<size; i++){
+			if(fabs(in_array[i]) < threshold){
+				in_array[i] = 0.0f;
+			}
+		}
+		return 0;
+	} else if(type==1){
+		// Soft thresholding
+		for(size_t i=0; i<size; i++){
+			double tmp = fabs(in_array[i]) - threshold;
+			if(tmp<0){
+				in_array[i] = 0.0f;
+			} else if(in_array[i]<0){
+				in_array[i] = -tmp;
+			} else {
+				in_array[i] = tmp;
+			}
+		}
+		return 0;
+	} else {
+		return -1;
+	}
+}
+
 // Block-threshold a node in a wp tree, in place
 // using thresholds from the threshold array in pieces of blocklen samples
 int ce_thresnode2_block(double *in_array, size_t datalen, size_t blocklen, double *threshold, int type)
@@ -138,6 +202,41 @@ int ce_thresnode2_block(double *in_array, size_t datalen, size_t blocklen, doubl
 	}
 }
 
+// Same as ce_thresnode2_block, for single precision nodes
+int ce_thresnode2_block_f(float *in_array, size_t datalen, size_t blocklen, double *threshold, int type)
+{
+	if(type==2){
+		// Hard thresholding
+		for(size_t bi=0; bi*blocklen<datalen; bi++){
+			size_t endi = (bi+1)*blocklen>datalen ? datalen : (bi+1)*blocklen;
+			for(size_t i=bi*blocklen; i<endi; i++){
+				if(fabs(in_array[i]) < threshold[bi]){
+					in_array[i] = 0.0f;
+				}
+			}
+		}
+		return 0;
+	} else if(type==1){
+		// Soft thresholding
+		for(size_t bi=0; bi*blocklen<datalen; bi++){
+			size_t endi = (bi+1)*blocklen>datalen ? datalen : (bi+1)*blocklen;
+			for(size_t i=bi*blocklen; i<endi; i++){
+				double tmp = fabs(in_array[i]) - threshold[bi];
+				if(tmp<0){
+					in_array[i] = 0.0f;
+				} else if(in_array[i]<0){
+					in_array[i] = -tmp;
+				} else {
+					in_array[i] = tmp;
+				}
+			}
+		}
+		return 0;
+	} else {
+		return -1;
+	}
+}
+
 // Main loop for "energy curve" - expanding envelope around waveform
 void ce_energycurve(double *arrE, double *arrC, size_t N, int M)
 {
@@ -150,6 +249,21 @@ void ce_energycurve(double *arrE, double *arrC, size_t N, int M)
 	}
 }
 
+// Same as ce_energycurve, for single precision data.
+// The running sum is kept in double, as it would drift over long pages otherwise
+void ce_energycurve_f(float *arrE, float *arrC, size_t N, int M)
+{
+	double e = arrE[M];
+	for(size_t i=M+1; i<N-M; i++){
+		e = e - arrC[i - M - 1] + arrC[i + M];
+		arrE[i] = e;
+	}
+	// Normalize for M
+	for(size_t i=0; i<N; i++){
+		arrE[i] = arrE[i] / (2 * M);
+	}
+}
+
 // Sum-of-squared differences loop for Yin's fund. freq. calculation
 // Args: input audiodata, its size, window size, output array, threshold for accepting fund freq
 void ce_sumsquares(double *arr, const size_t arrs, const int W, double *besttau, const double thr){
@@ -161,6 +275,13 @@ void ce_sumsquares(double *arr, const size_t arrs, const int W, double *besttau,
 	// double out[W];
 	double *out = malloc(sizeof(double) * W);
 	double *partial = malloc(sizeof(double) * W);
+	if(out==NULL || partial==NULL){
+		// besttau is left at -1 (no ff found)
+		printf("ERROR: could not allocate memory for Yin\n");
+		free(out);
+		free(partial);
+		return;
+	}
 
 	// start positions shift by half a window.
 	// Hence, we can precalculate and re-use half of the internal stuff.
@@ -292,3 +413,30 @@ int upsampling_convolution_valid_sf(const double * const input, const size_t N,
 	}
 	return 0;
 }
+
+// Same as upsampling_convolution_valid_sf, for single precision data
+// (sums are accumulated in double)
+int upsampling_convolution_valid_sf_f(const float * const input, const size_t N,
+		const float * const filter, const size_t F,
+		float * const output, const size_t O){
+
+	size_t o, i;
+
+	if(O != 2*N-F+2)
+		return -1;
+	if((F%2) || (N < F/2))
+		return -1;
+
+	for(o = 0, i = F/2 - 1; i < N; ++i, o += 2){
+		double sum_even = 0;
+		double sum_odd = 0;
+		size_t j;
+		for(j = 0; j < F/2; ++j){
+			sum_even += (double)filter[j*2] * input[i-j];
+			sum_odd += (double)filter[j*2+1] * input[i-j];
+		}
+		output[o] += sum_even;
+		output[o+1] += sum_odd;
+	}
+	return 0;
+}
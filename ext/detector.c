@@ -1,6 +1,7 @@
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include "detector.h"
 
 #define LOG2PI 1.8378770664093453
@@ -45,16 +46,6 @@ double cost0var(const double x2, const double s2t){
     return log(s2t) + x2/s2t;
 }
 
-double estsigma(const double x2s[], const size_t first, const size_t last){
-    double sigma = 0;
-    for(size_t j=first; j<=last; j++){
-        sigma += x2s[j];
-    }
-    sigma /= last-first+1;
-    sigma = sqrt(sigma);
-    return sigma;
-}
-
 
 // double cost1var(const double x2s[], const size_t len){
 //     return len*(LOG2PI + 1 + log(var(x2s)));
@@ -74,145 +65,6 @@ void findmincost(const double cs[], const double Fs[], const size_t starts[], co
 }
 
 
-// main loop over data - for change in VARIANCE
-int alg1_var(double xs[], const size_t n, const size_t maxlb, const double mu0, const double penalty, int outstarts[], int outends[], char outtypes[]){
-    // center and square x
-    double *x2s  = malloc(n * sizeof(double));
-    for(size_t i=0; i<n; i++){
-        xs[i] = (xs[i]-mu0);
-        x2s[i] = xs[i]*xs[i];
-    }
-    // precompute segment costs
-    // TODO add an initialization marker to spot cache misses
-    double *cs = malloc(n * sizeof(double));
-    double len;
-    double m2;
-
-    // output: estimate sequence
-    double *wts = malloc(n * sizeof(double));
-    wts[0] = x2s[0];
-
-    // output: segments (list of starts and ends)
-    // Could replace with two bare size_t[]
-    struct ChpList *chps = malloc(n * sizeof(struct ChpList));
-
-    // output: history of best costs
-    double *F = malloc(n * sizeof(double));
-    F[0] = 0;
-
-    // acceptable start positions to keep track of pruning
-    size_t *possiblestarts = malloc(n * sizeof(size_t));
-    possiblestarts[0] = 0;
-    for(size_t i=1; i<n-1; i++){
-        possiblestarts[i] = 0;
-    }
-    size_t numpossiblestarts = 1;
-    size_t minstart = 0;
-
-    // main DP loop:
-    double bgcost;
-    double *segcosts = malloc(n * sizeof(double));
-    size_t *bgsizes = malloc(n * sizeof(size_t));
-    bgsizes[0] = 1;
-    for(size_t t=1; t<n; t++){
-        // printf("----Cycle %zu/%zu----\n", t+1, n);
-        // precompute costs for all possible segments ending here at t
-        m2 = 0;
-        for(size_t start=t; start>minstart; start--){
-            // m += xs[start];
-            m2 += x2s[start];
-            len = t-start+1;
-            // SSE = Var(x_i) * n
-            cs[start] = len*(1 + log(m2/len));
-        }
-        // Could be good to check if any of the costs are -Inf given that logs are involved.
-
-        // F_B = F(t-1) + C0(t)
-        bgcost = F[t-1] + cost0var(x2s[t], wts[t-1]);
-
-        // F_S = min F(t-k) + C(t-k+1:t) + beta
-        double bestsegcost = INFINITY;
-        size_t bestsegstart;
-        findmincost(cs, F, possiblestarts, numpossiblestarts, &bestsegcost, &bestsegstart, segcosts);
-        // printf("bgcost: %.2f, segcost: %.2f + %.2f at t=%zu\n", bgcost, bestsegcost, penalty, bestsegstart+1);
-
-        // determine best F = min(F_B, F_S)
-        bestsegcost += penalty;
-        if(bgcost < bestsegcost){
-            // update cost
-            F[t] = bgcost;
-            // update wt
-            bgsizes[t] = bgsizes[t-1]+1;
-            wts[t] = wts[t-1] - (wts[t-1] - x2s[t])/bgsizes[t];
-            // to avoid storing a lot of dynamically growing chp lists,
-            // just store a pointer to the last list, plus at most one new chp pair
-            // using 0 to indicate "not a chp", as the 0-th point is auto-set to background
-            chps[t].start = 0;
-            // chps[t].end = 0;
-        } else {
-            // update cost
-            F[t] = bestsegcost;
-            // reset wt to wt[beststart]
-            bgsizes[t] = bgsizes[bestsegstart];
-            wts[t] = wts[bestsegstart];
-            // store a pointer to the last list, plus at most one new chp pair - don't think this is needed
-            // attach the new chp pair
-            chps[t].start = bestsegstart+1;
-            // chps[t].end = t;
-            // printf("! Ch.p. detected at %zu-%zu\n", bestsegstart+1, t);
-        }
-
-        // update and prune possible segment starts
-        minstart = t; // useful for reducing the set for cost precomputing
-        for(size_t i=0; i<numpossiblestarts; i++){
-            if(F[t] <= segcosts[possiblestarts[i]]){
-                // prune out this start time
-                possiblestarts[i] = possiblestarts[--numpossiblestarts];
-            }
-            if(possiblestarts[i]<minstart){
-                minstart = possiblestarts[i];
-            }
-        }
-        possiblestarts[numpossiblestarts++] = t;
-        // printf("Current wt: %f, F(t): %.2f\n", wts[t], F[t]);
-    }
-    printf("Final cost: %.2f, final wt: %.4f\n", F[n-1], wts[n-1]);
-    free(x2s);
-    free(cs);
-    free(wts);
-    free(F);
-    free(possiblestarts);
-    free(segcosts);
-    free(bgsizes);
-
-    // extract changepoints
-    size_t i = n-1;
-    size_t outnum = 0;
-    printf("Detected segments:\n");
-    while(i>0){
-        if(chps[i].start>0){
-            // no need to store chp end separately, as i is exactly that
-            printf("* %zu-%zu\n", chps[i].start, i);
-            outstarts[outnum] = chps[i].start;
-            outends[outnum] = i;
-            // no need to store the type since it can be recreated from length
-            char thischptype = i-chps[i].start<=maxlb ? 's' : 'n';
-            outtypes[outnum] = thischptype;
-            outnum++;
-            if(chps[i].start - 1 >= i){
-                printf("ERROR: potential infinite recursion in changepoints\n");
-                return 1;
-            }
-            i = chps[i].start - 1;
-        } else {
-            i--;
-        }
-    }
-    free(chps);
-    return 0;
-}
-
-
 // main loop over data - for change in MEAN
 int alg1_mean(double xs[], const size_t n, const double sd, const double penalty){
     // standardize x
@@ -342,354 +194,861 @@ int alg1_mean(double xs[], const size_t n, const double sd, const double penalty
     return 0;
 }
 
+// Online detectors for change in VARIANCE.
+// The data can be pushed in pieces of any length, and the memory used does not
+// grow with the length of the series: instead of arrays of costs and changepoints
+// over all points, each candidate segment start keeps a record of the values needed
+// from that point, and segmentations are linked lists of segments (newest first),
+// shared between the candidates. Segments are returned as soon as they are in every
+// candidate segmentation, i.e. no future data can change them.
+// alg 1: signal segments on a background of tracked variance
+//        (segments longer than maxlb are marked as nuisance),
+// alg 2: signal and nuisance segments on a background of variance sigma0, with a
+//        detector for signal on each candidate nuisance. Needs O(maxlb^2) memory
+//        at most, as nuisances of length up to maxlb (burn-ins) are not pruned.
+//        The signal segments on a final nuisance are found either by full backtracking
+//        of its detector (allsub), or as in the original batch detector, which checks
+//        every second point only. For the latter, each detector also keeps a history
+//        of its segment choices, i.e. one record per signal segment candidate.
+
+// history of the segment choices of a nuisance detector, ordered by end
+struct Hist {
+    size_t refs;
+    size_t num;
+    size_t cap;
+    size_t *starts;
+    size_t *ends;
+    double *thetas;
+};
 
-int alg2_var(double xs[], const size_t nn, const size_t maxlb, const double sigma0, const double penalty_s, const double penalty_n, int outstarts[], int outends[], char outtypes[], const size_t printing){
-    // xs, nn: centered data (nn points)
-    // sigma0: sigma^2_0, given
-    // output: segments (list of starts and ends and types)
-    struct ChpList *chps = malloc(nn * sizeof(struct ChpList));
+struct Seg {
+    size_t start;
+    size_t end;       // inclusive
+    char type;        // 's', 'n' or 'o' (signal on nuisance)
+    double theta;     // sigma estimated over the segment, for printing
+    struct Seg *prev; // previous segment in this segmentation
+    struct Seg *sub;  // signal segments on this nuisance
+    struct Hist *hist;// or the history of its detector, up to histnum choices (if not allsub)
+    size_t histnum;
+    size_t refs;
+    size_t epoch;     // for counting the segmentations that contain this segment
+    size_t visits;
+    int emitted;
+};
+
+struct Det;
+
+struct Start {
+    size_t t;         // the segment would start at t+1
+    double F;         // best cost up to t
+    double wt;        // background variance estimate at t
+    size_t bgsize;    // number of points in that estimate
+    double segcost;   // F + cost of the segment t+1 to now
+    double m2;        // alg 1: sum of x^2 from t+1 to now
+    double cumx2;     // alg 2 nuisances: sum of x^2 from 0 to t
+    struct Seg *segs; // best segmentation up to t
+    struct Det *det;  // alg 2 nuisances: detector for signal on this nuisance
+};
 
-    // square x
-    double *x2s = malloc(nn * sizeof(double));
-    for(size_t i=0; i<nn; i++){
-        x2s[i] = xs[i]*xs[i];
+struct StartList {
+    struct Start *recs;
+    size_t num;
+    size_t cap;
+};
+
+// detector for signal on a nuisance, started at the first point of that nuisance
+struct Det {
+    double F;
+    double wt;
+    size_t bgsize;
+    struct Seg *segs;
+    struct StartList starts;
+    struct Hist *hist;
+};
+
+struct SegOut {
+    size_t start;
+    size_t end;
+    char type;
+    double theta;
+};
+
+struct ChpDetector {
+    int alg;
+    size_t maxlb;
+    double mu0;
+    double sigma0;
+    double penalty_s;
+    double penalty_n;
+    size_t printing;
+    int allsub;
+    // state at the last point
+    size_t n;
+    double F;
+    double wt;
+    size_t bgsize;
+    double cumx2;
+    struct Seg *segs;
+    // possible signal and (alg 2) nuisance segment starts
+    struct StartList starts;
+    struct StartList nuis;
+    // alg 2: x^2 of the last maxlb points (ring buffer),
+    // and costs and variances of segments ending at the last point, indexed by end-start
+    double *x2r;
+    double *cs;
+    double *vars;
+    // finalised segments, waiting to be popped
+    size_t epoch;
+    struct SegOut *out;
+    size_t outfirst;
+    size_t outnum;
+    size_t outcap;
+    size_t outtotal;
+    int finished;
+};
+
+static struct Hist *hist_new(void){
+    struct Hist *h = calloc(1, sizeof(struct Hist));
+    if(!h){
+        printf("ERROR: could not allocate memory for a detector history\n");
+        return NULL;
     }
+    h->refs = 1;
+    return h;
+}
 
-    double *F  = malloc(nn * sizeof(double));
-    F[0] = 0;
+static struct Hist *hist_ref(struct Hist *h){
+    if(h){
+        h->refs++;
+    }
+    return h;
+}
 
-    // arrays of outputs and parameters for each detector
-    // each detector gets a slice of nn elements starting from i*nn
-    double *detwts = malloc(nn * nn * sizeof(double));
-    double *detFs = malloc(nn * nn * sizeof(double));
-    double *detsegcosts = malloc(nn * nn * sizeof(double));
-    size_t *detbgsizes = malloc(nn * nn * sizeof(size_t));
-    size_t *detpostarts = malloc(nn * nn * sizeof(size_t));
-    if(!detpostarts || !detbgsizes || !detsegcosts || !detFs || !detwts){
-        printf("ERROR: could not allocate memory of size %zu x %zu x %zu bytes\n", nn, nn, sizeof(double));
-        return 1;
+static void hist_release(struct Hist *h){
+    if(h && --h->refs==0){
+        free(h->starts);
+        free(h->ends);
+        free(h->thetas);
+        free(h);
     }
-    struct ChpList *detchps = malloc(nn * nn * sizeof(struct ChpList));
-    if(!detchps){
-        printf("ERROR: could not allocate memory of size %zu x %zu x %zu bytes\n", nn, nn, sizeof(struct ChpList));
-        return 1;
+}
+
+static int hist_add(struct Hist *h, const size_t start, const size_t end, const double theta){
+    if(h->num==h->cap){
+        size_t cap = h->cap>0 ? 2*h->cap : 16;
+        size_t *starts = realloc(h->starts, cap * sizeof(size_t));
+        if(starts){
+            h->starts = starts;
+        }
+        size_t *ends = realloc(h->ends, cap * sizeof(size_t));
+        if(ends){
+            h->ends = ends;
+        }
+        double *thetas = realloc(h->thetas, cap * sizeof(double));
+        if(thetas){
+            h->thetas = thetas;
+        }
+        if(!starts || !ends || !thetas){
+            printf("ERROR: could not allocate memory for a detector history of %zu\n", cap);
+            return 1;
+        }
+        h->cap = cap;
     }
-    for(size_t i=0; i<nn*nn; i++){
-        detpostarts[i] = 0;
-        detwts[i] = 9999; // cache miss marker. Could remove later
+    h->starts[h->num] = start;
+    h->ends[h->num] = end;
+    h->thetas[h->num] = theta;
+    h->num++;
+    return 0;
+}
+
+static struct Seg *seg_ref(struct Seg *s){
+    if(s){
+        s->refs++;
     }
-    for(size_t i=0; i<nn; i++){
-        detwts[i*nn + i] = x2s[i];
-        detFs[i*nn + i] = 1 + log(x2s[i]);
-        detbgsizes[i*nn + i] = 1;
+    return s;
+}
+
+static void seg_release(struct Seg *s){
+    // iterative, as segmentation lists can be long
+    while(s && --s->refs==0){
+        struct Seg *prev = s->prev;
+        // (signal on nuisance segments have no sub lists, so this recurses once at most)
+        seg_release(s->sub);
+        hist_release(s->hist);
+        free(s);
+        s = prev;
     }
+}
 
-    // other detector-specific values
-    size_t *detnumpostarts = malloc(nn * sizeof(size_t));
-    for(size_t i=0; i<nn; i++){
-        detnumpostarts[i] = 0;
+static struct Seg *seg_new(const size_t start, const size_t end, const char type, const double theta, struct Seg *prev, struct Seg *sub){
+    struct Seg *s = malloc(sizeof(struct Seg));
+    if(!s){
+        printf("ERROR: could not allocate memory for a segment\n");
+        return NULL;
     }
+    s->start = start;
+    s->end = end;
+    s->type = type;
+    s->theta = theta;
+    s->prev = seg_ref(prev);
+    s->sub = seg_ref(sub);
+    s->hist = NULL;
+    s->histnum = 0;
+    s->refs = 1;
+    s->epoch = 0;
+    s->visits = 0;
+    s->emitted = 0;
+    return s;
+}
 
-    // for precomputing costs
-    double m2;
-    double len;
-    double *cs = malloc(nn * sizeof(double));
-    double *vars = malloc(nn * sizeof(double));
+static void det_free(struct Det *det);
 
-    // acceptable start positions (for S) to keep track of pruning
-    size_t *possiblestarts = malloc(nn * sizeof(size_t));
-    possiblestarts[0] = 0;
-    for(size_t i=1; i<nn-1; i++){
-        possiblestarts[i] = 0;
+static void sl_remove(struct StartList *l, const size_t i){
+    seg_release(l->recs[i].segs);
+    det_free(l->recs[i].det);
+    l->recs[i] = l->recs[--l->num];
+}
+
+static void sl_clear(struct StartList *l){
+    while(l->num>0){
+        sl_remove(l, l->num-1);
     }
-    size_t numpossiblestarts = 1;
+    free(l->recs);
+    l->recs = NULL;
+    l->cap = 0;
+}
 
-    // acceptable start positions (for N)
-    size_t *possiblestarts_n = malloc(nn * sizeof(size_t));
-    possiblestarts_n[0] = 0;
-    for(size_t i=1; i<nn-1; i++){
-        possiblestarts_n[i] = 0;
+// takes over the references in r
+static int sl_add(struct StartList *l, const struct Start *r){
+    if(l->num==l->cap){
+        size_t cap = l->cap>0 ? 2*l->cap : 16;
+        struct Start *recs = realloc(l->recs, cap * sizeof(struct Start));
+        if(!recs){
+            printf("ERROR: could not allocate memory for %zu segment starts\n", cap);
+            seg_release(r->segs);
+            det_free(r->det);
+            return 1;
+        }
+        l->recs = recs;
+        l->cap = cap;
     }
-    size_t numpossiblestarts_n = 1;
+    l->recs[l->num++] = *r;
+    return 0;
+}
 
-    // minstart only tracks nuis starts as they are longer anyway
-    size_t minstart = 0;
+static void det_free(struct Det *det){
+    if(det){
+        seg_release(det->segs);
+        sl_clear(&det->starts);
+        hist_release(det->hist);
+        free(det);
+    }
+}
 
-    // main DP loop
-    double bgcost;
-    double *segcosts = malloc(nn * sizeof(double));
-    for(size_t tt=1; tt<nn; tt++){
-        // printf("----Cycle %zu/%zu----\n", tt+1, nn);
-        // precompute costs for all possible segments ending here at t
-        m2 = 0;
-        // Note: minstart fixed for now. Cannot really prune this,
-        // b/c burnin iterations do not prune possible S starts.
-        minstart = tt>maxlb ? tt-maxlb : 0;
-        // printf("DEBUG will precompute C down to %zu\n", minstart);
-        for(size_t start=tt; start>minstart; start--){
-            m2 += x2s[start];
-            len = tt-start+1;
-            // when we want to limit the S+N directions, also need to store seg. variance:
-            vars[start] = m2/len;
-            cs[start] = len*(1 + log(m2/len));
+static struct Det *det_new(const ChpDetector *d){
+    struct Det *det = calloc(1, sizeof(struct Det));
+    if(!det){
+        printf("ERROR: could not allocate memory for a nuisance detector\n");
+        return NULL;
+    }
+    if(!d->allsub){
+        det->hist = hist_new();
+        if(!det->hist){
+            free(det);
+            return NULL;
         }
+    }
+    return det;
+}
 
-        // F_B = F(t-1) + C0(t)
-        bgcost = F[tt-1] + cost0var(x2s[tt], sigma0);
+static char segtype(const ChpDetector *d, const size_t start, const size_t end){
+    return end-start<=d->maxlb ? 's' : 'n';
+}
 
-        // F_S = min F(t-k) + C(t-k+1:t) + beta
-        // this will loop over all possible sig. segment starts:
-        double bestsegcost = INFINITY;
-        size_t bestsegstart = 0;
-        findmincost(cs, F, possiblestarts, numpossiblestarts, &bestsegcost, &bestsegstart, segcosts);
-        // printf("bgcost: %.2f, segcost: %.2f + %.2f at t=%zu\n", bgcost, bestsegcost, penalty_s, bestsegstart+1);
-
-        // loop over all possible nuis. segment starts:
-        // basically, all points 1:maxlb and maxlb: are used in the loop (for doing detector.step),
-        // but only points maxlb+1: are treated as real nuis candidates and get pruned
-        double bestnuiscost = INFINITY;
-        size_t bestnuisstart = 0;
-        for(size_t i=0; i<numpossiblestarts_n; i++){
-            double detbgcost;
-            size_t t2 = possiblestarts_n[i];
-            // printf("DEBUG Working on potential nuisance at %zu : %zu\n", t2+1, tt);
-            // start of the nn-size block alloc'd for this detector
-            // (in row-column notation, 0-based indices on the matrices are:
-            //  row=first element in the detector
-            //  column=last element in the detector
-            // So it is upper triangular.
-            size_t t2det = (t2+1)*nn;
-
-            // if tested seg l=1, don't test segments etc.
-            // (detector F, wt values are already initialized with 0)
-            if(t2+1 < tt){
-                detbgcost = detFs[t2det + tt-1] + cost0var(x2s[tt], detwts[t2det + tt-1]);
-
-                // step the detector (which now contains points t2-tt),
-                // i.e. loop over last (S) segment starts for that detector
-                double detbestsegcost = INFINITY;
-                size_t detbestsegstart = 0;
-                for(size_t j=0; j<detnumpostarts[t2+1]; j++){
-                    size_t t3 = detpostarts[t2det + j];
-                    // printf("- possible start: %zu (%zu total)\n", t3, detnumpostarts[t2+1]);
-                    if(t3<minstart){
-                        printf("ERROR: fatal cache miss for precomputed cost at %zu < %zu, detector %zu\n", t3, minstart, t2);
-                        return(1);
-                    }
-                    // cs: precomputed cost for segs ending at tt
-                    detsegcosts[t2det + t3] = detFs[t2det + t3] + cs[t3+1];
-
-                    // If we want to limit effect directions to theta_S > theta_N > theta_0 or vice versa:
-                    // for any segment which had theta_0 < theta_S < theta_N, the cost of segment cannot be minimal
-                    // (b/c it equals C(no segment)+beta). But don't set the cost to inf to avoid pruning it.
-                    if((detwts[t2det+tt-1]>sigma0 && vars[t3+1] <= detwts[t2det+tt-1]) || \
-                            (detwts[t2det+tt-1]<sigma0 && vars[t3+1] >= detwts[t2det+tt-1])){
-                        continue;
-                    }
-
-                    // keep track to get min and argmin F_S for that detector
-                    if(detsegcosts[t2det + t3] < detbestsegcost){
-                        detbestsegcost = detsegcosts[t2det + t3];
-                        detbestsegstart = t3;
-                    }
-                }
-                // printf("- chosen seg start for this N: %zu\n", detbestsegstart);
-
-                // determine best F = min(F_B, F_S)
-                detbestsegcost += penalty_s;
-                if(detbgcost < detbestsegcost){
-                    // update cost
-                    detFs[t2det + tt] = detbgcost;
-                    // update wt
-                    detbgsizes[t2det + tt] = detbgsizes[t2det + tt-1]+1;
-                    detwts[t2det + tt] = detwts[t2det+tt-1] - (detwts[t2det+tt-1] - x2s[tt])/detbgsizes[t2det + tt];
-                    // using 0 to indicate "not a chp", as the 0-th point is auto-set to background
-                    detchps[t2det + tt].start = 0;
-                } else {
-                    // update cost
-                    detFs[t2det + tt] = detbestsegcost;
-                    // reset wt to wt[beststart]
-                    detbgsizes[t2det + tt] = detbgsizes[t2det + detbestsegstart];
-                    detwts[t2det + tt] = detwts[t2det + detbestsegstart];
-                    // attach the new chp pair
-                    detchps[t2det + tt].start = detbestsegstart+1;
-                    // detchps[t2det + tt].end = tt;
-                    // printf("! Ch.p. detected at %zu-%zu\n", detbestsegstart+1, tt);
-                }
+ChpDetector *chp_new(const int alg, const size_t maxlb, const double mu0, const double sigma0, const double penalty_s, const double penalty_n, const size_t printing, const int allsub){
+    if(alg!=1 && alg!=2){
+        printf("ERROR: unknown detector %d\n", alg);
+        return NULL;
+    }
+    if(alg==2 && maxlb==0){
+        printf("ERROR: maxlb must be positive\n");
+        return NULL;
+    }
+    ChpDetector *d = calloc(1, sizeof(ChpDetector));
+    if(!d){
+        printf("ERROR: could not allocate memory for the detector\n");
+        return NULL;
+    }
+    d->alg = alg;
+    d->maxlb = maxlb;
+    d->mu0 = mu0;
+    d->sigma0 = sigma0;
+    d->penalty_s = penalty_s;
+    d->penalty_n = penalty_n;
+    d->printing = printing;
+    d->allsub = allsub;
+    if(alg==2){
+        d->x2r = malloc(maxlb * sizeof(double));
+        d->cs = malloc(maxlb * sizeof(double));
+        d->vars = malloc(maxlb * sizeof(double));
+        if(!d->x2r || !d->cs || !d->vars){
+            printf("ERROR: could not allocate memory of size 3 x %zu x %zu bytes\n", maxlb, sizeof(double));
+            chp_free(d);
+            return NULL;
+        }
+    }
+    return d;
+}
+
+void chp_free(ChpDetector *d){
+    if(!d){
+        return;
+    }
+    seg_release(d->segs);
+    sl_clear(&d->starts);
+    sl_clear(&d->nuis);
+    free(d->x2r);
+    free(d->cs);
+    free(d->vars);
+    free(d->out);
+    free(d);
+}
+
+// the 0-th point is auto-set to background
+static int chp_first(ChpDetector *d, const double x2){
+    d->F = 0;
+    d->wt = x2;
+    d->bgsize = 1;
+    d->cumx2 = x2;
+    struct Start nr = {0};
+    nr.wt = x2;
+    nr.bgsize = 1;
+    if(sl_add(&d->starts, &nr)){
+        return 1;
+    }
+    if(d->alg==2){
+        d->x2r[0] = x2;
+        nr.cumx2 = x2;
+        nr.det = det_new(d);
+        if(!nr.det || sl_add(&d->nuis, &nr)){
+            return 1;
+        }
+    }
+    return 0;
+}
+
+// main step - alg 1
+static int step1(ChpDetector *d, const double x2){
+    const size_t t = d->n;
+
+    // F_B = F(t-1) + C0(t)
+    double bgcost = d->F + cost0var(x2, d->wt);
+
+    // F_S = min F(t-k) + C(t-k+1:t) + beta
+    // (segment sums are updated at each start, so no lookback over the data is needed)
+    double bestsegcost = INFINITY;
+    size_t bestseg = d->starts.num;
+    for(size_t i=0; i<d->starts.num; i++){
+        struct Start *r = &d->starts.recs[i];
+        r->m2 += x2;
+        double len = t - r->t;
+        r->segcost = r->F + len*(1 + log(r->m2/len));
+        if(r->segcost < bestsegcost){
+            bestsegcost = r->segcost;
+            bestseg = i;
+        }
+    }
+
+    // determine best F = min(F_B, F_S)
+    bestsegcost += d->penalty_s;
+    if(bestseg==d->starts.num || bgcost < bestsegcost){
+        d->F = bgcost;
+        d->bgsize++;
+        d->wt = d->wt - (d->wt - x2)/d->bgsize;
+    } else {
+        struct Start *r = &d->starts.recs[bestseg];
+        struct Seg *s = seg_new(r->t+1, t, segtype(d, r->t+1, t), sqrt(r->m2/(t - r->t)), r->segs, NULL);
+        if(!s){
+            return 1;
+        }
+        d->F = bestsegcost;
+        // reset wt to wt[beststart]
+        d->bgsize = r->bgsize;
+        d->wt = r->wt;
+        seg_release(d->segs);
+        d->segs = s;
+    }
+
+    // prune possible segment starts
+    // (a start moved into place i is checked in the next cycle)
+    for(size_t i=0; i<d->starts.num; i++){
+        if(d->F <= d->starts.recs[i].segcost){
+            sl_remove(&d->starts, i);
+        }
+    }
+    struct Start nr = {0};
+    nr.t = t;
+    nr.F = d->F;
+    nr.wt = d->wt;
+    nr.bgsize = d->bgsize;
+    nr.segs = seg_ref(d->segs);
+    return sl_add(&d->starts, &nr);
+}
+
+// step of the detector for signal on a nuisance - alg 2
+// (uses the costs precomputed for the main step)
+static int det_step(const ChpDetector *d, struct Det *det, const double x2, const int first){
+    const size_t tt = d->n;
+    const size_t minstart = tt>d->maxlb ? tt-d->maxlb : 0;
+    if(first){
+        det->F = 1 + log(x2);
+        det->wt = x2;
+        det->bgsize = 1;
+    } else {
+        double detbgcost = det->F + cost0var(x2, det->wt);
+
+        // loop over last (S) segment starts for this detector
+        double detbestsegcost = INFINITY;
+        size_t detbestseg = det->starts.num;
+        for(size_t j=0; j<det->starts.num; j++){
+            struct Start *r = &det->starts.recs[j];
+            if(r->t<minstart){
+                printf("ERROR: fatal cache miss for precomputed cost at %zu < %zu\n", r->t, minstart);
+                return 1;
             }
+            r->segcost = r->F + d->cs[tt - r->t - 1];
+
+            // If we want to limit effect directions to theta_S > theta_N > theta_0 or vice versa:
+            // for any segment which had theta_0 < theta_S < theta_N, the cost of segment cannot be minimal
+            // (b/c it equals C(no segment)+beta). But don't set the cost to inf to avoid pruning it.
+            double var = d->vars[tt - r->t - 1];
+            if((det->wt>d->sigma0 && var <= det->wt) || (det->wt<d->sigma0 && var >= det->wt)){
+                continue;
+            }
+            if(r->segcost < detbestsegcost){
+                detbestsegcost = r->segcost;
+                detbestseg = j;
+            }
+        }
 
-            // update and prune possible segment starts
-            // btw note the lit loop syntax
-            for(size_t j=detnumpostarts[t2+1]; j-- > 0; ){
-                if(detFs[t2det + tt] <= detsegcosts[t2det + detpostarts[t2det + j]]){
-                    // prune out this start time
-                    // printf("DEBUG - pruning out %zu, replacing with %zu\n", detpostarts[t2det + j], detpostarts[t2det + detnumpostarts[t2+1]-1]);
-                    detpostarts[t2det + j] = detpostarts[t2det + --detnumpostarts[t2+1]];
-                } else if(tt+1-detpostarts[t2det + j] > maxlb){
-                    // remove one segment start to limit lookback
-                    // (not super efficient but can't do better w/o sorting)
-                    // printf("DEBUG - start %zu for detector %zu exceeds maxlb = %zu\n", detpostarts[t2det+j], t2, maxlb);
-                    detpostarts[t2det + j] = detpostarts[t2det + --detnumpostarts[t2+1]];
-                }
+        // determine best F = min(F_B, F_S)
+        detbestsegcost += d->penalty_s;
+        if(detbestseg==det->starts.num || detbgcost < detbestsegcost){
+            det->F = detbgcost;
+            det->bgsize++;
+            det->wt = det->wt - (det->wt - x2)/det->bgsize;
+        } else {
+            struct Start *r = &det->starts.recs[detbestseg];
+            struct Seg *s = seg_new(r->t+1, tt, 'o', sqrt(d->vars[tt - r->t - 1]), r->segs, NULL);
+            if(!s){
+                return 1;
             }
-            detpostarts[t2det + detnumpostarts[t2+1]++] = tt;
-            // printf("- Current wt: %f, F(t): %.2f\n", detwts[t2det + tt], detFs[t2det + tt]);
-            // printf("- total number of possible det. starts: %zu, last: %zu\n", detnumpostarts[t2+1], detpostarts[t2det + detnumpostarts[t2+1]-1]);
-            if(detwts[t2det+tt]==9999){
-                printf("ERROR: fatal cache miss in cycle %zu\n", tt);
+            if(det->hist && hist_add(det->hist, r->t+1, tt, s->theta)){
+                seg_release(s);
                 return 1;
             }
+            det->F = detbestsegcost;
+            det->bgsize = r->bgsize;
+            det->wt = r->wt;
+            seg_release(det->segs);
+            det->segs = s;
+        }
+    }
 
-            // check if this detector is the best nuisance
-            // (nuisances of length 1:maxlb are only for burn-in and not real candidates)
-            if(tt-t2 > maxlb){
-                if(F[t2] + detFs[t2det + tt] < bestnuiscost){
-                    bestnuiscost = F[t2] + detFs[t2det + tt];
-                    bestnuisstart = t2;
-                }
-            }
+    // update and prune possible segment starts
+    for(size_t j=det->starts.num; j-- > 0; ){
+        struct Start *r = &det->starts.recs[j];
+        if(det->F <= r->segcost || tt+1-r->t > d->maxlb){
+            sl_remove(&det->starts, j);
         }
-            
-        // printf("bgcost: %.2f, segcost: %.2f + %.2f at t=%zu, nuiscost: %.2f + %.2f at t=%zu\n", bgcost, bestsegcost, penalty_s, bestsegstart+1, bestnuiscost, penalty_n, bestnuisstart+1);
+    }
+    struct Start nr = {0};
+    nr.t = tt;
+    nr.F = det->F;
+    nr.wt = det->wt;
+    nr.bgsize = det->bgsize;
+    nr.segs = seg_ref(det->segs);
+    return sl_add(&det->starts, &nr);
+}
 
-        // determine best F = min(F_B, F_S, F_N)
-        bestsegcost += penalty_s;
-        bestnuiscost += penalty_n;
+// main step - alg 2
+static int step2(ChpDetector *d, const double x2){
+    const size_t tt = d->n;
+    const size_t maxlb = d->maxlb;
+
+    // precompute costs for all possible segments ending here at tt
+    d->x2r[tt % maxlb] = x2;
+    d->cumx2 += x2;
+    const size_t minstart = tt>maxlb ? tt-maxlb : 0;
+    double m2 = 0;
+    for(size_t start=tt; start>minstart; start--){
+        m2 += d->x2r[start % maxlb];
+        double len = tt-start+1;
+        d->vars[tt-start] = m2/len;
+        d->cs[tt-start] = len*(1 + log(m2/len));
+    }
 
-        if(bgcost < bestsegcost && bgcost < bestnuiscost){
-            // update cost
-            F[tt] = bgcost;
-            // using 0 to indicate "not a chp", as the 0-th point is auto-set to background
-            chps[tt].start = 0;
-        } else if (bestsegcost<bestnuiscost){
-            // update cost
-            F[tt] = bestsegcost;
-            // attach the new chp pair
-            chps[tt].start = bestsegstart+1;
-            // printf("! Ch.p. detected at %zu-%zu, type SIGNAL\n", bestsegstart+1, tt);
-        } else {
-            // update cost
-            F[tt] = bestnuiscost;
-            // attach the new chp pair
-            chps[tt].start = bestnuisstart+1;
-            // printf("! Ch.p. detected at %zu-%zu, type NUIS\n", bestnuisstart+1, tt);
+    // F_B = F(t-1) + C0(t)
+    double bgcost = d->F + cost0var(x2, d->sigma0);
+
+    // F_S = min F(t-k) + C(t-k+1:t) + beta
+    double bestsegcost = INFINITY;
+    size_t bestseg = d->starts.num;
+    for(size_t i=0; i<d->starts.num; i++){
+        struct Start *r = &d->starts.recs[i];
+        r->segcost = r->F + d->cs[tt - r->t - 1];
+        if(r->segcost < bestsegcost){
+            bestsegcost = r->segcost;
+            bestseg = i;
+        }
+    }
+
+    // loop over all possible nuis. segment starts, stepping their detectors,
+    // but only nuisances longer than maxlb are real candidates (the rest are burn-ins)
+    double bestnuiscost = INFINITY;
+    size_t bestnuis = d->nuis.num;
+    for(size_t i=0; i<d->nuis.num; i++){
+        struct Start *nu = &d->nuis.recs[i];
+        if(det_step(d, nu->det, x2, nu->t+1==tt)){
+            return 1;
+        }
+        if(tt - nu->t > maxlb && nu->F + nu->det->F < bestnuiscost){
+            bestnuiscost = nu->F + nu->det->F;
+            bestnuis = i;
         }
+    }
 
-        // update and prune possible segment starts
-        // minstart = tt; // useful for reducing the set for cost precomputing
-        // minstart = tt>maxlb ? tt-maxlb : 0;
-        for(size_t i=numpossiblestarts; i-- > 0;){
-            if(F[tt] <= segcosts[possiblestarts[i]]){
-                // prune out this start time
-                possiblestarts[i] = possiblestarts[--numpossiblestarts];
-            } else if(tt+1-possiblestarts[i] > maxlb){
-                // remove one segment start to limit lookback
-                // (not super efficient but can't do better w/o sorting)
-                possiblestarts[i] = possiblestarts[--numpossiblestarts];
-            }
-            // if(possiblestarts[i]<minstart){
-            //     minstart = possiblestarts[i];
-            // }
-        }
-        // printf("After pruning signal starts, %zu remain, starting at %zu\n", numpossiblestarts, minstart);
-
-        // add one segment start
-        possiblestarts[numpossiblestarts++] = tt;
-
-        // update and prune possible nuisance starts
-        for(size_t i=numpossiblestarts_n; i-- >0;){
-            size_t t2 = possiblestarts_n[i];
-            // nuisances that will be no longer than maxlb in the next cycle
-            // are just burnins (not used for F_N), so shouldn't be pruned
-            if(tt-t2 > maxlb){
-                if(F[tt] <= F[t2] + detFs[(t2+1)*nn + tt]){
-                    // prune out this start time
-                    possiblestarts_n[i] = possiblestarts_n[--numpossiblestarts_n];
-                }
+    // determine best F = min(F_B, F_S, F_N)
+    bestsegcost += d->penalty_s;
+    bestnuiscost += d->penalty_n;
+    if((bgcost < bestsegcost && bgcost < bestnuiscost) || (bestseg==d->starts.num && bestnuis==d->nuis.num)){
+        d->F = bgcost;
+    } else {
+        struct Seg *s;
+        if(bestsegcost < bestnuiscost){
+            struct Start *r = &d->starts.recs[bestseg];
+            d->F = bestsegcost;
+            s = seg_new(r->t+1, tt, segtype(d, r->t+1, tt), sqrt(d->vars[tt - r->t - 1]), r->segs, NULL);
+        } else {
+            struct Start *nu = &d->nuis.recs[bestnuis];
+            d->F = bestnuiscost;
+            s = seg_new(nu->t+1, tt, segtype(d, nu->t+1, tt), sqrt((d->cumx2 - nu->cumx2)/(tt - nu->t)), nu->segs, d->allsub ? nu->det->segs : NULL);
+            if(s && !d->allsub){
+                s->hist = hist_ref(nu->det->hist);
+                s->histnum = nu->det->hist->num;
             }
         }
-        possiblestarts_n[numpossiblestarts_n++] = tt;
-        // printf("After pruning nuisance starts, %zu remain\n", numpossiblestarts_n);
+        if(!s){
+            return 1;
+        }
+        seg_release(d->segs);
+        d->segs = s;
     }
-    // printf("Final cost: %.3f\n", F[nn-1]);
 
-    free(detwts);
-    free(detFs);
-    free(detsegcosts);
-    free(detbgsizes);
-    free(detpostarts);
-    free(detnumpostarts);
-    free(x2s);
-    free(F);
-    free(cs);
-    free(vars);
-    free(segcosts);
-    free(possiblestarts);
-    free(possiblestarts_n);
+    // update and prune possible segment starts
+    for(size_t i=d->starts.num; i-- > 0; ){
+        struct Start *r = &d->starts.recs[i];
+        if(d->F <= r->segcost || tt+1-r->t > maxlb){
+            sl_remove(&d->starts, i);
+        }
+    }
+    struct Start nr = {0};
+    nr.t = tt;
+    nr.F = d->F;
+    nr.segs = seg_ref(d->segs);
+    if(sl_add(&d->starts, &nr)){
+        return 1;
+    }
 
-    // extract changepoints
-    size_t i = nn-1;
-    if(printing){
-         printf("Detected segments:\n");
+    // update and prune possible nuisance starts
+    // (nuisances that will be no longer than maxlb in the next cycle
+    // are just burn-ins, so shouldn't be pruned)
+    for(size_t i=d->nuis.num; i-- > 0; ){
+        struct Start *nu = &d->nuis.recs[i];
+        if(tt - nu->t > maxlb && d->F <= nu->F + nu->det->F){
+            sl_remove(&d->nuis, i);
+        }
     }
-    size_t outnum = 0;
-    while(i>0){
-        if(chps[i].start>0){
-            // return this segment
-            outstarts[outnum] = (int) chps[i].start;
-            outends[outnum] = (int) i;
-            // no need to store the type since it can be recreated from length
-            char thischptype = i-chps[i].start<=maxlb ? 's' : 'n';
-            outtypes[outnum] = thischptype;
-            if(printing){
-                printf("* %zu. %zu-%zu %s   \t\t", outnum, chps[i].start, i, thischptype=='s'?"SIG ":"NUIS");
-                printf("   * theta: %.2f\n", estsigma(x2s, chps[i].start, i));
+    nr.segs = seg_ref(d->segs);
+    nr.cumx2 = d->cumx2;
+    nr.det = det_new(d);
+    if(!nr.det){
+        seg_release(nr.segs);
+        return 1;
+    }
+    return sl_add(&d->nuis, &nr);
+}
+
+int chp_push(ChpDetector *d, const double xs[], const size_t n){
+    if(d->finished){
+        printf("ERROR: data pushed to a finished detector\n");
+        return 1;
+    }
+    for(size_t i=0; i<n; i++){
+        double x = xs[i] - d->mu0;
+        int err;
+        if(d->n==0){
+            err = chp_first(d, x*x);
+        } else if(d->alg==1){
+            err = step1(d, x*x);
+        } else {
+            err = step2(d, x*x);
+        }
+        if(err){
+            return 1;
+        }
+        d->n++;
+    }
+    return 0;
+}
+
+// signal segments on a nuisance, as found by the original batch detector from the
+// history of its detector: walks back from the end of the nuisance, and at every second point
+// (or, after a segment, at the second point before it) takes the segment chosen there.
+// Stores them in out (newest first) if given, returns their number.
+static size_t hist_sub(const struct Seg *s, struct SegOut out[]){
+    const struct Hist *h = s->hist;
+    size_t k = s->histnum;
+    size_t num = 0;
+    size_t i2 = s->end;
+    while(i2>s->start){
+        while(k>0 && h->ends[k-1]>i2){
+            k--;
+        }
+        if(k>0 && h->ends[k-1]==i2){
+            if(out){
+                out[num].start = h->starts[k-1];
+                out[num].end = i2;
+                out[num].type = 'o';
+                out[num].theta = h->thetas[k-1];
             }
-            outnum++;
+            num++;
+            i2 = h->starts[k-1] - 1;
+        } else {
+            i2--;
+        }
+        i2--;
+    }
+    return num;
+}
 
-            // just in case
-            if(chps[i].start - 1 >= i){
-                printf("ERROR: potential infinite recursion in changepoints\n");
+// queue a final segment for output (nuisances are followed by their signal segments)
+static int out_add(ChpDetector *d, struct Seg *s){
+    size_t nsub = 0;
+    if(s->type=='n'){
+        if(s->hist){
+            nsub = hist_sub(s, NULL);
+        }
+        for(struct Seg *o=s->sub; o; o=o->prev){
+            nsub++;
+        }
+    }
+    if(d->outnum+1+nsub > d->outcap){
+        // drop the segments already popped
+        for(size_t i=d->outfirst; i<d->outnum; i++){
+            d->out[i - d->outfirst] = d->out[i];
+        }
+        d->outnum -= d->outfirst;
+        d->outfirst = 0;
+        if(d->outnum+1+nsub > d->outcap){
+            size_t cap = 2*d->outcap > d->outnum+1+nsub ? 2*d->outcap : d->outnum+1+nsub+16;
+            struct SegOut *out = realloc(d->out, cap * sizeof(struct SegOut));
+            if(!out){
+                printf("ERROR: could not allocate memory for %zu segments\n", cap);
                 return 1;
             }
+            d->out = out;
+            d->outcap = cap;
+        }
+    }
+    d->out[d->outnum].start = s->start;
+    d->out[d->outnum].end = s->end;
+    d->out[d->outnum].type = s->type;
+    d->out[d->outnum].theta = s->theta;
+    if(s->type=='n' && s->hist && nsub>0){
+        // the history walk is newest first
+        struct SegOut *sub = d->out + d->outnum + 1;
+        hist_sub(s, sub);
+        for(size_t i=0; i<nsub/2; i++){
+            struct SegOut tmp = sub[i];
+            sub[i] = sub[nsub-1-i];
+            sub[nsub-1-i] = tmp;
+        }
+    }
+    if(s->type=='n' && !s->hist){
+        // the sub list is newest first
+        size_t i = d->outnum + 1 + nsub;
+        for(struct Seg *o=s->sub; o; o=o->prev){
+            i--;
+            d->out[i].start = o->start;
+            d->out[i].end = o->end;
+            d->out[i].type = 'o';
+            d->out[i].theta = o->theta;
+        }
+    }
+    if(d->printing){
+        for(size_t i=d->outnum; i<d->outnum+1+nsub; i++){
+            if(d->outtotal==0){
+                printf("Detected segments:\n");
+            }
+            struct SegOut *o = &d->out[i];
+            if(d->alg==1){
+                printf("* %zu-%zu\n", o->start, o->end);
+            } else {
+                printf("* %zu. %zu-%zu %s   \t\t", d->outtotal, o->start, o->end, o->type=='s'?"SIG ":(o->type=='n'?"NUIS":"SIG on NUIS"));
+                printf("   * theta: %.2f\n", o->theta);
+            }
+            d->outtotal++;
+        }
+    } else {
+        d->outtotal += 1+nsub;
+    }
+    d->outnum += 1+nsub;
 
-            // if this is a nuis, look for overlapping signal segments:
-            if(thischptype=='n'){
-                size_t i2 = i;
-                size_t i2det = chps[i].start*nn;
-                while(i2>chps[i].start){
-                    if(detchps[i2det + i2].start>0){
-                        if(printing){
-                            printf("* %zu. %zu-%zu %s \t", outnum, detchps[i2det + i2].start, i2, "SIG on NUIS");
-                            printf("   * theta: %.2f\n", estsigma(x2s, detchps[i2det + i2].start, i2));
-                        }
-                        outstarts[outnum] = (int) detchps[i2det + i2].start;
-                        outends[outnum] = (int) i2;
-                        outtypes[outnum] = 'o';
-                        outnum++;
-
-                        // just in case
-                        if(detchps[i2det + i2].start - 1 >= i2){
-                            printf("ERROR: potential infinite recursion in changepoints\n");
-                            return 1;
-                        }
-                        i2 = detchps[i2det + i2].start - 1;
-                    } else {
-                        i2--;
-                    }
-                    i2--;
-                }
+    s->emitted = 1;
+    seg_release(s->sub);
+    s->sub = NULL;
+    hist_release(s->hist);
+    s->hist = NULL;
+    return 0;
+}
+
+static int cmpseg(const void *a, const void *b){
+    uintptr_t x = (uintptr_t) *(struct Seg * const *) a;
+    uintptr_t y = (uintptr_t) *(struct Seg * const *) b;
+    return (x>y) - (x<y);
+}
+
+// output the segments contained in all of the given segmentations,
+// and cut the lists there, as the older segments are not needed anymore
+static int emit_common(ChpDetector *d, struct Seg *heads[], const size_t nheads){
+    // distinct segmentations
+    qsort(heads, nheads, sizeof(struct Seg *), cmpseg);
+    size_t nsegs = 0;
+    for(size_t i=0; i<nheads; i++){
+        if(!heads[i]){
+            // some candidate has no segments, so none are final
+            return 0;
+        }
+        if(nsegs==0 || heads[i]!=heads[nsegs-1]){
+            heads[nsegs++] = heads[i];
+        }
+    }
+    if(nsegs==0){
+        return 0;
+    }
+
+    // count the segmentations containing each segment
+    d->epoch++;
+    for(size_t i=0; i<nsegs; i++){
+        for(struct Seg *s=heads[i]; s && !s->emitted; s=s->prev){
+            if(s->epoch!=d->epoch){
+                s->epoch = d->epoch;
+                s->visits = 0;
             }
-            i = chps[i].start - 1;
-        } else {
-            i--;
+            s->visits++;
         }
     }
-    free(detchps);
-    free(chps);
+
+    // find the newest common segment - all older ones are common as well
+    struct Seg *last = heads[0];
+    while(last && !last->emitted && !(last->epoch==d->epoch && last->visits==nsegs)){
+        last = last->prev;
+    }
+    if(!last || last->emitted){
+        return 0;
+    }
+
+    // output the common segments, oldest first
+    size_t num = 0;
+    for(struct Seg *s=last; s && !s->emitted; s=s->prev){
+        num++;
+    }
+    struct Seg **order = malloc(num * sizeof(struct Seg *));
+    if(!order){
+        printf("ERROR: could not allocate memory for %zu segments\n", num);
+        return 1;
+    }
+    size_t i = num;
+    for(struct Seg *s=last; s && !s->emitted; s=s->prev){
+        order[--i] = s;
+    }
+    for(i=0; i<num; i++){
+        if(out_add(d, order[i])){
+            free(order);
+            return 1;
+        }
+    }
+    free(order);
+    seg_release(last->prev);
+    last->prev = NULL;
     return 0;
 }
 
+int chp_finalise(ChpDetector *d){
+    if(d->n==0 || d->finished){
+        return 0;
+    }
+    // all future segmentations continue from one of the possible starts
+    size_t nheads = d->starts.num + d->nuis.num + 1;
+    struct Seg **heads = malloc(nheads * sizeof(struct Seg *));
+    if(!heads){
+        printf("ERROR: could not allocate memory for %zu segmentations\n", nheads);
+        return 1;
+    }
+    size_t k = 0;
+    heads[k++] = d->segs;
+    for(size_t i=0; i<d->starts.num; i++){
+        heads[k++] = d->starts.recs[i].segs;
+    }
+    for(size_t i=0; i<d->nuis.num; i++){
+        heads[k++] = d->nuis.recs[i].segs;
+    }
+    int err = emit_common(d, heads, nheads);
+    free(heads);
+    return err;
+}
+
+int chp_finish(ChpDetector *d){
+    if(d->finished){
+        return 0;
+    }
+    d->finished = 1;
+    if(d->n==0){
+        return 0;
+    }
+    if(d->printing && d->alg==1){
+        printf("Final cost: %.2f, final wt: %.4f\n", d->F, d->wt);
+    }
+    struct Seg *heads[1] = {d->segs};
+    int err = emit_common(d, heads, 1);
+    // the search state is not needed anymore
+    sl_clear(&d->starts);
+    sl_clear(&d->nuis);
+    return err;
+}
+
+size_t chp_pending(const ChpDetector *d){
+    return d->outnum - d->outfirst;
+}
+
+// outputs 0-indexed positions, inclusive, in chronological order
+size_t chp_pop(ChpDetector *d, long outstarts[], long outends[], char outtypes[], const size_t maxout){
+    size_t num = 0;
+    while(num<maxout && d->outfirst<d->outnum){
+        outstarts[num] = (long) d->out[d->outfirst].start;
+        outends[num] = (long) d->out[d->outfirst].end;
+        outtypes[num] = d->out[d->outfirst].type;
+        d->outfirst++;
+        num++;
+    }
+    if(d->outfirst==d->outnum){
+        d->outfirst = 0;
+        d->outnum = 0;
+    }
+    return num;
+}
+
 // for testing separately:
 // int main(int argc, char *argv[]){
 //     FILE *fp;
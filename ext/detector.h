@@ -1,9 +1,15 @@
 #include <math.h>
 
+typedef struct ChpDetector ChpDetector;
+
 double cost0sq(const double x, const double wt);
 double cost1sq(const double xs[], const size_t len);
 void findmincost(const double cs[], const double Fs[], const size_t starts[], const size_t stlen, double *outcost, size_t *outstart, double segcosts[]);
-double estsigma(const double x2s[], const size_t first, const size_t last);
-int alg1_var(double xs[], const size_t n, const size_t maxlb, const double mu0, const double penalty, int outstarts[], int outends[], char outtypes[]);
 int alg1_mean(double xs[], const size_t n, const double sd, const double penalty);
-int alg2_var(double xs[], const size_t nn, const size_t maxlb, const double sigma0, const double penalty_s, const double penalty_n, int outstarts[], int outends[], char outtypes[], const size_t printing);
+ChpDetector *chp_new(const int alg, const size_t maxlb, const double mu0, const double sigma0, const double penalty_s, const double penalty_n, const size_t printing, const int allsub);
+int chp_push(ChpDetector *d, const double xs[], const size_t n);
+int chp_finalise(ChpDetector *d);
+int chp_finish(ChpDetector *d);
+size_t chp_pending(const ChpDetector *d);
+size_t chp_pop(ChpDetector *d, long outstarts[], long outends[], char outtypes[], const size_t maxout);
+void chp_free(ChpDetector *d);
@@ -0,0 +1,283 @@
+#include <stdlib.h>
+#include <math.h>
+#include <stdio.h>
+#include "dtw.h"
+
+// Dynamic time warping between series of frames.
+// Series are stored row-major: n frames of d features each.
+// Frame cost is |x-y| for d=1, Euclidean distance otherwise,
+// and the recursion is D[i,j] = cost(i,j) + min(D[i-1,j-1], D[i-1,j], D[i,j-1]).
+
+static double framecost(const double x[], const double y[], const size_t d)
+{
+	if(d==1){
+		return fabs(x[0] - y[0]);
+	}
+	double s = 0;
+	for(size_t k=0; k<d; k++){
+		double t = x[k] - y[k];
+		s += t*t;
+	}
+	return sqrt(s);
+}
+
+// Sakoe-Chiba band: columns allowed in row i of a n x m cost matrix.
+// The band follows the diagonal from (0,0) to (n-1,m-1), and band<0 means no constraint.
+// It is widened to the slope of the diagonal if needed, so that a path always exists.
+void dtw_bandlimits(const size_t i, const size_t n, const size_t m, const long band, size_t *lo, size_t *hi)
+{
+	if(band<0 || n<2){
+		*lo = 0;
+		*hi = m-1;
+		return;
+	}
+	size_t r = (size_t)band;
+	size_t slope = (m-1 + n-2) / (n-1);
+	if(r < slope){
+		r = slope;
+	}
+	size_t c = (i*(m-1) + (n-1)/2) / (n-1);
+	*lo = c > r ? c - r : 0;
+	*hi = c + r < m-1 ? c + r : m-1;
+}
+
+// DTW distance, keeping only two rows of the accumulated cost matrix.
+// Distances above maxcost are returned as INFINITY. Early abandoning: stops as soon as
+// all the cells in a row exceed maxcost, as the frame costs are non-negative
+// and any path has to cross every row.
+// Returns NAN if memory could not be allocated.
+double dtw_dist(const double x[], const size_t n, const double y[], const size_t m, const size_t d, const long band, const double maxcost)
+{
+	if(n==0 || m==0){
+		return INFINITY;
+	}
+	double *prev = malloc(sizeof(double) * m);
+	double *cur = malloc(sizeof(double) * m);
+	if(prev==NULL || cur==NULL){
+		free(prev);
+		free(cur);
+		return NAN;
+	}
+	for(size_t j=0; j<m; j++){
+		prev[j] = INFINITY;
+		cur[j] = INFINITY;
+	}
+	// ranges of the cells currently stored in each row buffer
+	size_t prevlo=1, prevhi=0, curlo=1, curhi=0;
+	size_t lo, hi, tmps;
+	double *tmp;
+
+	for(size_t i=0; i<n; i++){
+		// clear the buffer, which still holds row i-2
+		for(size_t j=curlo; j<=curhi; j++){
+			cur[j] = INFINITY;
+		}
+		dtw_bandlimits(i, n, m, band, &lo, &hi);
+		double rowmin = INFINITY;
+		for(size_t j=lo; j<=hi; j++){
+			double best;
+			if(i==0 && j==0){
+				best = 0;
+			} else {
+				best = INFINITY;
+				if(i>0){
+					if(prev[j] < best) best = prev[j];
+					if(j>0 && prev[j-1] < best) best = prev[j-1];
+				}
+				if(j>lo && cur[j-1] < best) best = cur[j-1];
+			}
+			cur[j] = framecost(&x[i*d], &y[j*d], d) + best;
+			if(cur[j] < rowmin) rowmin = cur[j];
+		}
+		curlo = lo;
+		curhi = hi;
+		if(rowmin > maxcost){
+			free(prev);
+			free(cur);
+			return INFINITY;
+		}
+		tmp = prev; prev = cur; cur = tmp;
+		tmps = prevlo; prevlo = curlo; curlo = tmps;
+		tmps = prevhi; prevhi = curhi; curhi = tmps;
+	}
+	double res = prev[m-1] > maxcost ? INFINITY : prev[m-1];
+	free(prev);
+	free(cur);
+	return res;
+}
+
+// Full accumulated cost matrix D, (n+1) x (m+1) with an infinite first row and column,
+// as used for backtracking the path. Cells outside the band are infinite.
+int dtw_matrix(const double x[], const size_t n, const double y[], const size_t m, const size_t d, const long band, double D[])
+{
+	size_t lo, hi;
+	const size_t w = m+1;
+	for(size_t i=0; i<(n+1)*w; i++){
+		D[i] = INFINITY;
+	}
+	D[0] = 0;
+	for(size_t i=0; i<n; i++){
+		dtw_bandlimits(i, n, m, band, &lo, &hi);
+		for(size_t j=lo; j<=hi; j++){
+			double best = D[i*w + j+1];
+			if(D[(i+1)*w + j] < best) best = D[(i+1)*w + j];
+			if(D[i*w + j] < best) best = D[i*w + j];
+			D[(i+1)*w + j+1] = framecost(&x[i*d], &y[j*d], d) + best;
+		}
+	}
+	return 0;
+}
+
+// Upper and lower envelopes of y (m frames) over the band of each of the n rows
+// of a n x m DTW, per feature. Running max/min with a monotone queue, as the band limits
+// are non-decreasing. upper and lower are n x d.
+int dtw_envelope(const double y[], const size_t m, const size_t n, const size_t d, const long band, double upper[], double lower[])
+{
+	size_t *dq = malloc(sizeof(size_t) * m);
+	if(dq==NULL){
+		return 1;
+	}
+	size_t lo, hi;
+	for(size_t k=0; k<d; k++){
+		// upper envelope
+		size_t head=0, tail=0, next=0;
+		for(size_t i=0; i<n; i++){
+			dtw_bandlimits(i, n, m, band, &lo, &hi);
+			while(next<=hi){
+				while(tail>head && y[dq[tail-1]*d + k] <= y[next*d + k]) tail--;
+				dq[tail++] = next++;
+			}
+			while(dq[head] < lo) head++;
+			upper[i*d + k] = y[dq[head]*d + k];
+		}
+		// lower envelope
+		head=0; tail=0; next=0;
+		for(size_t i=0; i<n; i++){
+			dtw_bandlimits(i, n, m, band, &lo, &hi);
+			while(next<=hi){
+				while(tail>head && y[dq[tail-1]*d + k] >= y[next*d + k]) tail--;
+				dq[tail++] = next++;
+			}
+			while(dq[head] < lo) head++;
+			lower[i*d + k] = y[dq[head]*d + k];
+		}
+	}
+	free(dq);
+	return 0;
+}
+
+// LB_Keogh lower bound of the DTW distance: distance of each frame of x
+// to the envelope box of the frames it can be matched to.
+// Stops early once the bound exceeds maxcost.
+double dtw_lbkeogh(const double x[], const size_t n, const size_t d, const double upper[], const double lower[], const double maxcost)
+{
+	double lb = 0;
+	for(size_t i=0; i<n; i++){
+		if(d==1){
+			if(x[i] > upper[i]){
+				lb += x[i] - upper[i];
+			} else if(x[i] < lower[i]){
+				lb += lower[i] - x[i];
+			}
+		} else {
+			double s = 0;
+			for(size_t k=0; k<d; k++){
+				double v = x[i*d + k];
+				double t = 0;
+				if(v > upper[i*d + k]){
+					t = v - upper[i*d + k];
+				} else if(v < lower[i*d + k]){
+					t = lower[i*d + k] - v;
+				}
+				s += t*t;
+			}
+			lb += sqrt(s);
+		}
+		if(lb > maxcost){
+			return lb;
+		}
+	}
+	return lb;
+}
+
+// DTW distance between the query q (n frames) and data[i:i+n] for every offset i
+// (shorter windows at the end of data).
+// With a finite maxcost, windows are first screened with LB_Keogh,
+// and distances above maxcost are returned as INFINITY.
+int dtw_offsets(const double q[], const size_t n, const double data[], const size_t N, const size_t d, const long band, const double maxcost, double out[])
+{
+	double *upper = NULL;
+	double *lower = NULL;
+	if(isfinite(maxcost)){
+		upper = malloc(sizeof(double) * n * d);
+		lower = malloc(sizeof(double) * n * d);
+		if(upper==NULL || lower==NULL || dtw_envelope(q, n, n, d, band, upper, lower)>0){
+			free(upper);
+			free(lower);
+			return 1;
+		}
+	}
+	int fail = 0;
+	for(size_t i=0; i<N; i++){
+		size_t w = N-i < n ? N-i : n;
+		if(upper!=NULL && w==n && dtw_lbkeogh(&data[i*d], n, d, upper, lower, maxcost) > maxcost){
+			out[i] = INFINITY;
+			continue;
+		}
+		out[i] = dtw_dist(q, n, &data[i*d], w, d, band, maxcost);
+		if(isnan(out[i])){
+			fail = 1;
+			break;
+		}
+	}
+	free(upper);
+	free(lower);
+	return fail;
+}
+
+// Subsequence DTW: the query q (n frames) may start and end anywhere in data (N frames).
+// outcost[j] is the cost of the best match of q ending at frame j,
+// and outstart[j] the frame where that match starts.
+int dtw_subsequence(const double q[], const size_t n, const double data[], const size_t N, const size_t d, double outcost[], long outstart[])
+{
+	if(n==0 || N==0){
+		return 1;
+	}
+	double *cur = malloc(sizeof(double) * N);
+	long *curst = malloc(sizeof(long) * N);
+	if(cur==NULL || curst==NULL){
+		free(cur);
+		free(curst);
+		return 1;
+	}
+	// outcost and outstart hold the previous row
+	for(size_t j=0; j<N; j++){
+		outcost[j] = framecost(&q[0], &data[j*d], d);
+		outstart[j] = (long)j;
+	}
+	for(size_t i=1; i<n; i++){
+		for(size_t j=0; j<N; j++){
+			double best = outcost[j];
+			long st = outstart[j];
+			if(j>0){
+				if(outcost[j-1] < best){
+					best = outcost[j-1];
+					st = outstart[j-1];
+				}
+				if(cur[j-1] < best){
+					best = cur[j-1];
+					st = curst[j-1];
+				}
+			}
+			cur[j] = framecost(&q[i*d], &data[j*d], d) + best;
+			curst[j] = st;
+		}
+		for(size_t j=0; j<N; j++){
+			outcost[j] = cur[j];
+			outstart[j] = curst[j];
+		}
+	}
+	free(cur);
+	free(curst);
+	return 0;
+}
@@ -0,0 +1,9 @@
+#include <math.h>
+
+void dtw_bandlimits(const size_t i, const size_t n, const size_t m, const long band, size_t *lo, size_t *hi);
+double dtw_dist(const double x[], const size_t n, const double y[], const size_t m, const size_t d, const long band, const double maxcost);
+int dtw_matrix(const double x[], const size_t n, const double y[], const size_t m, const size_t d, const long band, double D[]);
+int dtw_envelope(const double y[], const size_t m, const size_t n, const size_t d, const long band, double upper[], double lower[]);
+double dtw_lbkeogh(const double x[], const size_t n, const size_t d, const double upper[], const double lower[], const double maxcost);
+int dtw_offsets(const double q[], const size_t n, const double data[], const size_t N, const size_t d, const long band, const double maxcost, double out[]);
+int dtw_subsequence(const double q[], const size_t n, const double data[], const size_t N, const size_t d, double outcost[], long outstart[]);
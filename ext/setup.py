@@ -11,6 +11,9 @@ extensions = [
         sources=["SplitLauncher.pyx", "SplitWav.c"]),
     Extension("ce_detect",
         sources=["ce_detect.pyx", "detector.c"],
+        include_dirs=[numpy.get_include()]),
+    Extension("ce_dtw",
+        sources=["ce_dtw.pyx", "dtw.c"],
         include_dirs=[numpy.get_include()])
 ]
 
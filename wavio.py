@@ -3,6 +3,11 @@ The wavio module defines the functions:
 read(file)
     Read a WAV file and return a `wavio.Wav` object, with attributes
     `data`, `rate` and `sampwidth`.
+readPages(file, pagelen, overlap)
+    Read a WAV file one page at a time, yielding `wavio.Wav` objects.
+open_mmap(file)
+    Memory-map the PCM data of a WAV file and return a `wavio.WavMmap`
+    object, which reads and decodes only the regions that are sliced.
 write(filename, data, rate, scale=None, sampwidth=None)
     Write a numpy array to a WAV file.
 -----
@@ -33,6 +38,8 @@ POSSIBILITY OF SUCH DAMAGE.
 from __future__ import division as _division
 
 import wave as _wave
+import struct as _struct
+import os as _os
 import numpy as _np
 
 
@@ -50,14 +57,14 @@ def _wav2array(nchannels, sampwidth, data):
 
     if sampwidth == 3:
         a = _np.empty((num_samples, nchannels, 4), dtype=_np.uint8)
-        raw_bytes = _np.fromstring(data, dtype=_np.uint8)
+        raw_bytes = _np.frombuffer(data, dtype=_np.uint8)
         a[:, :, :sampwidth] = raw_bytes.reshape(-1, nchannels, sampwidth)
         a[:, :, sampwidth:] = (a[:, :, sampwidth - 1:sampwidth] >> 7) * 255
         result = a.view('<i4').reshape(a.shape[:-1])
     else:
         # 8 bit samples are stored as unsigned ints; others as signed ints.
         dt_char = 'u' if sampwidth == 1 else 'i'
-        a = _np.fromstring(data, dtype='<%s%d' % (dt_char, sampwidth))
+        a = _np.frombuffer(data, dtype='<%s%d' % (dt_char, sampwidth))
         result = a.reshape(-1, nchannels)
     return result
 
@@ -206,6 +213,259 @@ def read(file,nseconds=None,offset=0):
     return w
 
 
+def readPages(file, pagelen, overlap=0):
+    """
+    Read a WAV file in pages, without loading the whole file into memory.
+    Parameters
+    ----------
+    file : string or file object
+        Either the name of a file or an open file pointer.
+    pagelen : page length (in frames)
+    overlap : number of extra frames to read before and after each page,
+        where available (e.g. to avoid filter edge effects)
+    Yields
+    ------
+    A tuple for each page:
+        start : int
+            Position of the page start in the file (in frames)
+        left : int
+            Number of overlap frames before the page start,
+            i.e. the page itself starts at wav.data[left]
+        wav : wavio.Wav() instance
+            As returned by `wavio.read`, containing this page and its overlaps.
+    Notes
+    -----
+    Only one page (plus overlaps) is held in memory at a time.
+    If the file is shorter than its header claims, iteration stops
+    at the last frame that could be read.
+    """
+    wav = _wave.open(file)
+    try:
+        rate = wav.getframerate()
+        nchannels = wav.getnchannels()
+        sampwidth = wav.getsampwidth()
+        nframes = wav.getnframes()
+
+        start = 0
+        while start < nframes:
+            readstart = max(0, start - overlap)
+            readend = min(nframes, start + pagelen + overlap)
+            wav.setpos(readstart)
+            data = wav.readframes(readend - readstart)
+            # drop any incomplete frame at the end of a truncated file
+            data = data[:len(data) - len(data) % (sampwidth * nchannels)]
+            array = _wav2array(nchannels, sampwidth, data)
+            if array.shape[0] <= start - readstart:
+                break
+            yield start, start - readstart, Wav(data=array, rate=rate, sampwidth=sampwidth, nframes=nframes)
+            start += pagelen
+    finally:
+        wav.close()
+
+
+class WavMmap(object):
+    """
+    Object returned by `wavio.open_mmap`.  Attributes are:
+    data : numpy memmap
+        Read-only view of the raw PCM data in the file, of shape
+        (nframes, nchannels), or (nframes, nchannels, 3) for 24 bit files.
+        Nothing is read from disk until a region of it is used.
+    rate : float
+        The sample rate of the WAV file.
+    sampwidth : int
+        The sample width (i.e. number of bytes per sample) of the WAV file.
+    nchannels : int
+        Number of channels in the WAV file.
+    nframes : int
+        Number of frames in the WAV file (that are actually present on disk).
+    """
+
+    def __init__(self, data, rate, sampwidth, nchannels, nframes):
+        self.data = data
+        self.rate = rate
+        self.sampwidth = sampwidth
+        self.nchannels = nchannels
+        self.nframes = nframes
+
+    def __repr__(self):
+        s = ("WavMmap(rate=%r, sampwidth=%r, nchannels=%r, nframes=%r)" %
+             (self.rate, self.sampwidth, self.nchannels, self.nframes))
+        return s
+
+    def __len__(self):
+        return self.nframes
+
+    def bounds(self, nseconds=None, offset=0):
+        """
+        Converts the length and offset (in seconds) as used in `wavio.read`
+        to the (start, end) frames that `wavio.read` would return.
+        """
+        if nseconds is None:
+            nseconds = self.nframes
+        if float(self.nframes)/self.rate < nseconds:
+            nseconds = float(self.nframes)/self.rate
+        if self.nframes - offset*self.rate < 0:
+            offset = 0
+        start = int(offset*self.rate)
+        end = min(self.nframes, start + int(nseconds*self.rate))
+        return start, end
+
+    def frames(self, start=0, end=None):
+        """
+        Returns frames start to end as integers, in the same format as
+        `wavio.read` (shape (num_samples, num_channels), 24 bit sign-extended
+        to int32). This is a view of the file except for 24 bit data.
+        """
+        raw = self.data[start:end]
+        if self.sampwidth == 3:
+            result = raw[:, :, 0].astype('<i4')
+            result |= raw[:, :, 1].astype('<i4') << 8
+            result |= raw[:, :, 2].view('<i1').astype('<i4') << 16
+            return result
+        return raw
+
+    def asfloat(self, channel=None):
+        """
+        Returns a lazy float view of the data: slicing it decodes only
+        the requested frames, as float64.
+        channel : int or None
+            If given, only this channel is returned (1D),
+            otherwise all channels (2D, like `wavio.read`).
+        """
+        return _FloatView(self, channel)
+
+
+class _FloatView(object):
+    """ Lazy float64 view of a WavMmap, see WavMmap.asfloat. """
+
+    def __init__(self, wav, channel):
+        self.wav = wav
+        self.channel = channel
+
+    def __len__(self):
+        return self.wav.nframes
+
+    @property
+    def shape(self):
+        if self.channel is None:
+            return (self.wav.nframes, self.wav.nchannels)
+        return (self.wav.nframes,)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.wav.nframes)
+            if step < 0:
+                return self[:][key]
+            a = self.wav.frames(start, max(start, end))[::step]
+        else:
+            if key < 0:
+                key += self.wav.nframes
+            a = self.wav.frames(key, key+1)[0]
+        if self.channel is not None:
+            a = a[..., self.channel]
+        return a.astype('float')
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[:]
+        if dtype is not None:
+            a = a.astype(dtype)
+        return a
+
+
+def _readRiffHeader(f):
+    """
+    Walks the RIFF chunks of an open WAV file.
+    Returns (format tag, nchannels, rate, sampwidth, data offset, data size in bytes).
+    """
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError("file does not start with RIFF/WAVE id")
+
+    fmt = None
+    dataoffset = None
+    while fmt is None or dataoffset is None:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        chunkid, chunksize = _struct.unpack('<4sI', chunk)
+        if chunkid == b'fmt ':
+            fmtchunk = f.read(chunksize)
+            if len(fmtchunk) < 16:
+                raise ValueError("fmt chunk is too short")
+            fmt = _struct.unpack('<HHIIHH', fmtchunk[:16])
+            # WAVE_FORMAT_EXTENSIBLE: actual format is in the subformat GUID
+            if fmt[0] == 0xFFFE and len(fmtchunk) >= 26:
+                fmt = (_struct.unpack('<H', fmtchunk[24:26])[0],) + fmt[1:]
+            f.seek(chunksize % 2, 1)
+        elif chunkid == b'data':
+            dataoffset = f.tell()
+            datasize = chunksize
+            f.seek(chunksize + chunksize % 2, 1)
+        else:
+            # chunks are word-aligned
+            f.seek(chunksize + chunksize % 2, 1)
+
+    if fmt is None:
+        raise ValueError("fmt chunk not found")
+    if dataoffset is None:
+        raise ValueError("data chunk not found")
+    formattag, nchannels, rate, _, _, bits = fmt
+    return formattag, nchannels, rate, (bits + 7) // 8, dataoffset, datasize
+
+
+def open_mmap(file):
+    """
+    Open a WAV file as a read-only memory map, without reading the audio.
+    Parameters
+    ----------
+    file : string or file object
+        Either the name of a file or an open file pointer (in binary mode).
+    Returns
+    -------
+    wav : wavio.WavMmap() instance
+        Slicing wav.data, or the views from wav.frames and wav.asfloat,
+        costs the same regardless of where in the file the slice is,
+        and only the sliced region is paged in from disk.
+    Notes
+    -----
+    Like `wavio.read`, this only supports uncompressed integer PCM data.
+    If the file is shorter than its header claims, only the frames
+    actually present are mapped.
+    """
+    if hasattr(file, 'read'):
+        f = file
+        f.seek(0)
+    else:
+        f = open(file, 'rb')
+    try:
+        formattag, nchannels, rate, sampwidth, dataoffset, datasize = _readRiffHeader(f)
+        filesize = _os.fstat(f.fileno()).st_size
+    finally:
+        if f is not file:
+            f.close()
+
+    if formattag != 1:
+        raise ValueError("unsupported WAV format: %d (only integer PCM)" % formattag)
+    if sampwidth < 1 or sampwidth > 4:
+        raise ValueError("sampwidth must not be greater than 4.")
+
+    nframes = min(datasize, filesize - dataoffset) // (sampwidth * nchannels)
+    if sampwidth == 3:
+        dtype = _np.uint8
+        shape = (nframes, nchannels, 3)
+    else:
+        # 8 bit samples are stored as unsigned ints; others as signed ints.
+        dtype = '<%s%d' % ('u' if sampwidth == 1 else 'i', sampwidth)
+        shape = (nframes, nchannels)
+
+    if nframes == 0:
+        # (empty files cannot be mapped)
+        data = _np.zeros(shape, dtype=dtype)
+    else:
+        data = _np.memmap(file, dtype=dtype, mode='r', offset=dataoffset, shape=shape)
+    return WavMmap(data=data, rate=rate, sampwidth=sampwidth, nchannels=nchannels, nframes=nframes)
+
+
 _sampwidth_dtypes = {1: _np.uint8,
                      2: _np.int16,
                      3: _np.int32,